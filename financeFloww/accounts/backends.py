@@ -0,0 +1,17 @@
+from django.contrib.auth.backends import ModelBackend
+
+from .cache import get_cached_user
+
+
+class CachedModelBackend(ModelBackend):
+    """ModelBackend that loads the session's user, with their profile, from cache
+
+    Saves the User query AuthenticationMiddleware runs on every request and
+    the profile query most pages add on top.
+    """
+
+    def get_user(self, user_id):
+        user = get_cached_user(user_id)
+        if user is None or not self.user_can_authenticate(user):
+            return None
+        return user
@@ -0,0 +1,38 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction as db_transaction
+
+from .models import UserProfile
+
+# In the default cache, which every worker shares, so an invalidation is seen by all
+# of them (see the accounts.E001 check)
+USER_CACHE_KEY = 'auth-user:{user_id}'
+# Bounds staleness after changes that bypass save(), e.g. queryset.update()
+USER_CACHE_TIMEOUT = 60 * 15
+
+
+def get_cached_user(user_id):
+    """Load a user together with their profile, from cache when possible"""
+    key = USER_CACHE_KEY.format(user_id=user_id)
+    user = cache.get(key)
+    if user is None:
+        user = User.objects.select_related('profile').filter(pk=user_id).first()
+        if user is not None:
+            cache.set(key, user, USER_CACHE_TIMEOUT)
+    return user
+
+
+def invalidate_cached_user(user_id):
+    """Drop the cached user once the write commits, so no request re-caches the old row"""
+    key = USER_CACHE_KEY.format(user_id=user_id)
+    db_transaction.on_commit(lambda: cache.delete(key))
+
+
+def get_profile(user):
+    """Return the user's profile, creating it for accounts that predate profiles"""
+    try:
+        return user.profile
+    except UserProfile.DoesNotExist:
+        profile, _ = UserProfile.objects.get_or_create(user=user)
+        user.profile = profile
+        return profile
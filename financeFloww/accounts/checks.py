@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core import checks
+
+# Backends whose entries only the process that wrote them can see
+PROCESS_LOCAL_CACHES = {'django.core.cache.backends.locmem.LocMemCache'}
+
+
+@checks.register(checks.Tags.caches, deploy=True)
+def check_shared_auth_cache(app_configs, **kwargs):
+    """Sessions and cached users must be in a cache every worker process shares
+
+    Logouts, password changes and account deletions drop these entries in
+    the process that handles them. With a per-process cache, the other
+    workers would keep accepting the old session and user.
+    """
+    alias = getattr(settings, 'SESSION_CACHE_ALIAS', 'default')
+    errors = []
+    for name in sorted({alias, 'default'}):
+        backend = settings.CACHES.get(name, {}).get('BACKEND')
+        if backend in PROCESS_LOCAL_CACHES:
+            errors.append(checks.Error(
+                f"The '{name}' cache holds sessions and cached users but is local to each process.",
+                hint="Use a shared backend such as django.core.cache.backends.redis.RedisCache.",
+                id='accounts.E001',
+            ))
+    return errors
@@ -0,0 +1,251 @@
+import logging
+from datetime import timedelta
+
+from celery import shared_task
+from django.contrib.auth.models import User
+from django.db import transaction as db_transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from analytics.columnar import bump_store_version, drop_store
+from analytics.models import (
+    BalanceCheckpoint, FinancialSummary, MonthlyReport, SavingsGoal, SpendingTrend, StoreVersion
+)
+from analytics.reports import invalidate_reports
+from budgets.models import Budget, BudgetAlert
+from financeFloww.metrics import timed
+from financeFloww.sharding import shard_for, user_shard
+from transactions.anomalies import detect_anomalies, forget_stats
+from transactions.cache import bump_catalog_version, bump_data_version
+from transactions.models import (
+    ArchivedTransaction, ArchivedYear, Category, CategoryStats, DescriptionSuggestion, PaymentMethod, Transaction
+)
+from transactions.outbox import append, change_event, record
+from .models import DeletionJob, UserProfile
+
+logger = logging.getLogger(__name__)
+
+# Rows removed per database transaction; keeps locks and undo logs small
+DELETION_BATCH_SIZE = 2000
+# A running job that has not reported progress for this long is presumed dead
+STALE_JOB_AFTER = timedelta(minutes=10)
+# Rows whose removal is appended to the outbox, and the model their events name.
+# Archived transactions left the feed when they were archived (see transactions.archive).
+RECORDED_MODELS = {
+    Transaction: Transaction,
+    Budget: Budget,
+    SavingsGoal: SavingsGoal,
+}
+
+
+def _user_steps(user_id):
+    """Dependents of a user, children before parents, as (step, queryset, nulled field)"""
+    return [
+        ('budget alerts', BudgetAlert.objects.filter(user_id=user_id), None),
+        ('budgets', Budget.objects.filter(user_id=user_id), None),
+        ('spending trends', SpendingTrend.objects.filter(user_id=user_id), None),
+        ('monthly reports', MonthlyReport.objects.filter(user_id=user_id), None),
+        ('financial summaries', FinancialSummary.objects.filter(user_id=user_id), None),
+        ('savings goals', SavingsGoal.objects.filter(user_id=user_id), None),
+        ('balance checkpoints', BalanceCheckpoint.objects.filter(user_id=user_id), None),
+        ('store versions', StoreVersion.objects.filter(user_id=user_id), None),
+        ('transactions', Transaction.objects.filter(user_id=user_id), None),
+        ('archived transactions', ArchivedTransaction.objects.filter(user_id=user_id), None),
+        ('archived years', ArchivedYear.objects.filter(user_id=user_id), None),
+        ('description suggestions', DescriptionSuggestion.objects.filter(user_id=user_id), None),
+        ('category stats', CategoryStats.objects.filter(user_id=user_id), None),
+        ('payment methods', PaymentMethod.objects.filter(user_id=user_id), None),
+        ('categories', Category.objects.filter(user_id=user_id), None),
+        ('profile', UserProfile.objects.filter(user_id=user_id), None),
+    ]
+
+
+def _category_steps(category_id):
+    """Dependents of a category, mirroring the on_delete rules of their foreign keys
+
+    Stored reports naming the category as the top expense are derived data,
+    so they are dropped and rebuilt on the next view instead of nulled.
+    """
+    return [
+        ('budget alerts', BudgetAlert.objects.filter(budget__category_id=category_id), None),
+        ('budgets', Budget.objects.filter(category_id=category_id), None),
+        ('spending trends', SpendingTrend.objects.filter(category_id=category_id), None),
+        ('monthly reports', MonthlyReport.objects.filter(top_expense_category_id=category_id), None),
+        ('savings goals', SavingsGoal.objects.filter(category_id=category_id), 'category_id'),
+        ('transactions', Transaction.objects.filter(category_id=category_id), 'category_id'),
+        ('archived transactions', ArchivedTransaction.objects.filter(category_id=category_id), 'category_id'),
+        ('description suggestions', DescriptionSuggestion.objects.filter(category_id=category_id), 'category_id'),
+    ]
+
+
+def get_steps(job):
+    if job.target_type == 'user':
+        return _user_steps(job.target_id)
+    return _category_steps(job.target_id)
+
+
+def pending_deletion(target_type, target_ids):
+    """Ids among ``target_ids`` with an unfinished deletion job"""
+    return set(DeletionJob.objects.filter(
+        target_type=target_type,
+        target_id__in=target_ids,
+    ).exclude(status='completed').values_list('target_id', flat=True))
+
+
+def start_deletion(target, background=True):
+    """Queue the removal of a user or category and its data
+
+    The unfinished DeletionJob is what marks the target as being deleted
+    (see pending_deletion). A user is also deactivated, which refuses their
+    logins; a category keeps its own active flag and leaves the choice lists
+    through the catalog version. With ``background`` the job runs on a Celery
+    worker once this transaction commits.
+    """
+    if isinstance(target, User):
+        job = DeletionJob(user=target, target_type='user', target_id=target.pk, label=target.username)
+    else:
+        job = DeletionJob(user_id=target.user_id, target_type='category', target_id=target.pk, label=target.name)
+
+    with db_transaction.atomic(), db_transaction.atomic(using=target._state.db):
+        if isinstance(target, User):
+            target.is_active = False
+            target.save(update_fields=['is_active'])
+        job.save()
+        if not isinstance(target, User):
+            bump_catalog_version(target.user_id)
+
+    if background:
+        db_transaction.on_commit(lambda: process_job_task.delay(job.pk))
+    return job
+
+
+def _claim(job_id, include_stale=False):
+    """Atomically move a job to running, so only one worker processes it"""
+    claimable = Q(status__in=['pending', 'failed'])
+    if include_stale:
+        claimable |= Q(status='running', updated_at__lt=timezone.now() - STALE_JOB_AFTER)
+    return DeletionJob.objects.filter(claimable, pk=job_id).update(
+        status='running', error=None, updated_at=timezone.now()
+    ) == 1
+
+
+def _owner_id(job):
+    return job.target_id if job.target_type == 'user' else job.user_id
+
+
+def _delete_batch(job, queryset, nulled_field, batch_size):
+    """Handle the next ``batch_size`` rows of a step in primary key order
+
+    Returns the number of rows handled. Progress is saved in the same
+    database transaction, so a crashed job resumes exactly where it stopped.
+    When the rows are on another shard their transaction commits first; a
+    crash in between only repeats a batch that is already gone.
+    """
+    with db_transaction.atomic(), db_transaction.atomic(using=queryset.db):
+        ids = list(queryset.filter(pk__gt=job.cursor).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return 0
+
+        batch = queryset.model.objects.filter(pk__in=ids)
+        recorded = RECORDED_MODELS.get(queryset.model)
+        if nulled_field:
+            events = []
+            if recorded:
+                # Unchanged fields the events of the model carry, e.g. a transaction's description
+                context = [field for field in getattr(recorded, 'OUTBOX_CONTEXT_FIELDS', []) if field != nulled_field]
+                for row in batch.values('id', nulled_field, *context):
+                    pk = row.pop('id')
+                    events.append(change_event(_owner_id(job), recorded, pk, row, {**row, nulled_field: None}))
+            if queryset.model in (Transaction, ArchivedTransaction):
+                # Derived data keyed by category that the UPDATE bypasses
+                invalidate_reports(_owner_id(job), batch.dates('transaction_date', 'month'))
+                if queryset.model is Transaction:
+                    forget_stats(_owner_id(job), [job.target_id, 0])
+            batch.update(**{nulled_field: None})
+            append(events)
+        else:
+            batch._raw_delete(batch.db)
+            if recorded:
+                record(_owner_id(job), recorded, ids, action='delete')
+
+        job.cursor = ids[-1]
+        job.deleted_count += len(ids)
+        job.save(update_fields=['cursor', 'deleted_count', 'updated_at'])
+    return len(ids)
+
+
+def _delete_target(job):
+    """Remove the emptied user or category itself, with nothing left to cascade to"""
+    if job.target_type == 'user':
+        User.objects.filter(pk=job.target_id).delete()
+        drop_store(job.target_id)
+        return
+
+    category = Category.objects.filter(pk=job.target_id).first()
+    if category is not None:
+        category.delete()
+        # Derived data skipped by the raw batches
+        detect_anomalies([category.user_id])
+        bump_store_version(category.user_id)
+        bump_data_version(category.user_id)
+        bump_catalog_version(category.user_id)
+
+
+def run_deletion_job(job, batch_size=DELETION_BATCH_SIZE, progress=None):
+    """Remove a job's dependents in bounded batches, then the target itself
+
+    Each batch is its own short database transaction. ``progress`` is called
+    with the job after every batch. The job must already be claimed.
+    """
+    owner_id = _owner_id(job)
+    with user_shard(owner_id):
+        return _run_steps(job, shard_for(owner_id), batch_size, progress)
+
+
+def _run_steps(job, shard, batch_size, progress):
+    steps = get_steps(job)
+    names = [name for name, queryset, nulled_field in steps]
+
+    if job.total_count is None:
+        job.total_count = sum(queryset.count() for name, queryset, nulled_field in steps)
+        job.save(update_fields=['total_count', 'updated_at'])
+
+    start = names.index(job.step) if job.step in names else 0
+    for name, queryset, nulled_field in steps[start:]:
+        if job.step != name:
+            job.step, job.cursor = name, 0
+            job.save(update_fields=['step', 'cursor', 'updated_at'])
+        while _delete_batch(job, queryset, nulled_field, batch_size):
+            if progress:
+                progress(job)
+
+    with db_transaction.atomic(), db_transaction.atomic(using=shard):
+        _delete_target(job)
+        job.status = 'completed'
+        job.step = ''
+        job.finished_at = timezone.now()
+        job.save(update_fields=['status', 'step', 'finished_at', 'updated_at'])
+    if progress:
+        progress(job)
+    return job
+
+
+@timed('deletion_job')
+def process_job(job_id, include_stale=False, batch_size=DELETION_BATCH_SIZE, progress=None):
+    """Claim and run a job, recording the error if it fails. Returns the job, or None if not claimed"""
+    if not _claim(job_id, include_stale=include_stale):
+        return None
+
+    job = DeletionJob.objects.get(pk=job_id)
+    try:
+        return run_deletion_job(job, batch_size=batch_size, progress=progress)
+    except Exception as error:
+        logger.exception("Deletion job %s failed", job_id)
+        DeletionJob.objects.filter(pk=job_id).update(status='failed', error=str(error), updated_at=timezone.now())
+        raise
+
+
+@shared_task(ignore_result=True)
+def process_job_task(job_id):
+    """Celery entry point of process_job; a failed job is resumed by the resume_deletions command"""
+    process_job(job_id)
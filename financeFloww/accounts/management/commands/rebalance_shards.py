@@ -0,0 +1,77 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from financeFloww.sharding import (
+    SHARD_CACHE_TIMEOUT, move_users, plan_rebalance, shard_for, shards, user_loads, users_on,
+)
+
+
+class Command(BaseCommand):
+    help = "Move users between shards to even out their transactions, drain a shard or move given users"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', help='Move these user ids (with --to)')
+        parser.add_argument('--to', help='Shard the users given with --user move to')
+        parser.add_argument('--drain', help='Move every user off this shard, e.g. before removing it')
+        parser.add_argument('--tolerance', type=float, default=0.1,
+                            help='Stop once shards differ by at most this fraction of the average load')
+        parser.add_argument('--max-moves', type=int, default=None)
+        parser.add_argument('--batch-size', type=int, default=20, help='Users whose writes are paused together')
+        parser.add_argument('--settle', type=float, default=SHARD_CACHE_TIMEOUT,
+                            help='Seconds for every process to see a shard map change')
+        parser.add_argument('--dry-run', action='store_true', help='Only list the moves')
+
+    def plan(self, options):
+        configured = shards()
+        if options['user']:
+            if options['to'] not in configured:
+                raise CommandError(f"--to must be one of {', '.join(configured)}")
+            return [
+                (user_id, shard_for(user_id), options['to'])
+                for user_id in options['user']
+                if shard_for(user_id) != options['to']
+            ]
+
+        loads = user_loads()
+        if options['drain']:
+            if options['drain'] not in configured:
+                raise CommandError(f"--drain must be one of {', '.join(configured)}")
+            drained = loads.pop(options['drain'])
+            totals = {alias: sum(users.values()) for alias, users in loads.items()}
+            if not totals:
+                raise CommandError("There is no other shard to move the users to")
+            moves = []
+            # Largest first, each to the emptiest remaining shard
+            for user_id in sorted(users_on(options['drain']), key=lambda pk: -drained.get(pk, 0)):
+                target = min(totals, key=totals.get)
+                totals[target] += drained.get(user_id, 0)
+                moves.append((user_id, options['drain'], target))
+            return moves[:options['max_moves']]
+
+        return plan_rebalance(loads, tolerance=options['tolerance'], max_moves=options['max_moves'])
+
+    def handle(self, *args, **options):
+        moves = self.plan(options)
+        if not moves:
+            self.stdout.write(self.style.SUCCESS("Shards are balanced, nothing to move"))
+            return
+        if options['dry_run']:
+            for user_id, source, target in moves:
+                self.stdout.write(f"Would move user {user_id} from {source} to {target}")
+            return
+
+        def report(move):
+            self.stdout.write(f"Moved user {move[0]} from {move[1]} to {move[2]}")
+
+        moved, failed = [], []
+        for start in range(0, len(moves), options['batch_size']):
+            done, errors = move_users(
+                moves[start:start + options['batch_size']], settle=options['settle'], progress=report
+            )
+            moved += done
+            failed += errors
+
+        for (user_id, source, target), error in failed:
+            self.stdout.write(self.style.ERROR(f"User {user_id} stays on {source}: {error}"))
+        if failed:
+            raise CommandError(f"{len(failed)} of {len(moves)} moves failed")
+        self.stdout.write(self.style.SUCCESS(f"Moved {len(moved)} users"))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.deletion import DELETION_BATCH_SIZE, process_job
+from accounts.models import DeletionJob
+
+
+class Command(BaseCommand):
+    help = "Run queued deletion jobs and resume failed or abandoned ones where they stopped"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--job', type=int, action='append', help='Only run these job ids')
+        parser.add_argument('--batch-size', type=int, default=DELETION_BATCH_SIZE, help='Rows removed per transaction')
+
+    def handle(self, *args, **options):
+        jobs = DeletionJob.objects.exclude(status='completed').order_by('pk')
+        if options['job']:
+            jobs = jobs.filter(pk__in=options['job'])
+
+        def report(job):
+            self.stdout.write(
+                f"Job {job.pk} ({job.target_type} {job.label}): {job.step or job.status}, "
+                f"{job.deleted_count}/{job.total_count or 0} rows, {job.get_percentage_complete()}%"
+            )
+
+        completed = 0
+        for job_id in jobs.values_list('pk', flat=True):
+            try:
+                job = process_job(job_id, include_stale=True, batch_size=options['batch_size'], progress=report)
+            except Exception as error:
+                raise CommandError(f"Job {job_id} failed: {error}")
+            if job is None:
+                self.stdout.write(f"Job {job_id} is being run by another worker, skipped")
+            else:
+                completed += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Completed {completed} deletion jobs"))
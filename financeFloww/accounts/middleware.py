@@ -0,0 +1,16 @@
+from django.utils.functional import SimpleLazyObject
+
+from .cache import get_profile
+
+
+class ProfileMiddleware:
+    """Expose the authenticated user's profile as a lazy request.profile"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.profile = SimpleLazyObject(
+            lambda: get_profile(request.user) if request.user.is_authenticated else None
+        )
+        return self.get_response(request)
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.13 on 2026-10-19 08:12
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('accounts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeletionJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('target_type', models.CharField(choices=[('user', 'User'), ('category', 'Category')], max_length=20)),
+                ('target_id', models.BigIntegerField()),
+                ('label', models.CharField(help_text='Name of the deleted user or category', max_length=200)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('completed', 'Completed'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('step', models.CharField(blank=True, help_text='Dependent table being cleared', max_length=50)),
+                ('cursor', models.BigIntegerField(default=0, help_text='Highest primary key handled in the current step')),
+                ('deleted_count', models.IntegerField(default=0)),
+                ('total_count', models.IntegerField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='deletion_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Deletion Job',
+                'verbose_name_plural': 'Deletion Jobs',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['status', 'updated_at'], name='accounts_de_status_6f16e6_idx'), models.Index(fields=['target_type', 'target_id'], name='accounts_de_target__5c2d59_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.13 on 2026-10-19 08:51
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('accounts', '0002_deletionjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserShard',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='shard', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('shard', models.CharField(db_index=True, help_text='Alias of the database in DATABASES', max_length=64)),
+                ('moving', models.BooleanField(default=False, help_text='Writes are refused while the data moves to another shard')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'User Shard',
+                'verbose_name_plural': 'User Shards',
+            },
+        ),
+    ]
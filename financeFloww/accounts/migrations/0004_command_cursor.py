@@ -0,0 +1,26 @@
+# Generated by Django 4.2.13 on 2026-10-19 09:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_usershard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommandCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('position', models.BigIntegerField(default=0, help_text='Id of the last handled row')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Command Cursor',
+                'verbose_name_plural': 'Command Cursors',
+            },
+        ),
+    ]
@@ -40,4 +40,91 @@ class UserProfile(models.Model):
         verbose_name_plural = 'User Profiles'
 
     def __str__(self):
-        return f"{self.user.username}'s Profile"
\ No newline at end of file
+        return f"{self.user.username}'s Profile"
+
+class DeletionJob(models.Model):
+    """Background removal of a user or category and everything filed under it"""
+
+    TARGET_CHOICES = [
+        ('user', 'User'),
+        ('category', 'Category'),
+    ]
+
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    ]
+
+    # Kept after the account is gone, as a record of the deletion
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='deletion_jobs')
+
+    target_type = models.CharField(max_length=20, choices=TARGET_CHOICES)
+    target_id = models.BigIntegerField()
+    label = models.CharField(max_length=200, help_text="Name of the deleted user or category")
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    step = models.CharField(max_length=50, blank=True, help_text="Dependent table being cleared")
+    cursor = models.BigIntegerField(default=0, help_text="Highest primary key handled in the current step")
+    deleted_count = models.IntegerField(default=0)
+    total_count = models.IntegerField(blank=True, null=True)
+    error = models.TextField(blank=True, null=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        verbose_name = 'Deletion Job'
+        verbose_name_plural = 'Deletion Jobs'
+        indexes = [
+            models.Index(fields=['status', 'updated_at']),
+            models.Index(fields=['target_type', 'target_id']),
+        ]
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"Delete {self.target_type} {self.label} ({self.status})"
+
+    def get_percentage_complete(self):
+        """Share of the dependent rows handled so far"""
+        if self.status == 'completed':
+            return 100
+        if not self.total_count:
+            return 0
+        return min(99, round(self.deleted_count * 100 / self.total_count))
+
+
+class UserShard(models.Model):
+    """Database holding a user's financial data (see financeFloww.sharding)
+
+    Users without an entry predate sharding and live on the default database.
+    """
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='shard')
+    shard = models.CharField(max_length=64, db_index=True, help_text="Alias of the database in DATABASES")
+    moving = models.BooleanField(default=False, help_text="Writes are refused while the data moves to another shard")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'User Shard'
+        verbose_name_plural = 'User Shards'
+
+    def __str__(self):
+        return f"{self.user_id} on {self.shard}"
+
+
+class CommandCursor(models.Model):
+    """Where a resumable management command stopped, shared by every host that runs it"""
+
+    name = models.CharField(max_length=100, unique=True)
+    position = models.BigIntegerField(default=0, help_text="Id of the last handled row")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Command Cursor'
+        verbose_name_plural = 'Command Cursors'
+
+    def __str__(self):
+        return f"{self.name} at {self.position}"
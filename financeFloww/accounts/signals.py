@@ -0,0 +1,61 @@
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_delete
+from django.dispatch import receiver
+
+from financeFloww.sharding import forget_user, mirror_user, place_user, reserve_id_range, shard_for, shards, use_shard
+from .cache import invalidate_cached_user
+from .models import UserProfile
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_on_change(sender, instance, **kwargs):
+    """Drop the cached user after a save, including last_login and password updates"""
+    invalidate_cached_user(instance.pk)
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def invalidate_user_on_profile_change(sender, instance, **kwargs):
+    """The cached user carries their profile, so profile changes drop it too"""
+    invalidate_cached_user(instance.user_id)
+
+
+@receiver(post_save, sender=User)
+def place_user_on_shard(sender, instance, created, using, raw=False, update_fields=None, **kwargs):
+    """Give new users a shard and keep the copy of the user row there current
+
+    The copy is written right away, not on commit, since the user's first
+    rows on the shard may be written before the directory commits.
+    """
+    if raw or using != DEFAULT_DB_ALIAS or len(shards()) == 1:
+        return
+    if update_fields is not None and set(update_fields) == {'last_login'}:
+        return
+    mirror_user(instance, place_user(instance.pk) if created else None)
+
+
+@receiver(pre_delete, sender=User)
+def remember_user_shard(sender, instance, using, **kwargs):
+    if using == DEFAULT_DB_ALIAS and len(shards()) > 1:
+        instance._shard = shard_for(instance.pk)
+
+
+@receiver(post_delete, sender=User)
+def delete_user_copy(sender, instance, using, **kwargs):
+    """Remove the copy of a deleted user from their shard, with anything left there"""
+    shard = getattr(instance, '_shard', None)
+    if using != DEFAULT_DB_ALIAS or shard is None:
+        return
+    if shard != DEFAULT_DB_ALIAS:
+        with use_shard(shard):
+            User.objects.using(shard).filter(pk=instance.pk).delete()
+    forget_user(instance.pk)
+
+
+@receiver(post_migrate)
+def reserve_shard_id_range(sender, using, **kwargs):
+    """Start the shard's id sequences in its own range; post_migrate is sent per app, so once for accounts"""
+    if sender.label == 'accounts':
+        reserve_id_range(using)
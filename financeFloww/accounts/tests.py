@@ -1,3 +1,52 @@
-from django.test import TestCase
+from datetime import date
+from decimal import Decimal
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+
+from analytics.models import StaleMonth
+from transactions.anomalies import detect_anomalies
+from transactions.models import Category, CategoryStats, Transaction
+from .deletion import process_job, start_deletion
+
+LOCAL_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class CategoryDeletionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('owner', 'owner@example.com', 'secret')
+        self.food = Category.objects.create(user=self.user, name='Food', category_type='expense')
+        for day in (date(2024, 3, 4), date(2024, 5, 6), date(2024, 5, 20)):
+            Transaction.objects.create(
+                user=self.user, category=self.food, transaction_type='expense', amount=Decimal('9.00'),
+                description='Groceries', transaction_date=day,
+            )
+        Transaction.objects.create(
+            user=self.user, transaction_type='expense', amount=Decimal('4.00'),
+            description='Snack', transaction_date=date(2024, 5, 1),
+        )
+        detect_anomalies([self.user.pk])
+
+    def stats(self):
+        return dict(CategoryStats.objects.filter(user=self.user).values_list('category_key', 'count'))
+
+    def test_uncategorized_transactions_reach_derived_data(self):
+        job = start_deletion(self.food, background=False)
+        stale_stats = []
+
+        def progress(job):
+            # Stats of the category must not outlive a batch that uncategorized some of its rows
+            if job.step == 'transactions':
+                stale_stats.append(CategoryStats.objects.filter(category_key=self.food.pk).exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            process_job(job.pk, batch_size=2, progress=progress)
+
+        self.assertFalse(Transaction.objects.filter(category__isnull=False).exists())
+        self.assertEqual(
+            set(StaleMonth.objects.filter(user=self.user).values_list('month', flat=True)),
+            {date(2024, 3, 1), date(2024, 5, 1)},
+        )
+        self.assertEqual(stale_stats, [False, False])
+        self.assertEqual(self.stats(), {0: 4})
@@ -9,4 +9,6 @@ urlpatterns = [
     path('profile/', views.profile, name='profile'),
     path('profile/edit/', views.edit_profile, name='edit_profile'),
     path('settings/', views.settings, name='settings'),
+    path('settings/delete-account/', views.delete_account, name='delete_account'),
+    path('deletions/<int:pk>/', views.deletion_status, name='deletion_status'),
 ]
\ No newline at end of file
@@ -2,9 +2,12 @@ from django.shortcuts import render, redirect
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404
 from django.views.decorators.http import require_http_methods
+from .deletion import start_deletion
 from .forms import CustomUserCreationForm, UserProfileForm, UserUpdateForm
-from .models import UserProfile
+from .models import DeletionJob, UserProfile
 from django.db import transaction as db_transaction
 from django.contrib.auth.models import User
 
@@ -76,14 +79,8 @@ def logout_view(request):
 @login_required
 def profile(request):
     """User profile view"""
-    try:
-        user_profile = request.user.profile
-    
-    except:
-        # Create profile if it doesn't exist
-        from .models import UserProfile
-        user_profile = UserProfile.objects.create(user=request.user)
-        
+    user_profile = request.profile
+
     context = {
         'user_profile': user_profile,
         'user': request.user,
@@ -95,7 +92,7 @@ def profile(request):
 @require_http_methods(["GET", "POST"])
 def edit_profile(request):
     """Edit user profile"""
-    user_profile = request.user.profile
+    user_profile = request.profile
 
     if request.method == 'POST':
         profile_form = UserProfileForm(request.POST, request.FILES, instance=user_profile)
@@ -112,6 +109,7 @@ def edit_profile(request):
         user_form = UserUpdateForm(instance=request.user)
 
     context = {
+        'user_profile': user_profile,
         'profile_form': profile_form,
         'user_form': user_form,
     }
@@ -121,10 +119,42 @@ def edit_profile(request):
 @login_required
 def settings(request):
     """User settings"""
-    user_profile = request.user.profile
+    user_profile = request.profile
     
     context = {
         'user_profile': user_profile,
         'user': request.user,
     }
-    return render(request, 'accounts/settings.html', context)
\ No newline at end of file
+    return render(request, 'accounts/settings.html', context)
+
+
+@login_required
+@require_http_methods(["POST"])
+def delete_account(request):
+    """Deactivate the account now and remove its data in the background"""
+    if not request.user.check_password(request.POST.get('password', '')):
+        messages.error(request, 'Incorrect password, your account was not deleted.')
+        return redirect('settings')
+
+    start_deletion(request.user)
+    logout(request)
+    messages.success(request, 'Your account has been deactivated and its data is being deleted.')
+    return redirect('home')
+
+
+@login_required
+@require_http_methods(["GET"])
+def deletion_status(request, pk):
+    """Progress of one of the user's deletion jobs, for polling"""
+    job = get_object_or_404(DeletionJob, pk=pk, user=request.user)
+    return JsonResponse({
+        'id': job.pk,
+        'target_type': job.target_type,
+        'label': job.label,
+        'status': job.status,
+        'step': job.step,
+        'deleted': job.deleted_count,
+        'total': job.total_count,
+        'percent': job.get_percentage_complete(),
+        'error': job.error,
+    })
@@ -0,0 +1,204 @@
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import date, timedelta
+from decimal import Decimal
+
+from dateutil.relativedelta import relativedelta
+from django.db.models import Case, DecimalField, F, Max, Min, Sum, When
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from transactions.archive import transaction_sources
+from .breakdown import AggregateWindow, WindowSum, month_range
+from .models import BalanceCheckpoint
+
+# Longest daily series served at once
+MAX_SERIES_DAYS = 731
+
+SIGNED_AMOUNT = Case(
+    When(transaction_type='expense', then=-F('amount')),
+    default=F('amount'),
+    output_field=DecimalField(max_digits=14, decimal_places=2),
+)
+
+
+def parse_day(value, default=None):
+    """Parse a YYYY-MM-DD query parameter"""
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _monthly_nets(user_id, start, end):
+    """{(payment method id, month): net} of completed transactions with start <= date < end"""
+    nets = defaultdict(Decimal)
+    for model in transaction_sources(user_id, start):
+        rows = model.objects.filter(user_id=user_id, transaction_date__lt=end, status='completed')
+        if start is not None:
+            rows = rows.filter(transaction_date__gte=start)
+        for row in rows.annotate(month=TruncMonth('transaction_date')).values(
+            'payment_method_id', 'month'
+        ).annotate(net=Sum(SIGNED_AMOUNT)).order_by():
+            nets[row['payment_method_id'], row['month']] += row['net']
+    return nets
+
+
+def ensure_checkpoints(user_id):
+    """Extend the user's checkpoints through the last closed month; returns that month
+
+    The first call builds the whole history from one grouped query per
+    table; afterwards only months closed since the last call are read.
+    """
+    last_closed = timezone.now().date().replace(day=1) - relativedelta(months=1)
+    checkpoints = BalanceCheckpoint.objects.filter(user_id=user_id)
+    last = checkpoints.aggregate(last=Max('month'))['last']
+    if last is not None and last >= last_closed:
+        return last
+
+    start = last + relativedelta(months=1) if last else None
+    nets = _monthly_nets(user_id, start, last_closed + relativedelta(months=1))
+    balances = dict(checkpoints.filter(month=last).values_list('payment_method_id', 'balance')) if last else {}
+    first_months = {}
+    for payment_method_id, month in nets:
+        first_months[payment_method_id] = min(month, first_months.get(payment_method_id, month))
+
+    new = []
+    for month in month_range(start or min(first_months.values(), default=last_closed), last_closed):
+        for payment_method_id in sorted(set(balances) | set(first_months), key=lambda pk: pk or 0):
+            if payment_method_id not in balances and month < first_months[payment_method_id]:
+                continue
+            balances[payment_method_id] = balances.get(payment_method_id, Decimal('0')) + nets.get(
+                (payment_method_id, month), Decimal('0')
+            )
+            new.append(BalanceCheckpoint(
+                user_id=user_id,
+                payment_method_id=payment_method_id,
+                month=month,
+                balance=balances[payment_method_id],
+            ))
+    # A concurrent request may have extended them already
+    BalanceCheckpoint.objects.bulk_create(new, batch_size=1000, ignore_conflicts=True)
+    return last_closed
+
+
+def _signed_changes(previous, current):
+    """{(payment method id, month): delta} of a transaction going from ``previous`` to ``current``"""
+    changes = defaultdict(Decimal)
+    for state, sign in ((previous, -1), (current, 1)):
+        if state and state['status'] == 'completed' and state['amount'] is not None:
+            amount = -state['amount'] if state['transaction_type'] == 'expense' else state['amount']
+            changes[state['payment_method_id'], state['transaction_date'].replace(day=1)] += sign * Decimal(str(amount))
+    return {key: delta for key, delta in changes.items() if delta}
+
+
+def apply_balance_changes(user_id, pairs):
+    """Shift the checkpoints after writes, given (previous, current) tracked states
+
+    Writes to the open month do not touch checkpoints; a write to a closed
+    month adds its delta to that month's and every later checkpoint of its
+    payment method in one UPDATE, starting the method's series if needed.
+    """
+    changes = defaultdict(Decimal)
+    for previous, current in pairs:
+        for key, delta in _signed_changes(previous, current).items():
+            changes[key] += delta
+    changes = {key: delta for key, delta in changes.items() if delta}
+    if not changes:
+        return
+
+    checkpoints = BalanceCheckpoint.objects.filter(user_id=user_id)
+    last = checkpoints.aggregate(last=Max('month'))['last']
+    if last is None:
+        return
+
+    for (payment_method_id, month), delta in sorted(changes.items(), key=lambda item: item[0][1]):
+        if month > last:
+            continue
+        series = checkpoints.filter(payment_method_id=payment_method_id)
+        first = series.aggregate(first=Min('month'))['first']
+        if first is None or month < first:
+            # The method had no earlier history, so its balance before was zero
+            end = first - relativedelta(months=1) if first else last
+            BalanceCheckpoint.objects.bulk_create([
+                BalanceCheckpoint(user_id=user_id, payment_method_id=payment_method_id, month=value)
+                for value in month_range(month, end)
+            ], ignore_conflicts=True)
+        series.filter(month__gte=month).update(balance=F('balance') + delta)
+
+
+def _base_balances(user_id, month):
+    """Balance per payment method at the end of ``month``, a checkpointed month"""
+    balances = {}
+    for payment_method_id, balance in BalanceCheckpoint.objects.filter(
+        user_id=user_id, month__lte=month
+    ).order_by('payment_method_id', 'month').values_list('payment_method_id', 'balance'):
+        balances[payment_method_id] = balance
+    return balances
+
+
+def _running_nets(user_id, start, end):
+    """{payment method id: (days, running nets)} of completed transactions with start <= date <= end
+
+    Each table gets one grouped query with a running sum window per payment
+    method; the running sums of the hot table and the archive add up.
+    """
+    runs = defaultdict(lambda: ([], []))
+    for model in transaction_sources(user_id, start):
+        rows = model.objects.filter(
+            user_id=user_id,
+            transaction_date__gte=start,
+            transaction_date__lte=end,
+            status='completed'
+        ).values('payment_method_id', 'transaction_date').annotate(
+            net=Sum(SIGNED_AMOUNT),
+        ).annotate(
+            running=AggregateWindow(
+                WindowSum('net'),
+                partition_by=[F('payment_method_id')],
+                order_by=F('transaction_date').asc(),
+            ),
+        ).order_by('payment_method_id', 'transaction_date')
+        for row in rows:
+            runs[model, row['payment_method_id']][0].append(row['transaction_date'])
+            runs[model, row['payment_method_id']][1].append(row['running'])
+
+    by_method = defaultdict(list)
+    for (model, payment_method_id), run in runs.items():
+        by_method[payment_method_id].append(run)
+    return by_method
+
+
+def balance_series(user_id, start, end):
+    """Daily closing balances per payment method from ``start`` to ``end``, inclusive
+
+    Each balance is the checkpoint of the month before ``start`` (or the
+    latest one) plus a running sum over the few days since. Returns
+    ``(days, {payment method id: [balance per day]})``.
+    """
+    last = ensure_checkpoints(user_id)
+    base_month = min(start.replace(day=1) - relativedelta(months=1), last)
+    balances = _base_balances(user_id, base_month)
+    window_start = base_month + relativedelta(months=1)
+    runs = _running_nets(user_id, window_start, end)
+
+    days = [start + timedelta(days=offset) for offset in range((end - start).days + 1)]
+    series = {}
+    for payment_method_id in sorted(set(balances) | set(runs), key=lambda pk: pk or 0):
+        base = balances.get(payment_method_id, Decimal('0'))
+        values = []
+        for day in days:
+            value = base
+            for run_days, running in runs.get(payment_method_id, []):
+                position = bisect_right(run_days, day)
+                if position:
+                    value += running[position - 1]
+            values.append(value)
+        series[payment_method_id] = values
+    return days, series
+
+
+def balance_at(user_id, day):
+    """Closing balance on ``day`` per payment method"""
+    days, series = balance_series(user_id, day, day)
+    return {payment_method_id: values[0] for payment_method_id, values in series.items()}
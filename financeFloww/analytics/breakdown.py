@@ -0,0 +1,210 @@
+from collections import defaultdict
+from datetime import date
+
+from dateutil.relativedelta import relativedelta
+from django.core.cache import cache
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, FloatField, Func, Sum, Value, Window
+from django.db.models.functions import Coalesce, Lag, TruncMonth
+from django.utils import timezone
+
+from transactions.archive import transaction_sources
+from transactions.cache import get_closed_months_version
+
+MATRIX_CACHE_KEY = 'spending-matrix:{user_id}:{version}:{start}:{end}'
+MATRIX_CACHE_TIMEOUT = 60 * 60 * 24
+# Longest range of months compared at once
+MAX_MATRIX_MONTHS = 36
+# Months outside these bounds are rejected as query parameters
+MIN_MONTH = date(1900, 1, 1)
+MAX_MONTH = date(2100, 12, 1)
+
+
+class AggregateWindow(Window):
+    """Window over an aggregate of the grouped rows
+
+    Django adds plain window annotations to GROUP BY once a later annotation
+    contains an aggregate; flagging the window as aggregate keeps only its
+    partition columns there.
+    """
+    contains_aggregate = True
+
+
+class WindowSum(Func):
+    """SUM() usable over an aggregate inside a window, e.g. SUM(SUM(amount)) OVER (...)"""
+    function = 'SUM'
+    window_compatible = True
+
+
+def month_range(start, end):
+    """Return the first day of every month from start to end, inclusive"""
+    months = []
+    current = start.replace(day=1)
+    while current <= end:
+        months.append(current)
+        current += relativedelta(months=1)
+    return months
+
+
+def _category_month_rows(model, user, start, end):
+    """Expense totals per category and month of one table in one grouped query
+
+    Month-over-month deltas and each category's share of the month are
+    computed by the database with window functions.
+    """
+    decimal_field = DecimalField(max_digits=14, decimal_places=2)
+    by_category = {'partition_by': [F('category_id')], 'order_by': F('month').asc()}
+    by_month = {'partition_by': [F('month')]}
+
+    rows = model.objects.filter(
+        user=user,
+        transaction_type='expense',
+        transaction_date__gte=start,
+        transaction_date__lt=end + relativedelta(months=1),
+        status='completed'
+    ).annotate(
+        month=TruncMonth('transaction_date')
+    ).values('month', 'category_id', 'category__name').annotate(
+        total=Sum('amount'),
+        count=Count('id'),
+    ).annotate(
+        previous_month=AggregateWindow(Lag('month'), **by_category),
+        delta=F('total') - Coalesce(
+            AggregateWindow(Lag('total'), **by_category), Value(0), output_field=decimal_field
+        ),
+        share=ExpressionWrapper(
+            F('total') * Value(100.0) / AggregateWindow(WindowSum('total'), **by_month),
+            output_field=FloatField(),
+        ),
+    ).order_by('month', '-total')
+
+    return [{**row, 'share': round(float(row['share']), 2)} for row in rows]
+
+
+def category_month_rows(user, start, end):
+    """Expense totals per category and month, including archived years the range reaches
+
+    Years are archived whole, so the archive and the hot table normally hold
+    different months and their rows are simply concatenated. For months found
+    in both (rows added to an archived year later) cells are summed and shares
+    recomputed; build_matrix recomputes the deltas of summed cells.
+    """
+    sources = transaction_sources(user.pk, start)
+    if len(sources) == 1:
+        return _category_month_rows(sources[0], user, start, end)
+
+    cells, month_sources = {}, defaultdict(set)
+    for model in sources:
+        for row in _category_month_rows(model, user, start, end):
+            month_sources[row['month']].add(model)
+            key = (row['month'], row['category_id'])
+            if key in cells:
+                cells[key]['total'] += row['total']
+                cells[key]['count'] += row['count']
+                cells[key]['previous_month'] = None
+            else:
+                cells[key] = row
+
+    merged_months = {month for month, models in month_sources.items() if len(models) > 1}
+    if merged_months:
+        month_totals = defaultdict(int)
+        for cell in cells.values():
+            month_totals[cell['month']] += cell['total']
+        for cell in cells.values():
+            if cell['month'] in merged_months:
+                cell['share'] = round(float(cell['total'] * 100 / month_totals[cell['month']]), 2)
+
+    return sorted(cells.values(), key=lambda row: (row['month'], -row['total']))
+
+
+def _cached_closed_rows(user, start, end):
+    """Rows for months that are already closed, served from cache when possible
+
+    Keyed on the closed-months version, so writes to the current month
+    leave the cached rows in place.
+    """
+    key = MATRIX_CACHE_KEY.format(
+        user_id=user.pk,
+        version=get_closed_months_version(user.pk),
+        start=start.isoformat(),
+        end=end.isoformat(),
+    )
+    return key, cache.get(key)
+
+
+def spending_matrix(user, start, end):
+    """Category x month expense matrix for an arbitrary range of months
+
+    Past months rarely receive new activity, so their rows are cached until
+    a write reaches one of them. A range containing the current month costs
+    one query on a cache miss and a single-month query on a hit. Ranges
+    longer than MAX_MATRIX_MONTHS are cut to their last months.
+    """
+    end = end.replace(day=1)
+    start = max(start.replace(day=1), end - relativedelta(months=MAX_MATRIX_MONTHS - 1))
+    current_month = timezone.now().date().replace(day=1)
+    closed_end = min(end, current_month - relativedelta(months=1))
+
+    rows = None
+    if start <= closed_end:
+        key, rows = _cached_closed_rows(user, start, closed_end)
+        if rows is None:
+            rows = category_month_rows(user, start, end)
+            cache.set(key, [row for row in rows if row['month'] <= closed_end], MATRIX_CACHE_TIMEOUT)
+        elif end > closed_end:
+            rows = rows + category_month_rows(user, closed_end + relativedelta(months=1), end)
+    else:
+        rows = category_month_rows(user, start, end)
+
+    return build_matrix(rows, month_range(start, end))
+
+
+def build_matrix(rows, months):
+    """Pivot grouped rows into one row per category with a cell for every month"""
+    index = {month: position for position, month in enumerate(months)}
+    month_totals = [0] * len(months)
+    categories = {}
+
+    for row in rows:
+        position = index[row['month']]
+        category = categories.setdefault(row['category_id'], {
+            'category_id': row['category_id'],
+            'name': row['category__name'] or 'Uncategorized',
+            'cells': [None] * len(months),
+            'total': 0,
+        })
+        category['cells'][position] = row
+        category['total'] += row['total']
+        month_totals[position] += row['total']
+
+    for category in categories.values():
+        previous = None
+        for position, month in enumerate(months):
+            cell = category['cells'][position]
+            if cell is None:
+                cell = {'month': month, 'total': 0, 'count': 0, 'share': 0, 'previous_month': None}
+                cell['delta'] = -previous['total'] if previous and position else 0
+                category['cells'][position] = cell
+            elif position == 0:
+                # The month before the range was not queried
+                cell['delta'] = None
+            elif cell['previous_month'] != months[position - 1]:
+                # The database compared against an older month or a separately cached query
+                cell['delta'] = cell['total'] - (previous['total'] if previous else 0)
+            previous = cell
+
+    return {
+        'months': months,
+        'rows': sorted(categories.values(), key=lambda category: category['total'], reverse=True),
+        'month_totals': month_totals,
+        'grand_total': sum(month_totals),
+    }
+
+
+def parse_month(value, default=None):
+    """Parse a YYYY-MM query parameter into the first day of that month, between MIN_MONTH and MAX_MONTH"""
+    try:
+        year, month = (int(part) for part in value.split('-'))
+        parsed = date(year, month, 1)
+    except (AttributeError, TypeError, ValueError):
+        return default
+    return parsed if MIN_MONTH <= parsed <= MAX_MONTH else default
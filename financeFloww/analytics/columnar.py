@@ -0,0 +1,359 @@
+import fcntl
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from datetime import date
+from decimal import Decimal
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+
+from financeFloww.metrics import timed
+from financeFloww.sharding import user_shard
+from transactions.choices import get_user_choices
+from transactions.models import ArchivedTransaction, Category, Transaction
+from .models import StoreVersion
+
+# Column name -> dtype of the per-user store. Dates are ordinals, amounts
+# cents, category 0 means uncategorised.
+COLUMNS = {
+    'id': np.int64,
+    'day': np.int32,
+    'cents': np.int64,
+    'category': np.int64,
+    'kind': np.int8,
+    'status': np.int8,
+}
+KINDS = {'expense': 0, 'income': 1}
+STATUSES = {'completed': 0, 'pending': 1, 'cancelled': 2}
+# Status of a delta row that deletes the row with its id
+TOMBSTONE = -1
+
+DELTA_DTYPE = np.dtype([(name, dtype) for name, dtype in COLUMNS.items()])
+# Delta rows folded into a new base segment once exceeded
+COMPACT_ROWS = 2000
+# A stale store is rebuilt by one queued task at a time per user
+BUILD_QUEUED_KEY = 'analytics-store-build:{user_id}'
+BUILD_QUEUED_TIMEOUT = 60 * 10
+
+
+def get_store_version(user_id):
+    """Number of writes to the user's transactions so far"""
+    return StoreVersion.objects.filter(user_id=user_id).values_list('version', flat=True).first() or 0
+
+
+def bump_store_version(user_id):
+    """Count a write to the user's transactions, in its database transaction; returns the new version
+
+    The row stays locked until the write commits, so versions follow the
+    order of the user's commits.
+    """
+    versions = StoreVersion.objects.filter(user_id=user_id)
+    if not versions.update(version=F('version') + 1):
+        StoreVersion.objects.get_or_create(user_id=user_id)
+        versions.update(version=F('version') + 1)
+    return versions.values_list('version', flat=True).get()
+
+
+def store_root():
+    return Path(getattr(settings, 'ANALYTICS_STORE_DIR', settings.BASE_DIR / 'var' / 'analytics'))
+
+
+def _user_dir(user_id):
+    return store_root() / str(user_id)
+
+
+@contextmanager
+def _locked(user_id):
+    """Serialize builds and patches of one user's store across worker processes"""
+    directory = _user_dir(user_id)
+    directory.mkdir(parents=True, exist_ok=True)
+    with open(directory / '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield directory
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _read_meta(directory):
+    try:
+        with open(directory / 'meta.json') as meta:
+            return json.load(meta)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _write_meta(directory, meta):
+    temporary = directory / 'meta.json.tmp'
+    with open(temporary, 'w') as handle:
+        json.dump(meta, handle)
+    os.replace(temporary, directory / 'meta.json')
+
+
+def _save_array(path, array):
+    temporary = path.with_name(path.name + '.tmp')
+    with open(temporary, 'wb') as handle:
+        np.save(handle, array)
+    os.replace(temporary, path)
+
+
+@lru_cache(maxsize=512)
+def _open_base(path):
+    """Memory-map a base segment; segments are immutable, so mappings are shared and cached"""
+    return {name: np.load(Path(path) / f'{name}.npy', mmap_mode='r') for name in COLUMNS}
+
+
+def _load_delta(directory, meta):
+    if not meta.get('delta_rows'):
+        return np.empty(0, dtype=DELTA_DTYPE)
+    return np.load(directory / f"delta-{meta['generation']}.npy")
+
+
+def _rows_to_delta(rows):
+    """Tracked states (dicts with 'id') to delta records; None amounts mark deletions"""
+    delta = np.empty(len(rows), dtype=DELTA_DTYPE)
+    for position, row in enumerate(rows):
+        if row.get('amount') is None:
+            delta[position] = (row['id'], 0, 0, 0, 0, TOMBSTONE)
+            continue
+        delta[position] = (
+            row['id'],
+            row['transaction_date'].toordinal(),
+            int(Decimal(str(row['amount'])) * 100),
+            row['category_id'] or 0,
+            KINDS[row['transaction_type']],
+            STATUSES.get(row['status'], 0),
+        )
+    return delta
+
+
+def _merge(base, delta):
+    """Column arrays of the base segment with the delta's upserts and deletions applied"""
+    if not len(delta):
+        return base
+    # Keep only the latest delta record per id
+    _, last = np.unique(delta['id'][::-1], return_index=True)
+    delta = delta[len(delta) - 1 - last]
+    keep = ~np.isin(base['id'], delta['id'])
+    live = delta[delta['status'] != TOMBSTONE]
+    return {name: np.concatenate((base[name][keep], live[name])) for name in COLUMNS}
+
+
+def _write_base(directory, columns, version):
+    """Write a new immutable base segment and point meta.json at it"""
+    previous = _read_meta(directory)
+    # Unique across rebuilds, so cached mappings of a dropped store are never reused
+    generation = time.time_ns()
+    segment = directory / f'base-{generation}'
+    segment.mkdir()
+
+    order = np.argsort(columns['day'], kind='stable')
+    for name, dtype in COLUMNS.items():
+        _save_array(segment / f'{name}.npy', np.ascontiguousarray(np.asarray(columns[name], dtype=dtype)[order]))
+
+    _write_meta(directory, {
+        'generation': generation,
+        'version': version,
+        'delta_rows': 0,
+        'rows': int(len(order)),
+    })
+    # Processes still reading the old segment keep their mappings after unlink
+    if previous:
+        shutil.rmtree(directory / f"base-{previous['generation']}", ignore_errors=True)
+        (directory / f"delta-{previous['generation']}.npy").unlink(missing_ok=True)
+
+
+def load_columns_from_db(user_id):
+    """Every transaction of the user, archived ones included, as column arrays"""
+    parts = {name: [] for name in COLUMNS}
+    for model in (Transaction, ArchivedTransaction):
+        rows = model.objects.filter(user_id=user_id).order_by().values_list(
+            'id', 'transaction_date', 'amount', 'category_id', 'transaction_type', 'status'
+        )
+        for pk, transaction_date, amount, category_id, transaction_type, status in rows.iterator(chunk_size=5000):
+            parts['id'].append(pk)
+            parts['day'].append(transaction_date.toordinal())
+            parts['cents'].append(int(amount * 100))
+            parts['category'].append(category_id or 0)
+            parts['kind'].append(KINDS[transaction_type])
+            parts['status'].append(STATUSES.get(status, 0))
+    return {name: np.array(values, dtype=COLUMNS[name]) for name, values in parts.items()}
+
+
+@timed('build_analytics_store')
+def build_store(user_id):
+    """Rebuild a user's store from the database"""
+    # Read the version first: a write landing during the load then leaves the store stale, not wrong
+    version = get_store_version(user_id)
+    columns = load_columns_from_db(user_id)
+    with _locked(user_id) as directory:
+        _write_base(directory, columns, version)
+    return columns
+
+
+@shared_task(ignore_result=True)
+def build_store_task(user_id):
+    """Rebuild a stale store on a worker, off the request that found it stale"""
+    try:
+        with user_shard(user_id):
+            build_store(user_id)
+    finally:
+        cache.delete(BUILD_QUEUED_KEY.format(user_id=user_id))
+
+
+def get_columns(user_id):
+    """The user's transactions as column arrays, from the store when it is current
+
+    When nothing was written since the last compaction these are read-only
+    memory maps of the base segment, shared by every worker process. A
+    missing or stale store is rebuilt by a queued task; meanwhile the
+    columns are read from the database.
+    """
+    directory = _user_dir(user_id)
+    meta = _read_meta(directory)
+    if meta is None or meta['version'] != get_store_version(user_id):
+        if cache.add(BUILD_QUEUED_KEY.format(user_id=user_id), True, BUILD_QUEUED_TIMEOUT):
+            build_store_task.delay(user_id)
+        return load_columns_from_db(user_id)
+
+    try:
+        base = _open_base(str(directory / f"base-{meta['generation']}"))
+        delta = _load_delta(directory, meta)
+    except FileNotFoundError:
+        # Compacted by another process since meta.json was read
+        return get_columns(user_id)
+    return _merge(base, delta)
+
+
+def apply_changes(user_id, rows, version):
+    """Patch the store with changed rows once their write has committed
+
+    ``rows`` are tracked states with 'id'; a state without an amount deletes
+    the row. ``version`` is what bump_store_version returned for the write;
+    the patch only applies when the store is at the version just before it,
+    otherwise the store is left stale and rebuilt.
+    """
+    directory = _user_dir(user_id)
+    if _read_meta(directory) is None:
+        return False
+
+    with _locked(user_id) as directory:
+        meta = _read_meta(directory)
+        if meta is None or meta['version'] != version - 1:
+            return False
+
+        delta = np.concatenate((_load_delta(directory, meta), _rows_to_delta(rows)))
+        if len(delta) > COMPACT_ROWS:
+            base = _open_base(str(directory / f"base-{meta['generation']}"))
+            _write_base(directory, _merge(base, delta), version)
+            return True
+
+        _save_array(directory / f"delta-{meta['generation']}.npy", delta)
+        _write_meta(directory, {**meta, 'version': version, 'delta_rows': int(len(delta))})
+    return True
+
+
+def drop_store(user_id):
+    """Remove a user's store, e.g. when their account is deleted or inactive"""
+    shutil.rmtree(_user_dir(user_id), ignore_errors=True)
+
+
+def _range_mask(columns, start=None, end=None, transaction_type=None, status='completed'):
+    """Rows with start <= date < end of the given type and status"""
+    mask = np.ones(len(columns['id']), dtype=bool)
+    if start is not None:
+        mask &= columns['day'] >= start.toordinal()
+    if end is not None:
+        mask &= columns['day'] < end.toordinal()
+    if transaction_type is not None:
+        mask &= columns['kind'] == KINDS[transaction_type]
+    if status is not None:
+        mask &= columns['status'] == STATUSES[status]
+    return mask
+
+
+def _to_decimal(cents):
+    # bincount sums in float64, exact for integer cents below 2**53
+    return Decimal(int(round(cents))) / 100
+
+
+def type_totals(user_id, start, end):
+    """{'income': total, 'expense': total} of completed transactions with start <= date < end"""
+    columns = get_columns(user_id)
+    mask = _range_mask(columns, start, end)
+    sums = np.bincount(columns['kind'][mask], weights=columns['cents'][mask], minlength=2)
+    return {kind: _to_decimal(sums[code]) for kind, code in KINDS.items()}
+
+
+def category_totals(user_id, start, end, transaction_type):
+    """Completed totals per category with start <= date < end, largest first
+
+    Returns dicts shaped like the ORM's grouped values: category__id,
+    category__name, total and count.
+    """
+    columns = get_columns(user_id)
+    mask = _range_mask(columns, start, end, transaction_type)
+    categories, inverse, counts = np.unique(columns['category'][mask], return_inverse=True, return_counts=True)
+    totals = np.bincount(inverse, weights=columns['cents'][mask], minlength=len(categories))
+
+    names = category_names(user_id, categories)
+    rows = [
+        {
+            'category__id': int(category) or None,
+            'category__name': names.get(int(category)),
+            'total': _to_decimal(total),
+            'count': int(count),
+        }
+        for category, total, count in zip(categories, totals, counts)
+    ]
+    return sorted(rows, key=lambda row: row['total'], reverse=True)
+
+
+def month_category_totals(user_id, start, end):
+    """Completed totals per (month, type, category) with start <= date < end
+
+    Returns a list of (month, transaction_type, category_id, total) with the
+    month as its first day, matching the grouped query of build_reports.
+    """
+    columns = get_columns(user_id)
+    mask = _range_mask(columns, start, end)
+    if not mask.any():
+        return []
+
+    days = columns['day'][mask]
+    # Position of each row's month in ``months``, from the ordinals of month boundaries
+    first, last = date.fromordinal(int(days.min())), date.fromordinal(int(days.max()))
+    boundaries, months = [], []
+    current = first.replace(day=1)
+    while current <= last:
+        months.append(current)
+        current = current.replace(year=current.year + current.month // 12, month=current.month % 12 + 1)
+        boundaries.append(current.toordinal())
+    month_index = np.searchsorted(np.array(boundaries), days, side='right')
+
+    keys = np.column_stack((month_index, columns['kind'][mask], columns['category'][mask]))
+    groups, inverse = np.unique(keys, axis=0, return_inverse=True)
+    totals = np.bincount(inverse.ravel(), weights=columns['cents'][mask], minlength=len(groups))
+
+    kinds = {code: kind for kind, code in KINDS.items()}
+    return [
+        (months[month], kinds[kind], int(category) or None, _to_decimal(total))
+        for (month, kind, category), total in zip(groups, totals)
+    ]
+
+
+def category_names(user_id, category_ids):
+    """Map category id to name, without a query when the ids are active categories"""
+    names = {pk: name for pk, name, _ in get_user_choices(user_id)['categories']}
+    missing = [int(pk) for pk in category_ids if pk and int(pk) not in names]
+    if missing:
+        names.update(Category.objects.filter(pk__in=missing).values_list('id', 'name'))
+    return names
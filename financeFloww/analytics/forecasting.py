@@ -0,0 +1,182 @@
+import calendar
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+import numpy as np
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Sum
+from django.utils import timezone
+
+from financeFloww.sharding import user_shard
+from transactions.cache import get_data_version
+from transactions.models import Transaction
+
+HISTORY_DAYS = 365
+SMOOTHING_ALPHA = 0.1
+FORECAST_CACHE_KEY = 'forecast:{user_id}:{version}:{day}'
+FORECAST_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def load_daily_series(user_id, end_date, days=HISTORY_DAYS):
+    """Load daily totals per (type, category) into a (series x day) matrix with a single query"""
+    start_date = end_date - timedelta(days=days - 1)
+    rows = Transaction.objects.filter(
+        user_id=user_id,
+        status='completed',
+        transaction_date__gte=start_date,
+        transaction_date__lte=end_date
+    ).values('transaction_type', 'category_id', 'category__name', 'transaction_date').annotate(
+        total=Sum('amount')
+    ).order_by().values_list('transaction_type', 'category_id', 'category__name', 'transaction_date', 'total')
+
+    series = {}
+    series_index, day_index, amounts = [], [], []
+    for transaction_type, category_id, category_name, transaction_date, total in rows:
+        key = (transaction_type, category_id)
+        if key not in series:
+            series[key] = (len(series), category_name or 'Uncategorized')
+        series_index.append(series[key][0])
+        day_index.append((transaction_date - start_date).days)
+        amounts.append(float(total))
+
+    matrix = np.zeros((len(series), days))
+    if amounts:
+        np.add.at(matrix, (np.array(series_index), np.array(day_index)), np.array(amounts))
+
+    labels = [None] * len(series)
+    for (transaction_type, category_id), (position, name) in series.items():
+        labels[position] = {'transaction_type': transaction_type, 'category_id': category_id, 'name': name}
+
+    return start_date, labels, matrix
+
+
+def seasonal_average(matrix, start_date, remaining_dates):
+    """Project remaining spend from each series' average per weekday"""
+    days = matrix.shape[1]
+    weekdays = (np.arange(days) + start_date.weekday()) % 7
+    weekday_matrix = np.zeros((days, 7))
+    weekday_matrix[np.arange(days), weekdays] = 1
+
+    weekday_counts = weekday_matrix.sum(axis=0)
+    weekday_means = (matrix @ weekday_matrix) / np.maximum(weekday_counts, 1)
+
+    remaining = np.bincount([day.weekday() for day in remaining_dates], minlength=7)
+    return weekday_means @ remaining
+
+
+def exponential_smoothing(matrix, remaining_days, alpha=SMOOTHING_ALPHA):
+    """Project remaining spend from each series' exponentially smoothed daily level"""
+    days = matrix.shape[1]
+    weights = alpha * (1 - alpha) ** np.arange(days - 1, -1, -1)
+    level = (matrix @ weights) / weights.sum()
+    return level * remaining_days
+
+
+def forecast_user(user_id, today=None):
+    """Month-end projections for every series of a user"""
+    today = today or timezone.now().date()
+    start_date, labels, matrix = load_daily_series(user_id, today)
+
+    month_end = today.replace(day=calendar.monthrange(today.year, today.month)[1])
+    remaining_dates = [today + timedelta(days=offset) for offset in range(1, (month_end - today).days + 1)]
+    month_start_column = (today.replace(day=1) - start_date).days
+
+    month_to_date = matrix[:, month_start_column:].sum(axis=1)
+    seasonal = seasonal_average(matrix, start_date, remaining_dates)
+    smoothed = exponential_smoothing(matrix, len(remaining_dates))
+    projected = month_to_date + (seasonal + smoothed) / 2
+
+    categories = [
+        {
+            **label,
+            'month_to_date': round(float(month_to_date[position]), 2),
+            'seasonal': round(float(seasonal[position]), 2),
+            'smoothed': round(float(smoothed[position]), 2),
+            'projected': round(float(projected[position]), 2),
+        }
+        for position, label in enumerate(labels)
+    ]
+    categories.sort(key=lambda category: category['projected'], reverse=True)
+
+    is_income = np.array([label['transaction_type'] == 'income' for label in labels], dtype=bool)
+    projected_income = float(projected[is_income].sum())
+    projected_expense = float(projected[~is_income].sum())
+    month_to_date_net = float(month_to_date[is_income].sum() - month_to_date[~is_income].sum())
+
+    return {
+        'as_of': today,
+        'days_remaining': len(remaining_dates),
+        'categories': categories,
+        'top_expenses': [category for category in categories if category['transaction_type'] == 'expense'][:3],
+        'month_to_date_net': round(month_to_date_net, 2),
+        'projected_income': round(projected_income, 2),
+        'projected_expense': round(projected_expense, 2),
+        'projected_net': round(projected_income - projected_expense, 2),
+    }
+
+
+def _forecast_cache_key(user_id, today):
+    return FORECAST_CACHE_KEY.format(user_id=user_id, version=get_data_version(user_id), day=today.isoformat())
+
+
+def get_forecast(user):
+    """Cached forecast for a user, recomputed once their data or the date changes"""
+    today = timezone.now().date()
+    key = _forecast_cache_key(user.pk, today)
+    forecast = cache.get(key)
+    if forecast is None:
+        forecast = forecast_user(user.pk, today)
+        cache.set(key, forecast, FORECAST_CACHE_TIMEOUT)
+    return forecast
+
+
+def get_category_forecasts(user):
+    """Map category id to its projected month-end expense"""
+    return {
+        category['category_id']: category
+        for category in get_forecast(user)['categories']
+        if category['transaction_type'] == 'expense'
+    }
+
+
+def _init_worker():
+    import django
+    django.setup()
+
+
+def _forecast_user(user_id, today):
+    with user_shard(user_id):
+        return forecast_user(user_id, today)
+
+
+def _forecast_chunk(user_ids, today):
+    try:
+        return [(user_id, _forecast_user(user_id, today)) for user_id in user_ids]
+    finally:
+        connections.close_all()
+
+
+def forecast_all_users(user_ids, workers=None, chunk_size=100):
+    """Forecast many users in parallel worker processes and cache the results
+
+    Each worker opens its own database connection; results are cached by the
+    parent process in the shared default cache, where the web workers find
+    them. Keys are read before the forecasts are computed, so a write during
+    the run leaves its user's forecast under the old data version.
+    """
+    today = timezone.now().date()
+    user_ids = list(user_ids)
+    chunks = [user_ids[i:i + chunk_size] for i in range(0, len(user_ids), chunk_size)]
+    keys = [[_forecast_cache_key(user_id, today) for user_id in chunk] for chunk in chunks]
+
+    # Forked workers must not share the parent's database connections
+    connections.close_all()
+
+    forecasted = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        for chunk_keys, results in zip(keys, executor.map(_forecast_chunk, chunks, [today] * len(chunks))):
+            for key, (user_id, forecast) in zip(chunk_keys, results):
+                cache.set(key, forecast, FORECAST_CACHE_TIMEOUT)
+                forecasted += 1
+    return forecasted
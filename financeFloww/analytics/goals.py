@@ -0,0 +1,74 @@
+from decimal import Decimal
+
+from django.db.models import DecimalField, ExpressionWrapper, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, TruncDate
+
+from transactions.models import ArchivedTransaction, Transaction
+from .models import SavingsGoal
+
+
+def get_contribution(state):
+    """Return (user_id, category_id, transaction_date, amount) if a transaction state counts towards goals"""
+    if not state or state['status'] != 'completed' or not state['category_id']:
+        return None
+    return (state['user_id'], state['category_id'], state['transaction_date'], Decimal(str(state['amount'])))
+
+
+def apply_contribution(contribution, sign=1):
+    """Add (or remove, with sign=-1) a single contribution to the matching goal counters"""
+    if contribution is None:
+        return 0
+    user_id, category_id, transaction_date, amount = contribution
+    return SavingsGoal.objects.filter(
+        user_id=user_id,
+        category_id=category_id,
+        created_at__date__lte=transaction_date,
+    ).update(current_amount=F('current_amount') + amount * sign)
+
+
+def _contributions(model):
+    contributions = model.objects.filter(
+        user=OuterRef('user'),
+        category=OuterRef('category'),
+        status='completed',
+        transaction_date__gte=OuterRef('start_date'),
+    ).order_by().values('category').annotate(total=Sum('amount')).values('total')
+
+    return Coalesce(
+        Subquery(contributions, output_field=DecimalField(max_digits=12, decimal_places=2)),
+        Value(Decimal('0')),
+        output_field=DecimalField(max_digits=12, decimal_places=2),
+    )
+
+
+def contributions_subquery():
+    """Subquery summing completed transactions in a goal's category since the goal was created
+
+    Archived transactions count as well, so archiving old years does not
+    lower the progress of long-running goals. The outer queryset must be
+    annotated with ``start_date=TruncDate('created_at')``.
+    """
+    return ExpressionWrapper(
+        _contributions(Transaction) + _contributions(ArchivedTransaction),
+        output_field=DecimalField(max_digits=12, decimal_places=2),
+    )
+
+
+def reconcile_savings_goals(goals=None, batch_size=500):
+    """Recompute goal counters from transactions in one query and save the ones that drifted"""
+    if goals is None:
+        goals = SavingsGoal.objects.all()
+
+    goals = goals.filter(category__isnull=False).annotate(
+        start_date=TruncDate('created_at'),
+        contributed=contributions_subquery(),
+    )
+
+    changed = []
+    for goal in goals.only('id', 'current_amount'):
+        if goal.current_amount != goal.contributed:
+            goal.current_amount = goal.contributed
+            changed.append(goal)
+
+    SavingsGoal.objects.bulk_update(changed, ['current_amount'], batch_size=batch_size)
+    return len(changed)
@@ -0,0 +1,39 @@
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from analytics.columnar import build_store, drop_store, store_root
+from financeFloww.sharding import user_shard
+
+
+class Command(BaseCommand):
+    help = "Build the columnar analytics store of recently active users and drop those of idle ones"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', help='Only build these user ids')
+        parser.add_argument('--active-days', type=int, default=30,
+                            help='Users who logged in within this many days are built, others dropped')
+
+    def handle(self, *args, **options):
+        if options['user']:
+            active = set(options['user'])
+        else:
+            since = timezone.now() - timedelta(days=options['active_days'])
+            active = set(User.objects.filter(is_active=True, last_login__gte=since).values_list('id', flat=True))
+
+        dropped = 0
+        root = store_root()
+        if not options['user'] and root.exists():
+            for directory in root.iterdir():
+                if directory.is_dir() and directory.name.isdigit() and int(directory.name) not in active:
+                    drop_store(int(directory.name))
+                    dropped += 1
+
+        rows = 0
+        for user_id in sorted(active):
+            with user_shard(user_id):
+                rows += len(build_store(user_id)['id'])
+
+        self.stdout.write(self.style.SUCCESS(f"Built {len(active)} stores ({rows} rows), dropped {dropped}"))
@@ -0,0 +1,100 @@
+import json
+from contextlib import ExitStack
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connection, transaction as db_transaction
+
+from accounts.cache import USER_CACHE_KEY
+from analytics.columnar import drop_store
+from analytics.monthly_totals import REFRESH_CACHE_KEY
+from financeFloww.query_plans import HOT_PATHS, compare, run_hot_paths, seed_dataset
+from financeFloww.sharding import forget_user, shards
+from transactions.cache import CATALOG_VERSION_KEY, CLOSED_MONTHS_VERSION_KEY, DATA_VERSION_KEY
+
+
+class Command(BaseCommand):
+    help = (
+        "Explain the hot querysets against a seeded dataset and fail when their plans regress "
+        "from the stored baseline"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--baseline', help='Baseline file (default: query_plans/<database vendor>.json)')
+        parser.add_argument('--update-baseline', action='store_true', help='Store the current plans as the baseline')
+        parser.add_argument('--path', action='append', choices=sorted(HOT_PATHS), help='Only check these hot paths')
+        parser.add_argument('--users', type=int, default=3, help='Seeded users')
+        parser.add_argument('--transactions', type=int, default=20000, help='Seeded transactions per user')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--cost-threshold', type=float, default=0.25,
+                            help='Allowed growth of the estimated cost, as a fraction of the baseline')
+        parser.add_argument('--time-threshold', type=float, default=1.0,
+                            help='Allowed growth of the actual time, as a fraction of the baseline')
+        parser.add_argument('--min-time', type=float, default=1.0,
+                            help='Time regressions smaller than this many milliseconds are ignored')
+
+    def handle(self, *args, **options):
+        baseline_path = Path(options['baseline'] or settings.BASE_DIR / 'query_plans' / f'{connection.vendor}.json')
+
+        # Everything seeded is rolled back on every database once the plans are captured
+        databases = {DEFAULT_DB_ALIAS, *shards()}
+        with ExitStack() as stack:
+            for alias in databases:
+                stack.enter_context(db_transaction.atomic(using=alias))
+            users = seed_dataset(options['users'], options['transactions'], options['seed'])
+            try:
+                plans = run_hot_paths(users[0], options['path'])
+            finally:
+                for alias in databases:
+                    db_transaction.set_rollback(True, using=alias)
+                for user in users:
+                    drop_store(user.pk)
+                    forget_user(user.pk)
+                    cache.delete_many([
+                        DATA_VERSION_KEY.format(user_id=user.pk),
+                        CLOSED_MONTHS_VERSION_KEY.format(user_id=user.pk),
+                        CATALOG_VERSION_KEY.format(user_id=user.pk),
+                        # The ids are reused by the next run
+                        USER_CACHE_KEY.format(user_id=user.pk),
+                    ])
+                cache.delete_many([REFRESH_CACHE_KEY.format(shard=alias) for alias in shards()])
+
+        if options['update_baseline']:
+            baseline = {}
+            if options['path'] and baseline_path.exists():
+                # Keep the plans of the paths that were not run
+                baseline = {
+                    key: plan for key, plan in json.loads(baseline_path.read_text()).items()
+                    if key.partition('#')[0] not in options['path']
+                }
+            baseline.update(plans)
+            baseline_path.parent.mkdir(parents=True, exist_ok=True)
+            baseline_path.write_text(json.dumps(baseline, indent=2, sort_keys=True) + '\n')
+            self.stdout.write(self.style.SUCCESS(f"Stored {len(plans)} plans in {baseline_path}"))
+            return
+
+        if not baseline_path.exists():
+            raise CommandError(f"No baseline at {baseline_path}; record one with --update-baseline")
+        baseline = json.loads(baseline_path.read_text())
+        if options['path']:
+            baseline = {key: plan for key, plan in baseline.items() if key.partition('#')[0] in options['path']}
+
+        regressions = compare(
+            baseline,
+            plans,
+            cost_threshold=options['cost_threshold'],
+            time_threshold=options['time_threshold'],
+            min_time=options['min_time'],
+        )
+        for key in sorted(plans.keys() - baseline.keys()):
+            self.stdout.write(f"{key}: new statement, not in the baseline")
+        for key, lines in regressions:
+            self.stdout.write(self.style.ERROR(f"{key}:"))
+            for line in lines:
+                self.stdout.write(f"  {line}")
+
+        if regressions:
+            raise CommandError(f"{len(regressions)} of {len(plans)} query plans regressed")
+        self.stdout.write(self.style.SUCCESS(f"{len(plans)} query plans match the baseline"))
@@ -0,0 +1,19 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from analytics.forecasting import forecast_all_users
+
+
+class Command(BaseCommand):
+    help = "Precompute month-end cash-flow forecasts for all active users in parallel"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', help='Only forecast these user ids')
+        parser.add_argument('--workers', type=int, default=None, help='Worker processes (defaults to CPU count)')
+        parser.add_argument('--chunk-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        user_ids = options['user'] or User.objects.filter(is_active=True).values_list('id', flat=True)
+
+        forecasted = forecast_all_users(user_ids, workers=options['workers'], chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f"Forecasted {forecasted} users"))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from analytics.goals import reconcile_savings_goals
+from analytics.models import SavingsGoal
+from financeFloww.sharding import fan_out, moving_users
+
+
+class Command(BaseCommand):
+    help = "Recompute savings goal progress from the transactions in each goal's category"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, help='Only reconcile goals of this user id')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        changed = 0
+        for shard, user_ids in fan_out([options['user']] if options['user'] else None):
+            # Goals of users being moved are reconciled on their new shard next run
+            goals = SavingsGoal.objects.exclude(user_id__in=moving_users(shard))
+            if user_ids:
+                goals = goals.filter(user_id__in=user_ids)
+            changed += reconcile_savings_goals(goals, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Reconciled savings goals, {changed} updated"))
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from analytics.monthly_totals import refresh_monthly_totals
+from financeFloww.sharding import fan_out
+
+
+class Command(BaseCommand):
+    help = "Refresh the precomputed monthly category totals of every shard, once or on a schedule"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, help='Keep running and refresh every this many seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            for shard, _ in fan_out():
+                refresh = refresh_monthly_totals()
+                seconds = (refresh.finished_at - refresh.started_at).total_seconds()
+                self.stdout.write(self.style.SUCCESS(f"Refreshed monthly totals of {shard} in {seconds:.2f}s"))
+            if not options['interval']:
+                return
+            close_old_connections()
+            time.sleep(options['interval'])
@@ -0,0 +1,114 @@
+# Generated by Django 4.2.13 on 2026-10-19 08:34
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import timezone
+
+MONTH = {
+    'postgresql': "date_trunc('month', transaction_date)::date",
+    'sqlite': "date(transaction_date, 'start of month')",
+}
+TOTALS_QUERY = (
+    "SELECT user_id || '-' || {month} || '-' || COALESCE(category_id, 0) || '-' || transaction_type AS id, "
+    "user_id, {month} AS month, category_id, transaction_type, "
+    "SUM(amount) AS total, COUNT(*) AS transaction_count "
+    "FROM ("
+    "SELECT user_id, transaction_date, category_id, transaction_type, amount "
+    "FROM transactions_transaction WHERE status = 'completed' "
+    "UNION ALL "
+    "SELECT user_id, transaction_date, category_id, transaction_type, amount "
+    "FROM transactions_archivedtransaction WHERE status = 'completed'"
+    ") AS completed "
+    "GROUP BY user_id, {month}, category_id, transaction_type"
+)
+
+
+def create_monthly_totals(apps, schema_editor):
+    """A materialized view on PostgreSQL, a table filled the same way elsewhere"""
+    vendor = schema_editor.connection.vendor
+    query = TOTALS_QUERY.format(month=MONTH.get(vendor, MONTH['sqlite']))
+    started_at = timezone.now()
+    if vendor == 'postgresql':
+        schema_editor.execute(f'CREATE MATERIALIZED VIEW analytics_monthly_category_totals AS {query}')
+        # REFRESH ... CONCURRENTLY needs a unique index over all rows
+        schema_editor.execute('CREATE UNIQUE INDEX analytics_monthly_category_totals_id ON analytics_monthly_category_totals (id)')
+    else:
+        schema_editor.execute(
+            'CREATE TABLE analytics_monthly_category_totals ('
+            'id varchar(64) NOT NULL PRIMARY KEY, user_id integer NOT NULL, month date NOT NULL, '
+            'category_id bigint NULL, transaction_type varchar(10) NOT NULL, '
+            'total decimal NOT NULL, transaction_count integer NOT NULL)'
+        )
+        schema_editor.execute(f'INSERT INTO analytics_monthly_category_totals {query}')
+    schema_editor.execute(
+        'CREATE INDEX analytics_monthly_category_totals_user_month '
+        'ON analytics_monthly_category_totals (user_id, month)'
+    )
+    MonthlyTotalsRefresh = apps.get_model('analytics', 'MonthlyTotalsRefresh')
+    MonthlyTotalsRefresh.objects.using(schema_editor.connection.alias).create(
+        started_at=started_at, finished_at=timezone.now()
+    )
+
+
+def drop_monthly_totals(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP MATERIALIZED VIEW IF EXISTS analytics_monthly_category_totals')
+    else:
+        schema_editor.execute('DROP TABLE IF EXISTS analytics_monthly_category_totals')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('analytics', '0001_initial'),
+        ('transactions', '0004_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlyCategoryTotal',
+            fields=[
+                ('id', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('month', models.DateField(help_text='First day of the month')),
+                ('transaction_type', models.CharField(max_length=10)),
+                ('total', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('transaction_count', models.IntegerField()),
+            ],
+            options={
+                'verbose_name': 'Monthly Category Total',
+                'verbose_name_plural': 'Monthly Category Totals',
+                'db_table': 'analytics_monthly_category_totals',
+                'managed': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='MonthlyTotalsRefresh',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started_at', models.DateTimeField()),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Monthly Totals Refresh',
+                'verbose_name_plural': 'Monthly Totals Refreshes',
+                'ordering': ['-started_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='StaleMonth',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(help_text='First day of the month')),
+                ('marked_at', models.DateTimeField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stale_months', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Stale Month',
+                'verbose_name_plural': 'Stale Months',
+                'unique_together': {('user', 'month')},
+            },
+        ),
+        migrations.RunPython(create_monthly_totals, drop_monthly_totals),
+    ]
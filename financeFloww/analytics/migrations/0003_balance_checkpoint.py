@@ -0,0 +1,40 @@
+# Generated by Django 4.2.13 on 2026-10-19 08:39
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0004_archive'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('analytics', '0002_monthly_category_totals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(help_text='First day of the month')),
+                ('balance', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('payment_method', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='balance_checkpoints', to='transactions.paymentmethod')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_checkpoints', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Balance Checkpoint',
+                'verbose_name_plural': 'Balance Checkpoints',
+                'ordering': ['month'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='balancecheckpoint',
+            constraint=models.UniqueConstraint(condition=models.Q(('payment_method__isnull', False)), fields=('user', 'payment_method', 'month'), name='unique_payment_method_checkpoint'),
+        ),
+        migrations.AddConstraint(
+            model_name='balancecheckpoint',
+            constraint=models.UniqueConstraint(condition=models.Q(('payment_method__isnull', True)), fields=('user', 'month'), name='unique_unassigned_checkpoint'),
+        ),
+    ]
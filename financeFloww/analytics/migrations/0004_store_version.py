@@ -0,0 +1,27 @@
+# Generated by Django 4.2.13 on 2026-10-19 09:42
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('analytics', '0003_balance_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoreVersion',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('version', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Store Version',
+                'verbose_name_plural': 'Store Versions',
+            },
+        ),
+    ]
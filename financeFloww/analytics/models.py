@@ -4,6 +4,8 @@ from django.db.models import Sum, Count
 from datetime import timedelta
 from django.utils import timezone
 
+from transactions.models import RecordedModel
+
 class FinancialSummary(models.Model):
     """Daily financial summary for quick access and analytics"""
     
@@ -65,7 +67,7 @@ class SpendingTrend(models.Model):
         return f"{self.user.username} - {self.category.name} ({self.period})"
 
 
-class SavingsGoal(models.Model):
+class SavingsGoal(RecordedModel):
     """Track savings goals"""
     
     STATUS_CHOICES = [
@@ -90,6 +92,9 @@ class SavingsGoal(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # Fields included in outbox change records; progress is derived from transactions and left out
+    OUTBOX_FIELDS = ['category_id', 'target_amount', 'target_date', 'status']
+
     class Meta:
         verbose_name = 'Savings Goal'
         verbose_name_plural = 'Savings Goals'
@@ -149,4 +154,125 @@ class MonthlyReport(models.Model):
         ordering = ['-month']
 
     def __str__(self):
-        return f"{self.user.username} - {self.month.strftime('%B %Y')}"
\ No newline at end of file
+        return f"{self.user.username} - {self.month.strftime('%B %Y')}"
+
+class BalanceCheckpoint(models.Model):
+    """Cumulative net of a user's completed transactions through the end of a closed month
+
+    One row per payment method (None: transactions without one) and month,
+    from the method's first month with transactions to the latest checkpoint.
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='balance_checkpoints')
+    payment_method = models.ForeignKey(
+        'transactions.PaymentMethod',
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='balance_checkpoints'
+    )
+
+    month = models.DateField(help_text="First day of the month")
+    balance = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name = 'Balance Checkpoint'
+        verbose_name_plural = 'Balance Checkpoints'
+        ordering = ['month']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'payment_method', 'month'],
+                condition=models.Q(payment_method__isnull=False),
+                name='unique_payment_method_checkpoint',
+            ),
+            models.UniqueConstraint(
+                fields=['user', 'month'],
+                condition=models.Q(payment_method__isnull=True),
+                name='unique_unassigned_checkpoint',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} - {self.payment_method_id} - {self.month}: {self.balance}"
+
+
+class MonthlyCategoryTotal(models.Model):
+    """Completed totals per user, closed month, category and type
+
+    Backed by a materialized view on PostgreSQL and by a plain table
+    elsewhere, both created by migration and refreshed with
+    refresh_monthly_totals; archived transactions are included.
+    """
+
+    id = models.CharField(max_length=64, primary_key=True)
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    month = models.DateField(help_text="First day of the month")
+    category = models.ForeignKey(
+        'transactions.Category',
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        null=True,
+        related_name='+'
+    )
+    transaction_type = models.CharField(max_length=10)
+    total = models.DecimalField(max_digits=14, decimal_places=2)
+    transaction_count = models.IntegerField()
+
+    class Meta:
+        managed = False
+        db_table = 'analytics_monthly_category_totals'
+        verbose_name = 'Monthly Category Total'
+        verbose_name_plural = 'Monthly Category Totals'
+
+    def __str__(self):
+        return f"{self.user_id} - {self.month} - {self.category_id} ({self.transaction_type})"
+
+
+class MonthlyTotalsRefresh(models.Model):
+    """One refresh of the monthly category totals"""
+
+    started_at = models.DateTimeField()
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Monthly Totals Refresh'
+        verbose_name_plural = 'Monthly Totals Refreshes'
+        ordering = ['-started_at']
+
+    def __str__(self):
+        return f"Refresh at {self.started_at}"
+
+
+class StaleMonth(models.Model):
+    """A closed month of a user written to since the monthly totals were last refreshed"""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='stale_months')
+    month = models.DateField(help_text="First day of the month")
+    marked_at = models.DateTimeField()
+
+    class Meta:
+        verbose_name = 'Stale Month'
+        verbose_name_plural = 'Stale Months'
+        unique_together = ['user', 'month']
+
+    def __str__(self):
+        return f"{self.user.username} - {self.month}"
+
+
+class StoreVersion(models.Model):
+    """Count of writes to a user's transactions, the version their columnar store must be at
+
+    Bumped in the database transaction of every write (see
+    analytics.columnar), so every process and host agrees on whether a store
+    is current.
+    """
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='+')
+    version = models.BigIntegerField(default=0)
+
+    class Meta:
+        verbose_name = 'Store Version'
+        verbose_name_plural = 'Store Versions'
+
+    def __str__(self):
+        return f"{self.user_id} at {self.version}"
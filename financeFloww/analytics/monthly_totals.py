@@ -0,0 +1,152 @@
+from django.core.cache import cache
+from django.db import connections, router, transaction as db_transaction
+from django.utils import timezone
+
+from financeFloww.metrics import timed
+from financeFloww.sharding import current_shard, shard_for
+from transactions.models import ArchivedTransaction, Transaction
+from .columnar import category_names
+from .models import MonthlyCategoryTotal, MonthlyTotalsRefresh, StaleMonth
+
+REFRESH_CACHE_KEY = 'monthly-totals-refresh:{shard}'
+REFRESH_CACHE_TIMEOUT = 60 * 5
+# Refresh records kept for inspection
+REFRESH_HISTORY = 50
+
+
+def month_expression(vendor):
+    """SQL truncating transaction_date to the first day of its month"""
+    if vendor == 'postgresql':
+        return "date_trunc('month', transaction_date)::date"
+    return "date(transaction_date, 'start of month')"
+
+
+def totals_query(vendor):
+    """SELECT producing the rows of MonthlyCategoryTotal
+
+    The open month is included too, but only months closed when a refresh
+    started are ever read.
+    """
+    month = month_expression(vendor)
+    columns = 'user_id, transaction_date, category_id, transaction_type, amount'
+    return (
+        f"SELECT user_id || '-' || {month} || '-' || COALESCE(category_id, 0) || '-' || transaction_type AS id, "
+        f"user_id, {month} AS month, category_id, transaction_type, "
+        f"SUM(amount) AS total, COUNT(*) AS transaction_count "
+        f"FROM ("
+        f"SELECT {columns} FROM {Transaction._meta.db_table} WHERE status = 'completed' "
+        f"UNION ALL "
+        f"SELECT {columns} FROM {ArchivedTransaction._meta.db_table} WHERE status = 'completed'"
+        f") AS completed "
+        f"GROUP BY user_id, {month}, category_id, transaction_type"
+    )
+
+
+def latest_refresh():
+    """The selected shard's last finished refresh, or None; cached briefly since every helper needs it
+
+    A stale cached refresh is safe: the stored totals are always at least as
+    recent as it, so it only serves fewer months than it could.
+    """
+    key = REFRESH_CACHE_KEY.format(shard=current_shard())
+    refresh = cache.get(key)
+    if refresh is None:
+        refresh = MonthlyTotalsRefresh.objects.filter(finished_at__isnull=False).first() or ''
+        cache.set(key, refresh, REFRESH_CACHE_TIMEOUT)
+    return refresh or None
+
+
+@timed('refresh_monthly_totals')
+def refresh_monthly_totals():
+    """Recompute the stored totals of the selected shard; reads keep being served while it runs on PostgreSQL
+
+    Months marked stale before the refresh started are covered by it, so
+    their marks are cleared afterwards. Run it for every shard with
+    sharding.for_each_shard.
+    """
+    connection = connections[router.db_for_write(MonthlyCategoryTotal)]
+    table = connection.ops.quote_name(MonthlyCategoryTotal._meta.db_table)
+    refresh = MonthlyTotalsRefresh.objects.create(started_at=timezone.now())
+
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(f'REFRESH MATERIALIZED VIEW CONCURRENTLY {table}')
+    else:
+        with db_transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {table}')
+            cursor.execute(f'INSERT INTO {table} {totals_query(connection.vendor)}')
+
+    refresh.finished_at = timezone.now()
+    refresh.save(update_fields=['finished_at'])
+    StaleMonth.objects.filter(marked_at__lt=refresh.started_at).delete()
+    MonthlyTotalsRefresh.objects.filter(
+        pk__in=MonthlyTotalsRefresh.objects.values_list('pk', flat=True)[REFRESH_HISTORY:]
+    ).delete()
+    cache.set(REFRESH_CACHE_KEY.format(shard=connection.alias), refresh, REFRESH_CACHE_TIMEOUT)
+    return refresh
+
+
+def mark_stale(user_id, months):
+    """Record writes to closed months, so their totals are read live until the next refresh
+
+    Marked once the write commits: a refresh that started before the mark
+    then always sees the write.
+    """
+    months = set(months)
+    if not months:
+        return
+    alias = shard_for(user_id)
+
+    def mark():
+        now = timezone.now()
+        StaleMonth.objects.using(alias).bulk_create(
+            [StaleMonth(user_id=user_id, month=month, marked_at=now) for month in months],
+            update_conflicts=True,
+            unique_fields=['user', 'month'],
+            update_fields=['marked_at'],
+        )
+    db_transaction.on_commit(mark, using=alias)
+
+
+def precomputed_months(user_id, months):
+    """The months among ``months`` whose totals can be read from MonthlyCategoryTotal
+
+    Those are the months closed when the last refresh started that have not
+    been written to since.
+    """
+    refresh = latest_refresh()
+    if refresh is None:
+        return set()
+    covered = {month for month in months if month < timezone.localtime(refresh.started_at).date().replace(day=1)}
+    if covered:
+        covered -= set(StaleMonth.objects.filter(
+            user_id=user_id,
+            month__in=covered,
+            marked_at__gte=refresh.started_at,
+        ).values_list('month', flat=True))
+    return covered
+
+
+def monthly_totals(user_id, months, **filters):
+    """Stored totals of the user for ``months``, which must come from precomputed_months"""
+    return MonthlyCategoryTotal.objects.filter(user_id=user_id, month__in=months, **filters)
+
+
+def stored_category_totals(user_id, month, transaction_type):
+    """Per-category totals of one month shaped like columnar.category_totals, or None if not precomputed"""
+    if not precomputed_months(user_id, [month]):
+        return None
+    rows = list(monthly_totals(user_id, [month], transaction_type=transaction_type).values_list(
+        'category_id', 'total', 'transaction_count'
+    ))
+    names = category_names(user_id, [category_id for category_id, total, count in rows])
+    categories = [
+        {
+            'category__id': category_id,
+            'category__name': names.get(category_id),
+            'total': total,
+            'count': count,
+        }
+        for category_id, total, count in rows
+    ]
+    return sorted(categories, key=lambda row: row['total'], reverse=True)
@@ -0,0 +1,174 @@
+from collections import defaultdict
+from datetime import date
+from decimal import Decimal
+
+from dateutil.relativedelta import relativedelta
+from django.db.models import Q, Sum
+from django.utils import timezone
+
+from transactions.models import Transaction
+from .breakdown import month_range
+from .columnar import month_category_totals
+from .models import MonthlyReport
+from .monthly_totals import mark_stale, monthly_totals, precomputed_months
+
+# Stored history needed for a trailing-12-month view with year-over-year comparison
+REPORT_HISTORY_MONTHS = 24
+
+
+def savings_rate(income, expense):
+    """Percentage of income that was not spent"""
+    if income > 0:
+        return round(float((income - expense) / income) * 100, 2)
+    return 0
+
+
+def current_month_summary(user):
+    """Live totals for the open month in a single aggregate query"""
+    first_day = timezone.now().date().replace(day=1)
+    totals = Transaction.objects.filter(
+        user=user,
+        transaction_date__gte=first_day,
+        transaction_date__lt=first_day + relativedelta(months=1),
+        status='completed'
+    ).aggregate(
+        income=Sum('amount', filter=Q(transaction_type='income')),
+        expense=Sum('amount', filter=Q(transaction_type='expense')),
+    )
+    income = totals['income'] or Decimal('0')
+    expense = totals['expense'] or Decimal('0')
+
+    return {
+        'month': first_day,
+        'income': income,
+        'expense': expense,
+        'net': income - expense,
+        'savings_rate': savings_rate(income, expense),
+    }
+
+
+def build_reports(user, months):
+    """Build unsaved reports for the given months
+
+    Months covered by the precomputed monthly totals are read from them, the
+    rest reduced from the user's columnar store; both include archived years.
+    """
+    months = sorted(months)
+    totals = defaultdict(lambda: {'income': Decimal('0'), 'expense': Decimal('0'), 'categories': defaultdict(Decimal)})
+
+    precomputed = precomputed_months(user.pk, months)
+    rows = list(monthly_totals(user.pk, precomputed).values_list('month', 'transaction_type', 'category_id', 'total'))
+    live = [month for month in months if month not in precomputed]
+    if live:
+        rows += [
+            row for row in month_category_totals(user.pk, live[0], live[-1] + relativedelta(months=1))
+            if row[0] not in precomputed
+        ]
+
+    for month, transaction_type, category_id, total in rows:
+        month_totals = totals[month]
+        month_totals[transaction_type] += total
+        if transaction_type == 'expense' and category_id:
+            month_totals['categories'][category_id] += total
+
+    reports = []
+    for month in months:
+        month_totals = totals[month]
+        income, expense = month_totals['income'], month_totals['expense']
+        top_category, top_amount = max(
+            month_totals['categories'].items(), key=lambda item: item[1], default=(None, Decimal('0'))
+        )
+        reports.append(MonthlyReport(
+            user=user,
+            month=month,
+            total_income=income,
+            total_expense=expense,
+            net_savings=income - expense,
+            savings_rate=savings_rate(income, expense),
+            top_expense_category_id=top_category,
+            top_expense_amount=top_amount,
+        ))
+    return reports
+
+
+def backfill_monthly_reports(user, history=REPORT_HISTORY_MONTHS):
+    """Store reports for every closed month in the history window that has none
+
+    Costs one query to find the gaps and, if there are any, a read of the
+    precomputed monthly totals plus one bulk insert to fill all of them.
+    """
+    current_month = timezone.now().date().replace(day=1)
+    start = current_month - relativedelta(months=history)
+    existing = set(MonthlyReport.objects.filter(
+        user=user,
+        month__gte=start,
+        month__lt=current_month
+    ).values_list('month', flat=True))
+
+    missing = [month for month in month_range(start, current_month - relativedelta(months=1)) if month not in existing]
+    if not missing:
+        return []
+
+    reports = build_reports(user, missing)
+    MonthlyReport.objects.bulk_create(reports, ignore_conflicts=True)
+    return reports
+
+
+def trailing_reports(user, months=12):
+    """Stored reports for the last closed months, each paired with the same month a year earlier"""
+    backfill_monthly_reports(user, history=months + 12)
+
+    current_month = timezone.now().date().replace(day=1)
+    stored = {
+        report.month: report
+        for report in MonthlyReport.objects.filter(
+            user=user,
+            month__gte=current_month - relativedelta(months=months + 12),
+            month__lt=current_month
+        ).select_related('top_expense_category')
+    }
+
+    trailing = []
+    for month in reversed(month_range(current_month - relativedelta(months=months), current_month - relativedelta(months=1))):
+        report = stored.get(month)
+        if report is None:
+            continue
+        previous_year = stored.get(month - relativedelta(years=1))
+        trailing.append({
+            'report': report,
+            'previous_year': previous_year,
+            'income_change': report.total_income - previous_year.total_income if previous_year else None,
+            'expense_change': report.total_expense - previous_year.total_expense if previous_year else None,
+        })
+    return trailing
+
+
+def summarize(trailing):
+    """Totals over the trailing window and the same window a year earlier"""
+    income = sum((item['report'].total_income for item in trailing), Decimal('0'))
+    expense = sum((item['report'].total_expense for item in trailing), Decimal('0'))
+    previous_income = sum((item['previous_year'].total_income for item in trailing if item['previous_year']), Decimal('0'))
+    previous_expense = sum((item['previous_year'].total_expense for item in trailing if item['previous_year']), Decimal('0'))
+
+    return {
+        'income': income,
+        'expense': expense,
+        'net': income - expense,
+        'savings_rate': savings_rate(income, expense),
+        'previous_income': previous_income,
+        'previous_expense': previous_expense,
+        'previous_net': previous_income - previous_expense,
+        'previous_savings_rate': savings_rate(previous_income, previous_expense),
+    }
+
+
+def invalidate_reports(user_id, dates):
+    """Drop stored reports for closed months touched by a write so they are rebuilt on next view
+
+    The months' precomputed totals are marked stale as well.
+    """
+    current_month = timezone.now().date().replace(day=1)
+    months = {value.replace(day=1) for value in dates if isinstance(value, date) and value < current_month}
+    if months:
+        MonthlyReport.objects.filter(user_id=user_id, month__in=months).delete()
+        mark_stale(user_id, months)
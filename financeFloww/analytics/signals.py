@@ -0,0 +1,172 @@
+from django.db import transaction as db_transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from financeFloww.sharding import shard_for
+from transactions.cache import bump_data_version
+from transactions.models import PaymentMethod, Transaction
+from transactions.operations import bulk_transactions_changed
+from transactions.outbox import record_instance
+from .balances import apply_balance_changes
+from .columnar import apply_changes, bump_store_version
+from .goals import apply_contribution, get_contribution, reconcile_savings_goals
+from .models import BalanceCheckpoint, SavingsGoal
+from .reports import invalidate_reports
+
+
+@receiver(post_save, sender=Transaction)
+def update_goals_on_transaction_save(sender, instance, created, **kwargs):
+    """Move the transaction's contribution from its previous goals to its current ones"""
+    previous = None if created else instance.get_previous_state()
+    current = instance.get_tracked_state()
+
+    if not created and previous is None:
+        # The previous values were never loaded, so recompute the user's goals instead
+        reconcile_savings_goals(SavingsGoal.objects.filter(user_id=instance.user_id))
+        return
+
+    old_contribution = get_contribution(previous)
+    new_contribution = get_contribution(current)
+    if old_contribution == new_contribution:
+        return
+
+    apply_contribution(old_contribution, sign=-1)
+    apply_contribution(new_contribution)
+
+
+@receiver(post_delete, sender=Transaction)
+def update_goals_on_transaction_delete(sender, instance, **kwargs):
+    """Remove a deleted transaction's contribution from its goals"""
+    state = instance.get_previous_state() or instance.get_tracked_state()
+    apply_contribution(get_contribution(state), sign=-1)
+
+
+@receiver(post_save, sender=SavingsGoal)
+def reconcile_goal_on_save(sender, instance, created, update_fields=None, **kwargs):
+    """Recompute a goal's progress when it is created or linked to a category"""
+    if update_fields is not None and 'category' not in update_fields:
+        return
+    if instance.category_id is None:
+        return
+    reconcile_savings_goals(SavingsGoal.objects.filter(pk=instance.pk))
+
+
+@receiver(post_save, sender=Transaction)
+def invalidate_reports_on_transaction_save(sender, instance, created, **kwargs):
+    """Drop stored monthly reports that no longer match the transactions of their month"""
+    previous = None if created else instance.get_previous_state()
+    current = instance.get_tracked_state()
+    if previous == current:
+        return
+    dates = [state['transaction_date'] for state in (previous, current) if state]
+    invalidate_reports(instance.user_id, dates)
+
+
+@receiver(post_delete, sender=Transaction)
+def invalidate_reports_on_transaction_delete(sender, instance, **kwargs):
+    """Drop the stored report of a deleted transaction's month"""
+    state = instance.get_previous_state() or instance.get_tracked_state()
+    invalidate_reports(instance.user_id, [state['transaction_date']] if state else [])
+
+
+@receiver(bulk_transactions_changed)
+def update_goals_on_bulk_change(sender, user_id, before, after, **kwargs):
+    """Recompute, in one query, the goals of every category whose contributions changed"""
+    categories = set()
+    for previous, current in zip(before, after):
+        old_contribution, new_contribution = get_contribution(previous), get_contribution(current)
+        if old_contribution != new_contribution:
+            categories.update(contribution[1] for contribution in (old_contribution, new_contribution) if contribution)
+    if categories:
+        reconcile_savings_goals(SavingsGoal.objects.filter(user_id=user_id, category_id__in=categories))
+
+
+@receiver(bulk_transactions_changed)
+def invalidate_reports_on_bulk_change(sender, user_id, before, after, **kwargs):
+    """Drop the stored reports of every month a bulk change touched, in one delete"""
+    dates = {
+        state['transaction_date']
+        for previous, current in zip(before, after) if previous != current
+        for state in (previous, current) if state
+    }
+    invalidate_reports(user_id, dates)
+
+
+@receiver(post_save, sender=SavingsGoal)
+@receiver(post_delete, sender=SavingsGoal)
+def bump_data_version_on_goal_change(sender, instance, **kwargs):
+    """Goals are shown on the dashboard, so edits must change its ETag"""
+    bump_data_version(instance.user_id, dates=())
+
+
+@receiver(post_save, sender=SavingsGoal)
+def record_goal_save(sender, instance, created, raw=False, **kwargs):
+    """Append the change to the outbox, in the database transaction of the save"""
+    if not raw:
+        record_instance(instance, created=created)
+
+
+@receiver(post_delete, sender=SavingsGoal)
+def record_goal_delete(sender, instance, **kwargs):
+    """Append the delete to the outbox, in the collector's database transaction"""
+    record_instance(instance, deleted=True)
+
+
+@receiver(post_save, sender=Transaction)
+def patch_store_on_transaction_save(sender, instance, raw=False, **kwargs):
+    """Count the write and upsert the saved row into the owner's columnar store once it commits"""
+    if raw:
+        return
+    version = bump_store_version(instance.user_id)
+    state = instance.get_tracked_state()
+    if state is None:
+        return
+    row = {**state, 'id': instance.pk}
+    db_transaction.on_commit(lambda: apply_changes(instance.user_id, [row], version), using=instance._state.db)
+
+
+@receiver(post_delete, sender=Transaction)
+def patch_store_on_transaction_delete(sender, instance, **kwargs):
+    """Count the delete and remove the row from the owner's columnar store once it commits"""
+    version = bump_store_version(instance.user_id)
+    row = {'id': instance.pk}
+    db_transaction.on_commit(lambda: apply_changes(instance.user_id, [row], version), using=instance._state.db)
+
+
+@receiver(bulk_transactions_changed)
+def patch_store_on_bulk_change(sender, user_id, before, after, **kwargs):
+    """Count a whole bulk operation as one write and apply it to the columnar store in one patch"""
+    version = bump_store_version(user_id)
+    rows = [current or {'id': previous['id']} for previous, current in zip(before, after)]
+    db_transaction.on_commit(lambda: apply_changes(user_id, rows, version), using=shard_for(user_id))
+
+
+@receiver(post_save, sender=Transaction)
+def update_balances_on_transaction_save(sender, instance, created, **kwargs):
+    """Shift the balance checkpoints after the saved transaction's month"""
+    previous = None if created else instance.get_previous_state()
+    current = instance.get_tracked_state()
+    if current is None or (not created and previous is None):
+        # The change cannot be computed, so rebuild the checkpoints on next use
+        BalanceCheckpoint.objects.filter(user_id=instance.user_id).delete()
+        return
+    apply_balance_changes(instance.user_id, [(previous, current)])
+
+
+@receiver(post_delete, sender=Transaction)
+def update_balances_on_transaction_delete(sender, instance, **kwargs):
+    """Take a deleted transaction out of the balance checkpoints"""
+    state = instance.get_previous_state() or instance.get_tracked_state()
+    apply_balance_changes(instance.user_id, [(state, None)])
+
+
+@receiver(bulk_transactions_changed)
+def update_balances_on_bulk_change(sender, user_id, before, after, **kwargs):
+    """Shift the balance checkpoints by the net change of a bulk operation"""
+    apply_balance_changes(user_id, zip(before, after))
+
+
+@receiver(post_delete, sender=PaymentMethod)
+def reset_balances_on_payment_method_delete(sender, instance, **kwargs):
+    """Its transactions become unassigned, so the user's checkpoints are rebuilt on next use"""
+    BalanceCheckpoint.objects.filter(user_id=instance.user_id).delete()
@@ -1,3 +1,244 @@
-from django.test import TestCase
+import shutil
+import tempfile
+from datetime import date
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from transactions.models import Category, PaymentMethod, Transaction
+from . import columnar
+from .balances import ensure_checkpoints
+from .goals import reconcile_savings_goals
+from .breakdown import build_matrix, category_month_rows, month_range, spending_matrix
+from .models import BalanceCheckpoint, SavingsGoal, StaleMonth
+from .monthly_totals import precomputed_months, refresh_monthly_totals, stored_category_totals
+
+LOCAL_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+class AnalyticsTestCase(TestCase):
+    """A user with one expense category; writes run their on-commit hooks like a real commit"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('analyst', 'analyst@example.com', 'secret')
+        self.food = Category.objects.create(user=self.user, name='Food', category_type='expense')
+
+    def create(self, amount, day, category=None, transaction_type='expense', **fields):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Transaction.objects.create(
+                user=self.user, category=category or self.food, transaction_type=transaction_type,
+                amount=amount, description='Groceries', transaction_date=day, **fields
+            )
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class ClosedMonthMatrixTests(AnalyticsTestCase):
+    start, end = date(2024, 4, 1), date(2024, 6, 1)
+
+    def rebuilt(self):
+        return build_matrix(category_month_rows(self.user, self.start, self.end), month_range(self.start, self.end))
+
+    def test_string_dates_are_tracked_as_dates(self):
+        transaction = self.create(Decimal('10.00'), '2024-05-01')
+        self.assertEqual(transaction.get_tracked_state()['transaction_date'], date(2024, 5, 1))
+        self.assertTrue(StaleMonth.objects.filter(user_id=self.user.pk, month=date(2024, 5, 1)).exists())
+
+    def test_cached_closed_months_follow_writes_to_them(self):
+        self.create(Decimal('10.00'), date(2024, 5, 1))
+        self.assertEqual(spending_matrix(self.user, self.start, self.end), self.rebuilt())
+
+        self.create(Decimal('5.00'), '2024-05-10')
+        self.create(Decimal('7.50'), '2024-04-02')
+        matrix = spending_matrix(self.user, self.start, self.end)
+        self.assertEqual(matrix, self.rebuilt())
+        self.assertEqual(matrix['grand_total'], Decimal('22.50'))
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class BalanceCheckpointTests(AnalyticsTestCase):
+    def checkpoints(self):
+        # A series started by a later write may open with zero months a rebuild leaves out
+        return {
+            (payment_method_id, month): balance
+            for payment_method_id, month, balance in BalanceCheckpoint.objects.filter(
+                user_id=self.user.pk
+            ).exclude(balance=0).values_list('payment_method_id', 'month', 'balance')
+        }
+
+    def rebuilt(self):
+        BalanceCheckpoint.objects.filter(user_id=self.user.pk).delete()
+        ensure_checkpoints(self.user.pk)
+        return self.checkpoints()
+
+    def test_string_amounts_shift_the_checkpoints(self):
+        self.create('100.00', date(2024, 3, 5), transaction_type='income')
+        ensure_checkpoints(self.user.pk)
+        self.create('30.50', date(2024, 4, 2))
+        self.assertEqual(self.checkpoints()[None, date(2024, 4, 1)], Decimal('69.50'))
+
+    def test_incremental_checkpoints_equal_a_rebuild(self):
+        card = PaymentMethod.objects.create(user=self.user, name='Card', payment_type='debit_card')
+        self.create(Decimal('100.00'), date(2024, 3, 5), transaction_type='income')
+        rent = self.create(Decimal('40.00'), date(2024, 4, 2))
+        ensure_checkpoints(self.user.pk)
+
+        lunch = self.create('12.25', '2024-03-20', payment_method=card)
+        rent.amount = '45.00'
+        rent.transaction_date = date(2024, 2, 28)
+        rent.save()
+        lunch.status = 'pending'
+        lunch.save()
+        self.create(Decimal('8.00'), date(2024, 4, 9), payment_method=card)
+        incremental = self.checkpoints()
+
+        self.assertEqual(incremental, self.rebuilt())
+        self.assertEqual(incremental[None, date(2024, 3, 1)], Decimal('55.00'))
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class SavingsGoalTests(AnalyticsTestCase):
+    def test_progress_kept_by_delta_equals_a_reconcile(self):
+        savings = Category.objects.create(user=self.user, name='Savings', category_type='expense')
+        goal = SavingsGoal.objects.create(
+            user=self.user, name='Bike', target_amount=Decimal('500.00'), target_date=date(2030, 1, 1),
+            category=savings,
+        )
+        today = timezone.localdate()
+        deposits = [self.create(amount, today, category=savings) for amount in ('50.00', Decimal('25.00'), '10.00')]
+        self.create(Decimal('99.00'), today)
+
+        deposits[0].amount = '60.00'
+        deposits[0].save()
+        deposits[1].category = self.food
+        deposits[1].save()
+        deposits[2].status = 'pending'
+        deposits[2].save()
+        self.create(Decimal('15.00'), today, category=savings).delete()
+        goal.refresh_from_db()
+
+        self.assertEqual(goal.current_amount, Decimal('60.00'))
+        self.assertEqual(reconcile_savings_goals(SavingsGoal.objects.filter(user=self.user)), 0)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class MonthlyTotalsTests(AnalyticsTestCase):
+    months = [date(2024, 3, 1), date(2024, 4, 1)]
+
+    def stored(self):
+        return {month: stored_category_totals(self.user.pk, month, 'expense') for month in self.months}
+
+    def test_months_written_since_a_refresh_are_read_live_until_the_next(self):
+        self.create(Decimal('30.00'), date(2024, 3, 2))
+        self.create(Decimal('20.00'), date(2024, 4, 2))
+        refresh_monthly_totals()
+        self.assertEqual(precomputed_months(self.user.pk, self.months), set(self.months))
+
+        self.create('12.50', '2024-04-15')
+        stored = self.stored()
+        self.assertEqual(precomputed_months(self.user.pk, self.months), {date(2024, 3, 1)})
+        self.assertIsNone(stored[date(2024, 4, 1)])
+
+        refresh_monthly_totals()
+        self.assertEqual(precomputed_months(self.user.pk, self.months), set(self.months))
+        self.assertFalse(StaleMonth.objects.filter(user=self.user).exists())
+        refreshed = self.stored()
+        self.assertEqual(stored[date(2024, 3, 1)], refreshed[date(2024, 3, 1)])
+        self.assertEqual(refreshed[date(2024, 4, 1)][0]['total'], Decimal('32.50'))
+
+
+def sorted_columns(columns):
+    order = np.argsort(columns['id'], kind='stable')
+    return {name: np.asarray(values)[order].tolist() for name, values in columns.items()}
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class ColumnarStoreTests(AnalyticsTestCase):
+    def setUp(self):
+        super().setUp()
+        store = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, store, ignore_errors=True)
+        store_settings = override_settings(ANALYTICS_STORE_DIR=store)
+        store_settings.enable()
+        self.addCleanup(store_settings.disable)
+
+    def meta(self):
+        return columnar._read_meta(columnar._user_dir(self.user.pk))
+
+    def assertMatchesDatabase(self):
+        # Served from the store, not from the database fallback of a stale one
+        self.assertEqual(self.meta()['version'], columnar.get_store_version(self.user.pk))
+        self.assertEqual(
+            sorted_columns(columnar.get_columns(self.user.pk)),
+            sorted_columns(columnar.load_columns_from_db(self.user.pk)),
+        )
+
+    def test_merge_applies_the_latest_record_per_id(self):
+        base = {name: np.array(values, dtype=dtype) for (name, dtype), values in zip(columnar.COLUMNS.items(), (
+            [1, 2, 3], [700000, 700001, 700002], [100, 200, 300], [5, 5, 0], [0, 0, 1], [0, 0, 0],
+        ))}
+        delta = np.array([
+            (1, 700000, 150, 5, 0, 0),
+            (2, 0, 0, 0, 0, columnar.TOMBSTONE),
+            (1, 700003, 175, 6, 0, 1),
+            (4, 700004, 400, 0, 1, 0),
+            (9, 0, 0, 0, 0, columnar.TOMBSTONE),
+        ], dtype=columnar.DELTA_DTYPE)
+
+        merged = sorted_columns(columnar._merge(base, delta))
+
+        self.assertEqual(merged['id'], [1, 3, 4])
+        self.assertEqual(merged['cents'], [175, 300, 400])
+        self.assertEqual(merged['category'], [6, 0, 0])
+        self.assertEqual(merged['status'], [1, 0, 0])
+
+    def test_patches_apply_only_on_top_of_the_previous_version(self):
+        transaction = self.create(Decimal('10.00'), date(2024, 5, 1))
+        columnar.build_store(self.user.pk)
+        version = self.meta()['version']
+        row = {**transaction.get_tracked_state(), 'id': transaction.pk, 'amount': Decimal('12.00')}
+
+        self.assertFalse(columnar.apply_changes(self.user.pk, [row], version + 2))
+        self.assertFalse(columnar.apply_changes(self.user.pk, [row], version))
+        self.assertEqual((self.meta()['version'], self.meta()['delta_rows']), (version, 0))
+
+        self.assertTrue(columnar.apply_changes(self.user.pk, [row], version + 1))
+        self.assertEqual((self.meta()['version'], self.meta()['delta_rows']), (version + 1, 1))
+        directory = columnar._user_dir(self.user.pk)
+        base = columnar._open_base(str(directory / f"base-{self.meta()['generation']}"))
+        self.assertEqual(columnar._merge(base, columnar._load_delta(directory, self.meta()))['cents'].tolist(), [1200])
+
+    def test_store_kept_by_patches_equals_the_database(self):
+        rent = self.create(Decimal('800.00'), date(2024, 4, 1))
+        lunch = self.create(Decimal('9.50'), date(2024, 4, 3))
+        columnar.build_store(self.user.pk)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            rent.amount = Decimal('820.00')
+            rent.transaction_date = '2024-04-02'
+            rent.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            lunch.delete()
+        self.create('4.25', '2024-05-06', transaction_type='income', status='pending')
+
+        self.assertEqual(self.meta()['delta_rows'], 3)
+        self.assertMatchesDatabase()
+
+    def test_compaction_writes_a_new_base_without_the_delta(self):
+        self.create(Decimal('3.00'), date(2024, 4, 1))
+        columnar.build_store(self.user.pk)
+        generation = self.meta()['generation']
+
+        with mock.patch.object(columnar, 'COMPACT_ROWS', 2):
+            for day in (2, 3, 4):
+                self.create(Decimal('3.00'), date(2024, 4, day))
+
+        self.assertNotEqual(self.meta()['generation'], generation)
+        self.assertEqual(self.meta()['delta_rows'], 0)
+        self.assertEqual(self.meta()['rows'], 4)
+        self.assertFalse((columnar._user_dir(self.user.pk) / f'base-{generation}').exists())
+        self.assertMatchesDatabase()
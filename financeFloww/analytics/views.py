@@ -1,14 +1,24 @@
+from django.http import JsonResponse
 from django.shortcuts import render, get_object_or_404
 from django.contrib.auth.decorators import login_required
-from django.db.models import Sum, Count, Q
 from django.utils import timezone
 from datetime import timedelta, date
 from calendar import monthrange
-from .models import FinancialSummary, SavingsGoal, MonthlyReport
-from transactions.models import Transaction, Category
+from dateutil.relativedelta import relativedelta
+from .models import FinancialSummary, SavingsGoal
+from .balances import MAX_SERIES_DAYS, balance_series, parse_day
+from .breakdown import MAX_MATRIX_MONTHS, parse_month, spending_matrix
+from .columnar import category_totals, type_totals
+from .monthly_totals import stored_category_totals
+from .reports import current_month_summary, summarize, trailing_reports
+from .forecasting import get_forecast
+from transactions.choices import get_user_choices
+from transactions.models import Transaction, Category, PaymentMethod
+from transactions.cache import conditional_on_user_data
 
 
 @login_required
+@conditional_on_user_data
 def dashboard(request):
     """Main dashboard"""
     today = timezone.now().date()
@@ -17,22 +27,10 @@ def dashboard(request):
     first_day = today.replace(day=1)
     last_day = today.replace(day=monthrange(today.year, today.month)[1])
     
-    # Monthly stats
-    monthly_income = Transaction.objects.filter(
-        user=request.user,
-        transaction_type='income',
-        transaction_date__gte=first_day,
-        transaction_date__lte=last_day,
-        status='completed'
-    ).aggregate(Sum('amount'))['amount__sum'] or 0
-    
-    monthly_expense = Transaction.objects.filter(
-        user=request.user,
-        transaction_type='expense',
-        transaction_date__gte=first_day,
-        transaction_date__lte=last_day,
-        status='completed'
-    ).aggregate(Sum('amount'))['amount__sum'] or 0
+    # Monthly stats, reduced from the user's columnar store
+    month_totals = type_totals(request.user.pk, first_day, last_day + timedelta(days=1))
+    monthly_income = month_totals['income']
+    monthly_expense = month_totals['expense']
     
     monthly_net = monthly_income - monthly_expense
     
@@ -50,29 +48,9 @@ def dashboard(request):
         status='completed'
     ).order_by('-transaction_date')[:10]
     
-    # Expense breakdown by category
-    expense_by_category = Transaction.objects.filter(
-        user=request.user,
-        transaction_type='expense',
-        transaction_date__gte=first_day,
-        transaction_date__lte=last_day,
-        status='completed'
-    ).values('category__name').annotate(
-        total=Sum('amount'),
-        count=Count('id')
-    ).order_by('-total')[:5]
-    
-    # Income breakdown by category
-    income_by_category = Transaction.objects.filter(
-        user=request.user,
-        transaction_type='income',
-        transaction_date__gte=first_day,
-        transaction_date__lte=last_day,
-        status='completed'
-    ).values('category__name').annotate(
-        total=Sum('amount'),
-        count=Count('id')
-    ).order_by('-total')[:5]
+    # Breakdown by category
+    expense_by_category = category_totals(request.user.pk, first_day, last_day + timedelta(days=1), 'expense')[:5]
+    income_by_category = category_totals(request.user.pk, first_day, last_day + timedelta(days=1), 'income')[:5]
     
     # Budget summary
     from budgets.models import Budget
@@ -80,7 +58,7 @@ def dashboard(request):
     budget_summary = []
     for budget in active_budgets:
         spent = budget.get_spent_amount()
-        percentage = min(budget.percentage, 100)
+        percentage = min(budget.get_percentage_used(), 100)
         budget_summary.append({
             'budget': budget,
             'spent': spent,
@@ -88,11 +66,11 @@ def dashboard(request):
             'is_over': budget.is_over_budget(),
         })
     
-    # Savings goals
+    # Savings goals (progress is maintained from transactions, see analytics.goals)
     savings_goals = SavingsGoal.objects.filter(
         user=request.user,
         status='active'
-    ).order_by('target_date')[:3]
+    ).select_related('category').order_by('target_date')[:3]
     
     # Financial summary
     try:
@@ -109,8 +87,12 @@ def dashboard(request):
     else:
         savings_rate = 0
     
+    # Month-end projection (cached until the user's data changes)
+    forecast = get_forecast(request.user)
+    
     context = {
         'today': today,
+        'forecast': forecast,
         'monthly_income': monthly_income,
         'monthly_expense': monthly_expense,
         'monthly_net': monthly_net,
@@ -127,10 +109,27 @@ def dashboard(request):
 
 
 @login_required
+@conditional_on_user_data
 def spending_breakdown(request):
     """Detailed spending breakdown"""
     today = timezone.now().date()
     
+    # Multi-month comparison: ?start=YYYY-MM&end=YYYY-MM
+    if request.GET.get('start'):
+        start = parse_month(request.GET.get('start'), today.replace(day=1))
+        end = parse_month(request.GET.get('end'), today.replace(day=1))
+        if start > end:
+            start, end = end, start
+        # Longer ranges are cut to their last months, which the page then shows
+        start = max(start, end - relativedelta(months=MAX_MATRIX_MONTHS - 1))
+        
+        context = {
+            'matrix': spending_matrix(request.user, start, end),
+            'start': start,
+            'end': end,
+        }
+        return render(request, 'analytics/spending_comparison.html', context)
+    
     # Default to current month
     year = int(request.GET.get('year', today.year))
     month = int(request.GET.get('month', today.month))
@@ -138,17 +137,11 @@ def spending_breakdown(request):
     first_day = date(year, month, 1)
     last_day = first_day.replace(day=monthrange(year, month)[1])
     
-    # Get all expense categories with amounts
-    categories = Transaction.objects.filter(
-        user=request.user,
-        transaction_type='expense',
-        transaction_date__gte=first_day,
-        transaction_date__lte=last_day,
-        status='completed'
-    ).values('category__name', 'category__id').annotate(
-        total=Sum('amount'),
-        count=Count('id')
-    ).order_by('-total')
+    # Get all expense categories with amounts (archived years included),
+    # precomputed for closed months
+    categories = stored_category_totals(request.user.pk, first_day, 'expense')
+    if categories is None:
+        categories = category_totals(request.user.pk, first_day, last_day + timedelta(days=1), 'expense')
     
     # Calculate percentages
     total_expenses = sum(cat['total'] for cat in categories)
@@ -169,48 +162,22 @@ def spending_breakdown(request):
 
 
 @login_required
+@conditional_on_user_data
 def financial_report(request):
-    """Monthly financial report"""
-    today = timezone.now().date()
-    
-    # Get last 6 months
-    reports = MonthlyReport.objects.filter(
-        user=request.user
-    ).order_by('-month')[:6]
-    
-    # Calculate current month if not in database
-    first_day = today.replace(day=1)
-    last_day = today.replace(day=monthrange(today.year, today.month)[1])
+    """Trailing 12-month financial report with year-over-year comparison"""
+    # Closed months come from stored MonthlyReport rows (gaps are backfilled on demand)
+    trailing = trailing_reports(request.user, months=12)
     
-    current_income = Transaction.objects.filter(
-        user=request.user,
-        transaction_type='income',
-        transaction_date__gte=first_day,
-        transaction_date__lte=last_day,
-        status='completed'
-    ).aggregate(Sum('amount'))['amount__sum'] or 0
-    
-    current_expense = Transaction.objects.filter(
-        user=request.user,
-        transaction_type='expense',
-        transaction_date__gte=first_day,
-        transaction_date__lte=last_day,
-        status='completed'
-    ).aggregate(Sum('amount'))['amount__sum'] or 0
-    
-    current_net = current_income - current_expense
-    
-    if current_income > 0:
-        current_savings_rate = round(((current_income - current_expense) / current_income) * 100, 2)
-    else:
-        current_savings_rate = 0
+    # Only the open month is computed live
+    current = current_month_summary(request.user)
     
     context = {
-        'reports': reports,
-        'current_income': current_income,
-        'current_expense': current_expense,
-        'current_net': current_net,
-        'current_savings_rate': current_savings_rate,
+        'reports': trailing,
+        'summary': summarize(trailing),
+        'current_income': current['income'],
+        'current_expense': current['expense'],
+        'current_net': current['net'],
+        'current_savings_rate': current['savings_rate'],
     }
     return render(request, 'analytics/financial_report.html', context)
 
@@ -218,7 +185,7 @@ def financial_report(request):
 @login_required
 def savings_goals_list(request):
     """List savings goals"""
-    goals = SavingsGoal.objects.filter(user=request.user).order_by('target_date')
+    goals = SavingsGoal.objects.filter(user=request.user).select_related('category').order_by('target_date')
     
     context = {'goals': goals}
     return render(request, 'analytics/savings_goals_list.html', context)
@@ -230,4 +197,39 @@ def savings_goal_detail(request, pk):
     goal = get_object_or_404(SavingsGoal, pk=pk, user=request.user)
     
     context = {'goal': goal}
-    return render(request, 'analytics/savings_goal_detail.html', context)
\ No newline at end of file
+    return render(request, 'analytics/savings_goal_detail.html', context)
+
+@login_required
+@conditional_on_user_data
+def balance_history(request):
+    """Daily balances per payment method and overall, as compact JSON for charts
+
+    Takes ``start`` and ``end`` (YYYY-MM-DD, default the last 90 days) and
+    returns one list of balances per payment method, aligned with the days
+    from start to end.
+    """
+    today = timezone.now().date()
+    end = parse_day(request.GET.get('end'), today)
+    start = parse_day(request.GET.get('start'), end - timedelta(days=89))
+    if start > end or (end - start).days >= MAX_SERIES_DAYS:
+        return JsonResponse({'error': f'Choose a range of at most {MAX_SERIES_DAYS} days.'}, status=400)
+
+    days, series = balance_series(request.user.pk, start, end)
+    names = dict(get_user_choices(request.user.pk)['payment_methods'])
+    missing = [pk for pk in series if pk and pk not in names]
+    if missing:
+        names.update(PaymentMethod.objects.filter(pk__in=missing).values_list('id', 'name'))
+
+    return JsonResponse({
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'series': [
+            {
+                'payment_method': payment_method_id,
+                'name': names.get(payment_method_id, 'Unassigned'),
+                'balances': [float(value) for value in values],
+            }
+            for payment_method_id, values in series.items()
+        ],
+        'total': [float(sum(values)) for values in zip(*series.values())] or [0.0] * len(days),
+    })
@@ -1,14 +1,17 @@
 from django import forms
+
+from transactions.choices import UserChoiceField, category_choices
 from .models import Budget
 
 
 class BudgetForm(forms.ModelForm):
     """Form for creating and editing budgets"""
 
+    category = UserChoiceField(widget=forms.Select(attrs={'class': 'form-select'}))
+
     class Meta:
         model = Budget
         fields = [
-            'category',
             'amount',
             'frequency',
             'start_date',
@@ -18,10 +21,11 @@ class BudgetForm(forms.ModelForm):
             'notes'
         ]
 
-    def __init__(self, user=None, *args, **kwargs):
+    def __init__(self, *args, user=None, **kwargs):
         super().__init__(*args, **kwargs)
+        if self.instance.pk:
+            self.initial.setdefault('category', self.instance.category_id)
 
-        self.fields['category'].widget.attrs.update({'class': 'form-select'})
         self.fields['amount'].widget.attrs.update({
             'class': 'form-control',
             'step': '0.01',
@@ -48,17 +52,14 @@ class BudgetForm(forms.ModelForm):
             'placeholder': 'Budget notes (optional)'
         })
 
-        # Filter categories for the current user
+        # Only the current user's expense categories are valid choices
         if user:
-            from transactions.models import Category
-            self.fields['category'].queryset = Category.objects.filter(
-                user=user,
-                category_type='expense',
-                is_active=True
-            )
+            self.fields['category'].choices = category_choices(user.pk, category_type='expense')
 
     def clean(self):
         cleaned_data = super().clean()
+        if 'category' in cleaned_data:
+            self.instance.category_id = cleaned_data['category']
         start_date = cleaned_data.get('start_date')
         end_date = cleaned_data.get('end_date')
         amount = cleaned_data.get('amount')
@@ -4,7 +4,9 @@ from django.core.validators import MinValueValidator
 from django.utils import timezone
 from dateutil.relativedelta import relativedelta
 
-class Budget(models.Model):
+from transactions.models import RecordedModel
+
+class Budget(RecordedModel):
     """Budget tracking for categories"""
     
     FREQUENCY_CHOICES = [
@@ -38,6 +40,9 @@ class Budget(models.Model):
     
     notes = models.TextField(blank=True, null=True)
 
+    # Fields included in outbox change records
+    OUTBOX_FIELDS = ['category_id', 'amount', 'frequency', 'start_date', 'end_date', 'is_active']
+
     class Meta:
         verbose_name = 'Budget'
         verbose_name_plural = 'Budgets'
@@ -47,11 +52,8 @@ class Budget(models.Model):
     def __str__(self):
         return f"{self.category.name} - {self.amount} ({self.frequency})"
 
-    def get_spent_amount(self):
-        """Calculate total spent in this budget period"""
-        from django.db.models import Sum
-        from transactions.models import Transaction
-        
+    def get_period(self):
+        """First day of the budget period and the first day after it"""
         if self.frequency == 'monthly':
             start = self.start_date.replace(day=1)
             if self.start_date.month == 12:
@@ -65,15 +67,44 @@ class Budget(models.Model):
         else:  # yearly
             start = self.start_date.replace(month=1, day=1)
             end = self.start_date.replace(year=self.start_date.year + 1, month=1, day=1)
+        return start, end
+
+    def is_current_month(self):
+        """Whether this is a monthly budget for the current month, which month-end forecasts apply to"""
+        start, end = self.get_period()
+        return self.frequency == 'monthly' and start <= timezone.localdate() < end
+
+    def get_spent_amount(self):
+        """Calculate total spent in this budget period"""
+        from django.db.models import Sum
+        from transactions.archive import transaction_sources
+        
+        start, end = self.get_period()
+        
+        # Periods that closed before the last refresh are read from the precomputed
+        # monthly totals, which include archived years
+        from analytics.breakdown import month_range
+        from analytics.monthly_totals import monthly_totals, precomputed_months
+        months = month_range(start, end - relativedelta(days=1))
+        if precomputed_months(self.user_id, months) == set(months):
+            return monthly_totals(
+                self.user_id,
+                months,
+                category_id=self.category_id,
+                transaction_type='expense'
+            ).aggregate(total=Sum('total'))['total'] or 0
         
-        spent = Transaction.objects.filter(
-            user=self.user,
-            category=self.category,
-            transaction_type='expense',
-            transaction_date__gte=start,
-            transaction_date__lt=end,
-            status='completed'
-        ).aggregate(total=Sum('amount'))['total'] or 0
+        # Otherwise from the live rows, and the archive if the period reaches back into it
+        spent = 0
+        for model in transaction_sources(self.user_id, start):
+            spent += model.objects.filter(
+                user_id=self.user_id,
+                category_id=self.category_id,
+                transaction_type='expense',
+                transaction_date__gte=start,
+                transaction_date__lt=end,
+                status='completed'
+            ).aggregate(total=Sum('amount'))['total'] or 0
         
         return spent
 
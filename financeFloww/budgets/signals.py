@@ -0,0 +1,28 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from transactions.cache import bump_data_version
+from transactions.outbox import record_instance
+from .models import Budget, BudgetAlert
+
+
+@receiver(post_save, sender=Budget)
+@receiver(post_delete, sender=Budget)
+@receiver(post_save, sender=BudgetAlert)
+@receiver(post_delete, sender=BudgetAlert)
+def bump_user_data_version(sender, instance, **kwargs):
+    """Budgets are part of the data behind the user's cached and conditional pages"""
+    bump_data_version(instance.user_id, dates=())
+
+
+@receiver(post_save, sender=Budget)
+def record_budget_save(sender, instance, created, raw=False, **kwargs):
+    """Append the change to the outbox, in the database transaction of the save"""
+    if not raw:
+        record_instance(instance, created=created)
+
+
+@receiver(post_delete, sender=Budget)
+def record_budget_delete(sender, instance, **kwargs):
+    """Append the delete to the outbox, in the collector's database transaction"""
+    record_instance(instance, deleted=True)
@@ -2,11 +2,14 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.views.decorators.http import require_http_methods
+from analytics.forecasting import get_category_forecasts
+from transactions.cache import conditional_on_user_data
 from .models import Budget, BudgetAlert
 from .forms import BudgetForm, BudgetFilterForm
 
 
 @login_required
+@conditional_on_user_data
 def budget_list(request):
     """List all budgets"""
     budgets = Budget.objects.filter(user=request.user).select_related('category')
@@ -24,9 +27,11 @@ def budget_list(request):
     
     search = request.GET.get('search')
     if search:
-        budgets = budgets.filter(category__name__icontains=search)
+        # Naming the category's owner lets PostgreSQL use its (user, name) trigram index
+        budgets = budgets.filter(category__user=request.user, category__name__icontains=search)
     
     # Calculate spent and percentage for each budget
+    forecasts = get_category_forecasts(request.user)
     budget_details = []
     for budget in budgets:
         spent = budget.get_spent_amount()
@@ -42,6 +47,7 @@ def budget_list(request):
             'percentage': percentage,
             'is_over': is_over,
             'should_alert': should_alert,
+            'forecast': forecasts.get(budget.category_id) if budget.is_current_month() else None,
         })
     
     filter_form = BudgetFilterForm(request.GET)
@@ -98,6 +104,7 @@ def budget_detail(request, pk):
         'percentage': percentage,
         'is_over': is_over,
         'recent_transactions': recent_transactions,
+        'forecast': get_category_forecasts(request.user).get(budget.category_id) if budget.is_current_month() else None,
     }
     return render(request, 'budgets/budget_detail.html', context)
 
@@ -136,7 +143,15 @@ def budget_alerts(request):
     """View budget alerts"""
     alerts = BudgetAlert.objects.filter(user=request.user).select_related('budget').order_by('-triggered_at')
     
-    context = {'alerts': alerts}
+    # Unusual charges flagged by the anomaly detector
+    from transactions.models import Transaction
+    anomalies = Transaction.objects.filter(
+        user=request.user,
+        is_anomaly=True,
+        transaction_type='expense'
+    ).select_related('category').order_by('-transaction_date')[:10]
+    
+    context = {'alerts': alerts, 'anomalies': anomalies}
     return render(request, 'budgets/budget_alerts.html', context)
 
 
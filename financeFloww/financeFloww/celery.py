@@ -0,0 +1,9 @@
+import os
+
+from celery import Celery
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'financeFloww.settings')
+
+# Background work queued by requests; run a worker with `celery -A financeFloww worker`
+app = Celery('financeFloww')
+app.config_from_object('django.conf:settings', namespace='CELERY')
@@ -0,0 +1,378 @@
+import fcntl
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache.backends.base import BaseCache
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.module_loading import import_string
+
+# Seconds between writes of a process's metrics to its file
+FLUSH_INTERVAL = 1.0
+# Other methods are reported as 'other', bounding the number of series
+HTTP_METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+# Distinct cache key families tracked before the rest are counted as 'other'
+MAX_KEY_FAMILIES = 100
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+TASK_BUCKETS = (0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0)
+
+
+class Metric:
+    """A named metric with one value per combination of label values
+
+    Updates only touch a dict in this process. Each process periodically
+    writes its values to a file of its own, and a scrape adds up the files
+    of all processes, so gunicorn workers need no shared memory or server.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def snapshot(self):
+        return [[list(labels), value] for labels, value in self.values.items()]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with _lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """Summed over live processes; values of exited processes are dropped"""
+
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with _lock:
+            self.values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with _lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    """Observations counted per bucket, with their sum; values are [bucket counts..., count, sum]"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with _lock:
+            values = self.values.get(labels)
+            if values is None:
+                values = self.values[labels] = [0] * (len(self.buckets) + 3)
+            # Index len(buckets) is the +Inf bucket
+            values[bisect_left(self.buckets, value)] += 1
+            values[-2] += 1
+            values[-1] += value
+
+
+_lock = threading.Lock()
+REGISTRY = {}
+
+
+def _register(metric):
+    return REGISTRY.setdefault(metric.name, metric)
+
+
+REQUESTS_IN_PROGRESS = _register(Gauge(
+    'http_requests_in_progress', 'Requests being handled'
+))
+REQUEST_DURATION = _register(Histogram(
+    'http_request_duration_seconds', 'Time to produce a response, per view', ('view', 'method', 'status')
+))
+REQUEST_DB_TIME = _register(Histogram(
+    'http_request_db_seconds', 'Time spent in database queries per request', ('view',)
+))
+REQUEST_QUERIES = _register(Histogram(
+    'http_request_queries', 'Database queries per request', ('view',), buckets=QUERY_COUNT_BUCKETS
+))
+CACHE_REQUESTS = _register(Counter(
+    'cache_requests_total', 'Cache lookups per key family, by result', ('family', 'result')
+))
+TASK_DURATION = _register(Histogram(
+    'task_duration_seconds', 'Duration of background tasks', ('task', 'outcome'), buckets=TASK_BUCKETS
+))
+
+
+# Per-process file --------------------------------------------------------
+
+_started = time.time_ns()
+_last_flush = 0.0
+
+
+def metrics_dir():
+    return Path(getattr(settings, 'METRICS_DIR', settings.BASE_DIR / 'var' / 'metrics'))
+
+
+def flush(force=False):
+    """Write this process's metrics to its file, at most every FLUSH_INTERVAL unless forced"""
+    global _last_flush
+    now = time.monotonic()
+    if not force and now - _last_flush < FLUSH_INTERVAL:
+        return
+    _last_flush = now
+
+    with _lock:
+        data = {
+            'pid': os.getpid(),
+            'metrics': {name: metric.snapshot() for name, metric in REGISTRY.items()},
+        }
+    directory = metrics_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f'process-{os.getpid()}-{_started}.json'
+    temporary = path.with_name(path.name + '.tmp')
+    with open(temporary, 'w') as handle:
+        json.dump(data, handle)
+    os.replace(temporary, path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _add(totals, name, labels, value):
+    key = (name, tuple(labels))
+    if isinstance(value, list):
+        current = totals.get(key)
+        totals[key] = value if current is None else [a + b for a, b in zip(current, value)]
+    else:
+        totals[key] = totals.get(key, 0) + value
+
+
+def collect():
+    """Totals of every metric over all processes, as {(name, labels): value}
+
+    Files of exited processes are folded into a single retired file, so
+    counters keep counting across worker restarts without files piling up.
+    """
+    flush(force=True)
+    directory = metrics_dir()
+    retired_path = directory / 'retired.json'
+    totals, retired = {}, {}
+
+    with open(directory / '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(retired_path) as handle:
+                for name, labels, value in json.load(handle):
+                    _add(retired, name, labels, value)
+        except (FileNotFoundError, ValueError):
+            pass
+
+        exited = []
+        for path in directory.glob('process-*.json'):
+            try:
+                with open(path) as handle:
+                    data = json.load(handle)
+            except (FileNotFoundError, ValueError):
+                continue
+            alive = _alive(data['pid'])
+            if not alive:
+                exited.append(path)
+            for name, values in data['metrics'].items():
+                metric = REGISTRY.get(name)
+                if metric is None or (metric.kind == 'gauge' and not alive):
+                    continue
+                for labels, value in values:
+                    _add(totals if alive else retired, name, labels, value)
+
+        if exited:
+            temporary = retired_path.with_name('retired.json.tmp')
+            with open(temporary, 'w') as handle:
+                json.dump([[name, list(labels), value] for (name, labels), value in retired.items()], handle)
+            os.replace(temporary, retired_path)
+            for path in exited:
+                path.unlink(missing_ok=True)
+
+    for (name, labels), value in retired.items():
+        _add(totals, name, labels, value)
+    return totals
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def render_text(totals):
+    """Totals in the Prometheus text exposition format"""
+    by_name = {}
+    for (name, labels), value in sorted(totals.items()):
+        by_name.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name, metric in REGISTRY.items():
+        lines.append(f'# HELP {name} {metric.documentation}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        for labels, value in by_name.get(name, []):
+            if metric.kind != 'histogram':
+                lines.append(f'{name}{_format_labels(metric.labelnames, labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip([*metric.buckets, '+Inf'], value):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(metric.labelnames, labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_count{_format_labels(metric.labelnames, labels)} {value[-2]}')
+            lines.append(f'{name}_sum{_format_labels(metric.labelnames, labels)} {value[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+# Instrumentation ------------------------------------------------------------
+
+@contextmanager
+def timed(task):
+    """Record the duration and outcome of a background task and flush right away"""
+    started = time.perf_counter()
+    outcome = 'failure'
+    try:
+        yield
+        outcome = 'success'
+    finally:
+        TASK_DURATION.observe(time.perf_counter() - started, task, outcome)
+        flush(force=True)
+
+
+_families = set()
+_MISSING = object()
+
+
+def _key_family(key):
+    """The part of a cache key naming what is cached, e.g. 'user-data-version'"""
+    family = str(key).partition(':')[0]
+    if family.startswith('template.cache.'):
+        # template.cache.<fragment name>.<hash of vary_on>
+        family = family.rpartition('.')[0]
+    elif family.startswith('django.contrib.sessions.'):
+        # Followed by the session key
+        family = 'django.contrib.sessions'
+    if family not in _families:
+        if len(_families) >= MAX_KEY_FAMILIES:
+            return 'other'
+        _families.add(family)
+    return family
+
+
+def _instrument_get(original):
+    def get(self, key, default=None, version=None):
+        value = original(self, key, _MISSING, version)
+        hit = value is not _MISSING
+        CACHE_REQUESTS.inc(_key_family(key), 'hit' if hit else 'miss')
+        return value if hit else default
+    get.instrumented = True
+    return get
+
+
+def _instrument_get_many(original):
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        found = original(self, keys, version)
+        for key in keys:
+            CACHE_REQUESTS.inc(_key_family(key), 'hit' if key in found else 'miss')
+        return found
+    get_many.instrumented = True
+    return get_many
+
+
+def install():
+    """Count hits and misses of the configured cache backends"""
+    for config in settings.CACHES.values():
+        backend = import_string(config['BACKEND'])
+        if not getattr(backend.get, 'instrumented', False):
+            backend.get = _instrument_get(backend.get)
+            # The default get_many calls get once per key, which is counted already
+            if backend.get_many is not BaseCache.get_many:
+                backend.get_many = _instrument_get_many(backend.get_many)
+
+
+@contextmanager
+def wrap_queries(wrapper):
+    """Install a query wrapper on the connection to every database, shards included"""
+    with ExitStack() as stack:
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(wrapper))
+        yield
+
+
+class MetricsMiddleware:
+    """Record latency, database time and query count of every request, per view
+
+    Should come first in MIDDLEWARE so the time of all other middleware is
+    included. Costs a few microseconds per request and per query.
+    """
+
+    def __init__(self, get_response):
+        install()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = [0, 0.0]
+
+        def count_query(execute, sql, params, many, context):
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                queries[0] += 1
+                queries[1] += time.perf_counter() - started
+
+        REQUESTS_IN_PROGRESS.inc()
+        started = time.perf_counter()
+        status = 500
+        try:
+            with wrap_queries(count_query):
+                response = self.get_response(request)
+            status = response.status_code
+            return response
+        finally:
+            duration = time.perf_counter() - started
+            REQUESTS_IN_PROGRESS.dec()
+            match = getattr(request, 'resolver_match', None)
+            view = (match.view_name or match._func_path) if match else '<unresolved>'
+            method = request.method if request.method in HTTP_METHODS else 'other'
+            REQUEST_DURATION.observe(duration, view, method, str(status))
+            REQUEST_DB_TIME.observe(queries[1], view)
+            REQUEST_QUERIES.observe(queries[0], view)
+            flush()
+
+
+def metrics_view(request):
+    """Metrics of all worker processes in the Prometheus text format, for staff only"""
+    if not (request.user.is_authenticated and request.user.is_staff):
+        return HttpResponseForbidden()
+    return HttpResponse(render_text(collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
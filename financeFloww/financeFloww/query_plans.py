@@ -0,0 +1,312 @@
+import difflib
+import hashlib
+import random
+import re
+import time
+from contextlib import ExitStack
+from datetime import date, timedelta
+from decimal import Decimal
+
+from dateutil.relativedelta import relativedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test import Client
+from django.test.utils import override_settings
+
+from .sharding import fan_out, shards, user_shard
+
+HOT_PATHS = {}
+# Statements on framework tables (sessions, auth) are not ours to tune
+IGNORED_TABLE_PREFIXES = ('"django_', '"auth_', 'django_', 'auth_')
+# Runs of each statement on backends without EXPLAIN ANALYZE; the fastest counts
+TIMED_RUNS = 3
+# Placeholder lists, e.g. of IN (...), whose length depends on the data
+PLACEHOLDER_LIST = re.compile(r'%s(?:\s*,\s*%s)+')
+
+
+def hot_path(name):
+    """Register a function of (client, user) that runs one of the hot querysets"""
+    def register(function):
+        HOT_PATHS[name] = function
+        return function
+    return register
+
+
+# Hot paths ------------------------------------------------------------------
+
+def _closed_month():
+    return date.today().replace(day=1) - relativedelta(months=2)
+
+
+@hot_path('dashboard')
+def _dashboard(client, user):
+    client.get('/analytics/dashboard/')
+
+
+@hot_path('spending_breakdown')
+def _spending_breakdown(client, user):
+    month = _closed_month()
+    client.get(f'/analytics/spending-breakdown/?year={month.year}&month={month.month}')
+
+
+@hot_path('spending_comparison')
+def _spending_comparison(client, user):
+    end = _closed_month()
+    client.get(f'/analytics/spending-breakdown/?start={end - relativedelta(months=5):%Y-%m}&end={end:%Y-%m}')
+
+
+@hot_path('financial_report')
+def _financial_report(client, user):
+    client.get('/analytics/financial-report/')
+
+
+@hot_path('balance_history')
+def _balance_history(client, user):
+    client.get(f'/analytics/balance-history/?start={date.today() - timedelta(days=89)}')
+
+
+@hot_path('budget_list')
+def _budget_list(client, user):
+    client.get('/budgets/')
+
+
+@hot_path('budget_search')
+def _budget_search(client, user):
+    client.get('/budgets/?search=pense 3')
+
+
+@hot_path('description_suggestions')
+def _description_suggestions(client, user):
+    # Longer than the cached prefixes, so the query runs every time
+    client.get('/transactions/suggestions/?q=eeded 42')
+
+
+@hot_path('budget_alerts')
+def _budget_alerts(client, user):
+    client.get('/budgets/alerts/')
+
+
+@hot_path('transaction_list')
+def _transaction_list(client, user):
+    client.get(f'/transactions/?date_from={date.today() - timedelta(days=30)}&transaction_type=expense')
+
+
+@hot_path('transaction_export')
+def _transaction_export(client, user):
+    response = client.get(f'/transactions/export/?date_from={date.today() - timedelta(days=365)}')
+    b''.join(response.streaming_content)
+
+
+@hot_path('budget_spent_amount')
+def _budget_spent_amount(client, user):
+    from budgets.models import Budget
+    for budget in Budget.objects.filter(user=user).order_by('start_date'):
+        budget.get_spent_amount()
+
+
+# Seeded dataset -------------------------------------------------------------
+
+def seed_dataset(users=3, transactions=20000, seed=0):
+    """Deterministic users with categories, payment methods, transactions and budgets
+
+    Returns the seeded users. The hot paths run as the first; the others
+    make the user filter as selective as it is in production. Each user's
+    rows go to their shard.
+    """
+    from analytics.monthly_totals import refresh_monthly_totals
+    from budgets.models import Budget
+    from transactions.models import Category, PaymentMethod, Transaction
+    from transactions.suggestions import rebuild_suggestions
+
+    generator = random.Random(seed)
+    today = date.today()
+    seeded = []
+    for number in range(users):
+        user = User.objects.create_user(f'query-plan-{seed}-{number}', password=None)
+        seeded.append(user)
+        with user_shard(user.pk):
+            expense = [
+                Category.objects.create(user=user, name=f'Expense {position}', category_type='expense')
+                for position in range(8)
+            ]
+            income = [
+                Category.objects.create(user=user, name=f'Income {position}', category_type='income')
+                for position in range(2)
+            ]
+            methods = [PaymentMethod.objects.create(user=user, name=f'Method {position}') for position in range(3)]
+
+            rows = []
+            for position in range(transactions):
+                is_income = position % 6 == 0
+                rows.append(Transaction(
+                    user=user,
+                    category=generator.choice(income if is_income else expense),
+                    payment_method=generator.choice(methods),
+                    transaction_type='income' if is_income else 'expense',
+                    amount=Decimal(generator.randint(100, 200000)) / 100,
+                    description=f'Seeded {position % 500}',
+                    transaction_date=today - timedelta(days=generator.randint(0, 3 * 365)),
+                    status='pending' if position % 20 == 0 else 'completed',
+                    is_anomaly=position % 97 == 0,
+                ))
+            Transaction.objects.bulk_create(rows, batch_size=2000)
+            rebuild_suggestions(user.pk)
+
+            current_month = today.replace(day=1)
+            Budget.objects.bulk_create([
+                Budget(user=user, category=category, amount=500, frequency='monthly', start_date=month)
+                for category in expense
+                for month in (current_month, current_month - relativedelta(months=2))
+            ])
+
+    for alias, _ in fan_out():
+        with connections[alias].cursor() as cursor:
+            cursor.execute('ANALYZE')
+        refresh_monthly_totals()
+    return seeded
+
+
+# Explaining -----------------------------------------------------------------
+
+def capture_statements(function, *args):
+    """Distinct SELECT statements issued by ``function``, as (sql, parameters of the first run, database)"""
+    statements = {}
+
+    def capture(execute, sql, params, many, context):
+        text = sql.lstrip().upper()
+        if not many and (text.startswith('SELECT') or text.startswith('WITH')) and sql not in statements:
+            if not any(f'FROM {prefix}' in sql for prefix in IGNORED_TABLE_PREFIXES):
+                statements[sql] = (params, context['connection'].alias)
+        return execute(sql, params, many, context)
+
+    with ExitStack() as stack:
+        for alias in {DEFAULT_DB_ALIAS, *shards()}:
+            stack.enter_context(connections[alias].execute_wrapper(capture))
+        function(*args)
+    return [(sql, params, alias) for sql, (params, alias) in statements.items()]
+
+
+def _postgresql_nodes(plan, depth=0):
+    label = plan['Node Type']
+    if plan.get('Index Name'):
+        label += f" using {plan['Index Name']}"
+    if plan.get('Relation Name'):
+        label += f" on {plan['Relation Name']}"
+    nodes = [f"{'  ' * depth}{label}"]
+    for child in plan.get('Plans', []):
+        nodes += _postgresql_nodes(child, depth + 1)
+    return nodes
+
+
+def explain(sql, params, using=DEFAULT_DB_ALIAS):
+    """{'sql', 'nodes', 'cost', 'time'} of one statement; cost is None where not reported"""
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(f'EXPLAIN (ANALYZE, FORMAT JSON) {sql}', params)
+            result = cursor.fetchone()[0]
+            result = result[0] if isinstance(result, list) else result
+            return {
+                'sql': sql,
+                'nodes': _postgresql_nodes(result['Plan']),
+                'cost': result['Plan']['Total Cost'],
+                'time': result['Execution Time'],
+            }
+
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+        depths, nodes = {0: -1}, []
+        for node_id, parent, _, detail in cursor.fetchall():
+            depths[node_id] = depths.get(parent, -1) + 1
+            nodes.append(f"{'  ' * depths[node_id]}{detail}")
+
+        timings = []
+        for _ in range(TIMED_RUNS):
+            started = time.perf_counter()
+            cursor.execute(sql, params)
+            cursor.fetchall()
+            timings.append((time.perf_counter() - started) * 1000)
+        return {'sql': sql, 'nodes': nodes, 'cost': None, 'time': min(timings)}
+
+
+def statement_key(sql):
+    """Hash of a statement with whitespace and placeholder lists normalized
+
+    Keys stay the same when a path issues its statements in another order
+    or adds one, so only changed statements show up in a comparison.
+    """
+    normalized = PLACEHOLDER_LIST.sub('%s, ...', ' '.join(sql.split()))
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:12]
+
+
+def capture_plans(client, user, names=None):
+    """{'<hot path>#<statement key>': plan} for the registered hot paths
+
+    Plans come from EXPLAIN (ANALYZE, FORMAT JSON) on PostgreSQL; other
+    backends give the shape from EXPLAIN QUERY PLAN and the time of the
+    fastest of a few runs, without an estimated cost.
+    """
+    plans = {}
+    for name, function in HOT_PATHS.items():
+        if names and name not in names:
+            continue
+        with user_shard(user.pk):
+            statements = capture_statements(function, client, user)
+        for sql, params, alias in statements:
+            key = f'{name}#{statement_key(sql)}'
+            # Statements differing only in the length of a placeholder list share a plan
+            if key not in plans:
+                plans[key] = explain(sql, params, alias)
+    return plans
+
+
+def run_hot_paths(user, names=None):
+    """Log in as ``user`` and capture the plans of the hot paths
+
+    The user is fresh, so caches are cold and the paths issue every query
+    they can, including the ones that fill those caches.
+    """
+    client = Client()
+    with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+        client.force_login(user)
+        return capture_plans(client, user, names)
+
+
+# Comparing ------------------------------------------------------------------
+
+def compare(baseline, plans, cost_threshold=0.25, time_threshold=1.0, min_time=1.0):
+    """Regressions of ``plans`` against ``baseline`` as (key, [message lines])
+
+    A plan regresses when its shape differs, its estimated cost grew by more
+    than ``cost_threshold`` or its actual time by more than ``time_threshold``
+    (fractions of the baseline) and ``min_time`` milliseconds.
+    """
+    regressions = []
+    for key, plan in plans.items():
+        expected = baseline.get(key)
+        if expected is None:
+            continue
+        lines = []
+        if expected['sql'] != plan['sql']:
+            lines.append('SQL changed:')
+            lines += _diff(expected['sql'].split(' FROM '), plan['sql'].split(' FROM '))
+        if expected['nodes'] != plan['nodes']:
+            lines.append('Plan shape changed:')
+            lines += _diff(expected['nodes'], plan['nodes'])
+        if expected['cost'] and plan['cost'] and plan['cost'] > expected['cost'] * (1 + cost_threshold):
+            lines.append(f"Estimated cost {expected['cost']:.1f} -> {plan['cost']:.1f}")
+        if plan['time'] > expected['time'] * (1 + time_threshold) and plan['time'] - expected['time'] > min_time:
+            lines.append(f"Actual time {expected['time']:.2f} ms -> {plan['time']:.2f} ms")
+        if lines:
+            regressions.append((key, lines))
+
+    for key in baseline.keys() - plans.keys():
+        regressions.append((key, ['No longer issued; update the baseline if that is intended']))
+    return regressions
+
+
+def _diff(before, after):
+    return [
+        f'    {line}'
+        for line in difflib.unified_diff(before, after, 'baseline', 'current', lineterm='', n=2)
+    ]
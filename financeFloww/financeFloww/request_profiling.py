@@ -0,0 +1,182 @@
+import cProfile
+import io
+import json
+import logging
+import pstats
+import re
+import secrets
+import shutil
+import time
+import tracemalloc
+from pathlib import Path
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseForbidden
+from django.urls import reverse
+from django.utils import timezone
+
+from .metrics import wrap_queries
+
+logger = logging.getLogger(__name__)
+
+# Query parameter or header (X-Profile) that turns profiling on for one request
+TRIGGER = 'profile'
+# Profiles kept in the artifacts directory; older ones are removed
+MAX_PROFILES = 50
+FUNCTION_LIMIT = 60
+ALLOCATION_LIMIT = 30
+PROFILE_ID = re.compile(r'^[0-9]{8}-[0-9]{6}-[0-9a-f]{8}$')
+
+
+def profiles_dir():
+    return Path(getattr(settings, 'REQUEST_PROFILING_DIR', settings.BASE_DIR / 'var' / 'profiles'))
+
+
+def _is_triggered(request):
+    # Checked on the raw query string first, so other requests skip parsing it
+    if f'{TRIGGER}=' in request.META.get('QUERY_STRING', ''):
+        return bool(request.GET.get(TRIGGER))
+    return bool(request.META.get('HTTP_X_PROFILE'))
+
+
+class RequestProfile:
+    """cProfile, tracemalloc and SQL timeline of one request"""
+
+    def __init__(self):
+        self.queries = []
+        self.profiler = cProfile.Profile()
+        self._started_tracing = False
+
+    def _record_query(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((started - self.started, time.perf_counter() - started, sql, many))
+
+    def run(self, get_response, request):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        tracemalloc.clear_traces()
+        tracemalloc.reset_peak()
+        self.started = time.perf_counter()
+        try:
+            with wrap_queries(self._record_query):
+                self.profiler.enable()
+                try:
+                    return get_response(request)
+                finally:
+                    self.profiler.disable()
+        finally:
+            self.duration = time.perf_counter() - self.started
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            self.snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, cProfile.__file__),
+                tracemalloc.Filter(False, __file__),
+            ])
+            if self._started_tracing:
+                tracemalloc.stop()
+
+    def report(self, request, response):
+        """Plain-text summary: timings, slowest functions, top allocation sites and the SQL timeline"""
+        output = io.StringIO()
+        sql_time = sum(duration for _, duration, _, _ in self.queries)
+        output.write(f"{request.method} {request.get_full_path()} -> {response.status_code}\n")
+        output.write(f"User {request.user.username}, {timezone.now().isoformat()}\n")
+        output.write(
+            f"Total {self.duration * 1000:.1f} ms, SQL {sql_time * 1000:.1f} ms in {len(self.queries)} queries, "
+            f"peak traced memory {self.peak_memory / 1024:.1f} KiB\n"
+        )
+
+        output.write(f"\n== Functions by cumulative time (top {FUNCTION_LIMIT}) ==\n")
+        stats = pstats.Stats(self.profiler, stream=output)
+        stats.sort_stats('cumulative').print_stats(FUNCTION_LIMIT)
+
+        output.write(f"\n== Allocation sites still held at the end of the request (top {ALLOCATION_LIMIT}) ==\n")
+        for statistic in self.snapshot.statistics('lineno')[:ALLOCATION_LIMIT]:
+            frame = statistic.traceback[0]
+            output.write(
+                f"{statistic.size / 1024:10.1f} KiB {statistic.count:8d} blocks  {frame.filename}:{frame.lineno}\n"
+            )
+
+        output.write("\n== SQL timeline (start ms, duration ms) ==\n")
+        for started, duration, sql, many in self.queries:
+            output.write(f"{started * 1000:9.2f} {duration * 1000:9.2f}  {'[many] ' if many else ''}{sql}\n")
+        return output.getvalue()
+
+    def save(self, request, response):
+        """Write the artifacts to a directory of their own and return its id"""
+        profile_id = f"{timezone.now():%Y%m%d-%H%M%S}-{secrets.token_hex(4)}"
+        directory = profiles_dir() / profile_id
+        directory.mkdir(parents=True)
+        self.profiler.dump_stats(directory / 'profile.prof')
+        (directory / 'report.txt').write_text(self.report(request, response))
+        (directory / 'queries.json').write_text(json.dumps([
+            {'start_ms': started * 1000, 'duration_ms': duration * 1000, 'sql': sql, 'many': many}
+            for started, duration, sql, many in self.queries
+        ], indent=1))
+
+        for old in sorted(path for path in profiles_dir().iterdir() if PROFILE_ID.match(path.name))[:-MAX_PROFILES]:
+            shutil.rmtree(old, ignore_errors=True)
+        return profile_id
+
+
+def _add_link(response, url):
+    response['X-Profile-Report'] = url
+    if response.streaming or not response.get('Content-Type', '').startswith('text/html'):
+        return
+    link = (
+        f'<a href="{url}" style="position:fixed;bottom:8px;right:8px;z-index:9999" '
+        f'class="btn btn-sm btn-dark">Profile report</a>'
+    ).encode()
+    content = response.content
+    position = content.rfind(b'</body>')
+    response.content = content[:position] + link + content[position:] if position != -1 else content + link
+    if response.has_header('Content-Length'):
+        response['Content-Length'] = str(len(response.content))
+
+
+class RequestProfilerMiddleware:
+    """Profile single requests of staff users on demand
+
+    Add ?profile=1 to the URL or send an X-Profile header. The request runs
+    under cProfile and tracemalloc with its queries timed; the artifacts are
+    saved under REQUEST_PROFILING_DIR and the normal response comes back with
+    a link to the report. Other requests only pay for a substring check.
+    The body of a streaming response is produced after this returns, so
+    only the work up to its first byte is profiled.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not _is_triggered(request) or not request.user.is_staff:
+            return self.get_response(request)
+
+        profile = RequestProfile()
+        response = profile.run(self.get_response, request)
+        try:
+            profile_id = profile.save(request, response)
+        except OSError:
+            logger.exception("Could not save the profile of %s", request.path)
+            return response
+        _add_link(response, reverse('profile_report', args=[profile_id]))
+        return response
+
+
+def profile_report(request, profile_id):
+    """A saved profile's text report, or with ?download=1 its cProfile data, for staff only"""
+    if not (request.user.is_authenticated and request.user.is_staff):
+        return HttpResponseForbidden()
+    if not PROFILE_ID.match(profile_id):
+        raise Http404
+    directory = profiles_dir() / profile_id
+    try:
+        if request.GET.get('download'):
+            return FileResponse(open(directory / 'profile.prof', 'rb'), as_attachment=True, filename=f'{profile_id}.prof')
+        return HttpResponse((directory / 'report.txt').read_text(), content_type='text/plain; charset=utf-8')
+    except FileNotFoundError:
+        raise Http404
@@ -52,13 +52,18 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'financeFloww.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'financeFloww.sharding.ShardMiddleware',
+    'financeFloww.request_profiling.RequestProfilerMiddleware',
+    'accounts.middleware.ProfileMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'financeFloww.template_profiling.TemplateProfilerMiddleware',
 ]
 
 ROOT_URLCONF = 'financeFloww.urls'
@@ -67,8 +72,14 @@ TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
-        'APP_DIRS': True,
         'OPTIONS': {
+            # Compiled templates are kept in memory; in DEBUG they are reloaded when the files change
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -102,6 +113,24 @@ DATABASES = {
     }
 }
 
+# Per-user data (transactions, budgets, analytics) lives on one of these databases, by
+# user (see financeFloww.sharding); everything else stays on 'default'. Map each alias
+# in DATABASES to a number that is never reused. Several SQLite files work locally:
+#   DATABASES['shard_1'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'shard_1.sqlite3'}
+#   SHARDS = {'default': 0, 'shard_1': 1}
+# and run migrate once per alias with --database.
+SHARDS = {'default': 0}
+DATABASE_ROUTERS = ['financeFloww.sharding.ShardRouter']
+
+# Sessions are read from the shared default cache and written through to the database
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+# Keep flash messages in a cookie so redirects don't write the session
+MESSAGE_STORAGE = 'django.contrib.messages.storage.cookie.CookieStorage'
+
+# The session's user is loaded from cache together with their profile
+AUTHENTICATION_BACKENDS = ['accounts.backends.CachedModelBackend']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -155,6 +184,56 @@ LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'dashboard'
 LOGOUT_REDIRECT_URL = 'home'
 
+# Caches
+# The default cache holds sessions, cached users, user shards and the per-user data
+# versions behind ETags and cached analytics, so it must be shared by every worker
+# process and management command; a per-process cache would keep serving what
+# another process already invalidated.
+# {% cache %} fragments use their own cache, so thousands of rendered transaction
+# rows don't evict the entries in the default one. Their keys carry the versions
+# they depend on, so a per-process cache is safe for them.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/1',
+    },
+    'template_fragments': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'template-fragments',
+        'OPTIONS': {'MAX_ENTRIES': 50000},
+    },
+}
+
+# Celery runs deletion jobs and other work queued by requests (see financeFloww.celery).
+# Tasks are acknowledged after they finish, so a job whose worker dies is redelivered.
+CELERY_BROKER_URL = 'redis://127.0.0.1:6379/0'
+# Modules defining tasks, loaded by workers
+CELERY_IMPORTS = ['accounts.deletion', 'analytics.columnar']
+CELERY_TASK_ACKS_LATE = True
+CELERY_TASK_REJECT_ON_WORKER_LOST = True
+
+# Per-user memory-mapped column files behind the analytics views (see analytics.columnar);
+# must be on a local disk shared by all worker processes of a host
+ANALYTICS_STORE_DIR = BASE_DIR / 'var' / 'analytics'
+
+# Per-process metric files merged by the staff-only /metrics/ endpoint (see financeFloww.metrics);
+# shared by all worker processes of a host
+METRICS_DIR = BASE_DIR / 'var' / 'metrics'
+
+# Reports of requests profiled on demand by staff with ?profile=1 (see financeFloww.request_profiling)
+REQUEST_PROFILING_DIR = BASE_DIR / 'var' / 'profiles'
+
+# Consumers of the transaction, budget and savings goal change feed (see transactions.outbox),
+# run by consume_outbox: name -> dotted path of a function taking a list of OutboxEvents, e.g.
+#   OUTBOX_CONSUMERS = {'search-index': 'search.consumers.index_transactions'}
+OUTBOX_CONSUMERS = {
+    # Previous descriptions offered while entering a transaction
+    'description-suggestions': 'transactions.suggestions.apply_events',
+}
+
+# Log per-template render times and send them in a Server-Timing header
+TEMPLATE_PROFILING = DEBUG
+
 # Crispy Forms
 CRISPY_ALLOWED_TEMPLATE_PACKS = "bootstrap5"
 CRISPY_TEMPLATE_PACK = "bootstrap5"
@@ -0,0 +1,493 @@
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections, transaction as db_transaction
+from django.db.models import Count, Q
+from django.http import HttpResponse
+from django.utils import timezone
+
+from accounts.models import UserShard
+
+logger = logging.getLogger(__name__)
+
+# Apps whose rows all belong to one user and live on that user's shard;
+# every other app lives on the directory (default) database
+SHARDED_APPS = {'transactions', 'budgets', 'analytics'}
+DIRECTORY = DEFAULT_DB_ALIAS
+# Ids of shard number n start above n * ID_RANGE, so rows keep their id when moved
+ID_RANGE = 10 ** 15
+
+SHARD_CACHE_KEY = 'user-shard:{user_id}'
+# Longest a process can keep using a user's old shard after a move; moves wait this long
+SHARD_CACHE_TIMEOUT = 60
+
+# Per-user tables, parents before children; rebalancing copies every one of them.
+# Outbox events stay behind and are consumed on the shard they were written to.
+MOVED_MODELS = [
+    'transactions.Category',
+    'transactions.PaymentMethod',
+    'transactions.Transaction',
+    'transactions.ArchivedTransaction',
+    'transactions.ArchivedYear',
+    'transactions.DescriptionSuggestion',
+    'transactions.CategoryStats',
+    'budgets.Budget',
+    'budgets.BudgetAlert',
+    'analytics.FinancialSummary',
+    'analytics.SpendingTrend',
+    'analytics.SavingsGoal',
+    'analytics.MonthlyReport',
+    'analytics.BalanceCheckpoint',
+    'analytics.StaleMonth',
+    'analytics.StoreVersion',
+]
+MOVE_BATCH_SIZE = 2000
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+
+
+class ShardingError(Exception):
+    """Per-user data was queried without knowing whose shard to use"""
+
+
+class UserMovingError(ShardingError):
+    """A user's data was written while it is being moved to another shard"""
+
+
+def shards():
+    """{database alias: shard number} of the databases holding per-user data
+
+    Numbers fix each shard's id range, so they must never be reused, and
+    a shard is only removed from SHARDS once it has been drained.
+    """
+    return getattr(settings, 'SHARDS', {DEFAULT_DB_ALIAS: 0})
+
+
+# Shard map -------------------------------------------------------------------
+
+def lookup(user_id):
+    """(shard, moving) of a user, from cache when possible"""
+    key = SHARD_CACHE_KEY.format(user_id=user_id)
+    entry = cache.get(key)
+    if entry is None:
+        entry = UserShard.objects.filter(user_id=user_id).values_list('shard', 'moving').first() or (DIRECTORY, False)
+        cache.set(key, tuple(entry), SHARD_CACHE_TIMEOUT)
+    return tuple(entry)
+
+
+def shard_for(user_id):
+    """Alias of the database holding the user's financial data"""
+    configured = shards()
+    if len(configured) == 1:
+        return next(iter(configured))
+    return lookup(user_id)[0]
+
+
+def _set_entry(user_id, shard, moving=False):
+    UserShard.objects.update_or_create(user_id=user_id, defaults={'shard': shard, 'moving': moving})
+    cache.set(SHARD_CACHE_KEY.format(user_id=user_id), (shard, moving), SHARD_CACHE_TIMEOUT)
+
+
+def place_user(user_id):
+    """Put a new user on the shard with the fewest users and return it"""
+    counts = dict.fromkeys(shards(), 0)
+    for row in UserShard.objects.filter(shard__in=counts).values('shard').annotate(users=Count('pk')):
+        counts[row['shard']] = row['users']
+    shard = min(counts, key=lambda alias: (counts[alias], shards()[alias]))
+    _set_entry(user_id, shard)
+    return shard
+
+
+def moving_users(alias):
+    """Ids of the users whose data is being moved away from ``alias``"""
+    return list(UserShard.objects.filter(shard=alias, moving=True).values_list('user_id', flat=True))
+
+
+def forget_user(user_id):
+    cache.delete(SHARD_CACHE_KEY.format(user_id=user_id))
+
+
+def mirror_user(user, alias=None):
+    """Copy a user row from the directory to a shard, so foreign keys there resolve
+
+    The copy has an unusable password; logins are always checked against
+    the directory.
+    """
+    alias = alias or shard_for(user.pk)
+    if alias == DIRECTORY:
+        return
+    copy = User(**{field.attname: getattr(user, field.attname) for field in User._meta.concrete_fields})
+    copy.password = make_password(None)
+    User.objects.using(alias).bulk_create(
+        [copy],
+        update_conflicts=True,
+        unique_fields=['id'],
+        update_fields=[field.name for field in User._meta.concrete_fields if not field.primary_key],
+    )
+
+
+def reserve_id_range(alias):
+    """Move the id sequences of the per-user tables on a shard to the start of its range"""
+    number = shards().get(alias)
+    if not number:
+        return
+    start = number * ID_RANGE
+    connection = connections[alias]
+    with connection.cursor() as cursor:
+        for model in apps.get_models():
+            if model._meta.app_label not in SHARDED_APPS or not model._meta.managed:
+                continue
+            if model._meta.pk.get_internal_type() not in ('AutoField', 'BigAutoField'):
+                continue
+            table = model._meta.db_table
+            if connection.vendor == 'postgresql':
+                cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [table, model._meta.pk.column])
+                sequence = cursor.fetchone()[0]
+                cursor.execute(
+                    f'SELECT setval(%s, %s) WHERE (SELECT last_value FROM {sequence}) < %s',
+                    [sequence, start, start],
+                )
+            elif connection.vendor == 'sqlite':
+                cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s AND seq < %s', [start, table, start])
+                cursor.execute(
+                    'INSERT INTO sqlite_sequence (name, seq) SELECT %s, %s '
+                    'WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = %s)',
+                    [table, start, table],
+                )
+            else:
+                raise ShardingError(f"Id ranges are not supported on {connection.vendor}")
+
+
+# Selecting a shard -------------------------------------------------------------
+
+_selected = ContextVar('shard', default=None)
+_request = ContextVar('shard_request', default=None)
+_selected_user = ContextVar('shard_user', default=None)
+
+
+def current_shard():
+    """Shard of the work in progress: one selected explicitly, else the requesting user's"""
+    alias = _selected.get()
+    if alias is not None:
+        return alias
+    configured = shards()
+    if len(configured) == 1:
+        return next(iter(configured))
+    request = _request.get()
+    if request is not None and request.user.is_authenticated:
+        return shard_for(request.user.pk)
+    raise ShardingError("No shard selected; run per-user work inside user_shard() or use_shard()")
+
+
+@contextmanager
+def use_shard(alias):
+    """Route unhinted per-user queries to ``alias`` inside the block"""
+    token = _selected.set(alias)
+    try:
+        yield alias
+    finally:
+        _selected.reset(token)
+
+
+@contextmanager
+def user_shard(user_id):
+    """Route unhinted per-user queries to the shard of ``user_id`` inside the block"""
+    token = _selected_user.set(user_id)
+    try:
+        with use_shard(shard_for(user_id)) as alias:
+            yield alias
+    finally:
+        _selected_user.reset(token)
+
+
+def group_by_shard(user_ids):
+    """{shard: [user ids]} for a batch of users"""
+    groups = {}
+    for user_id in user_ids:
+        groups.setdefault(shard_for(user_id), []).append(user_id)
+    return groups
+
+
+def fan_out(user_ids=None, writing=False):
+    """Yield (shard, user ids on it), with that shard selected while the caller handles it
+
+    Without ``user_ids`` every shard is yielded with None, for jobs that
+    cover all users, e.g. ``for shard, _ in fan_out(): ...``. Jobs that
+    write pass ``writing=True`` to leave out users being moved; the next
+    run picks them up.
+    """
+    if writing and user_ids is not None and len(shards()) > 1:
+        user_ids = [user_id for user_id in user_ids if not lookup(user_id)[1]]
+    groups = group_by_shard(user_ids) if user_ids is not None else dict.fromkeys(shards())
+    for alias, ids in groups.items():
+        with use_shard(alias):
+            yield alias, ids
+
+
+def for_each_shard(function, *args, **kwargs):
+    """{shard: result} of calling ``function`` once per shard with that shard selected"""
+    return {alias: function(*args, **kwargs) for alias, _ in fan_out()}
+
+
+def _writing_user(instance):
+    if isinstance(instance, User):
+        return instance.pk
+    if instance is not None and getattr(instance, 'user_id', None) is not None:
+        return instance.user_id
+    return _selected_user.get()
+
+
+class ShardRouter:
+    """Send each user's rows to their shard and everything else to the directory
+
+    Instances go where they were loaded from, or to their user's shard when
+    new, so related lookups stay on one database. Queries without an
+    instance use current_shard(). Every database gets the full schema, and
+    users are mirrored to the shard of their data so foreign keys and joins
+    to auth_user work there.
+
+    Outside requests, which ShardMiddleware turns away, writes of a user
+    being moved raise UserMovingError; that covers management commands,
+    Celery tasks and threads. The user is the instance's, or the one
+    selected with user_shard(). The move itself writes with explicit
+    databases and raw SQL, so it is not routed.
+    """
+
+    def _db(self, model, **hints):
+        if model._meta.app_label not in SHARDED_APPS:
+            return None
+        configured = shards()
+        if len(configured) == 1:
+            return next(iter(configured))
+        instance = hints.get('instance')
+        if isinstance(instance, User):
+            return shard_for(instance.pk)
+        if instance is not None:
+            if instance._state.db is not None and instance._meta.app_label in SHARDED_APPS:
+                return instance._state.db
+            if getattr(instance, 'user_id', None) is not None:
+                return shard_for(instance.user_id)
+        return current_shard()
+
+    db_for_read = _db
+
+    def db_for_write(self, model, **hints):
+        alias = self._db(model, **hints)
+        if alias is not None and len(shards()) > 1 and _request.get() is None:
+            user_id = _writing_user(hints.get('instance'))
+            if user_id is not None and lookup(user_id)[1]:
+                raise UserMovingError(f"User {user_id} is being moved to another shard; retry once the move finishes")
+        return alias
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if isinstance(obj1, User) or isinstance(obj2, User):
+            return True
+        if obj1._state.db and obj2._state.db:
+            return obj1._state.db == obj2._state.db
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return None
+
+
+def _streamed(request, content):
+    # Streaming bodies are produced after the middleware returns
+    token = _request.set(request)
+    try:
+        yield from content
+    finally:
+        _request.reset(token)
+
+
+class ShardMiddleware:
+    """Route a request's per-user queries to the shard of the requesting user
+
+    The user is only resolved when a query needs it. Writes of a user whose
+    data is being moved are refused with 503 until the move finishes.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if len(shards()) > 1 and request.method not in SAFE_METHODS and request.user.is_authenticated:
+            if lookup(request.user.pk)[1]:
+                response = HttpResponse("Your data is being moved, please try again in a minute.", status=503)
+                response['Retry-After'] = str(SHARD_CACHE_TIMEOUT)
+                return response
+
+        token = _request.set(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            _request.reset(token)
+        if response.streaming:
+            response.streaming_content = _streamed(request, response.streaming_content)
+        return response
+
+
+# Rebalancing -------------------------------------------------------------------
+
+def user_loads():
+    """{shard: {user id: transactions}} over the hot and archive tables of every shard"""
+    Transaction = apps.get_model('transactions', 'Transaction')
+    ArchivedTransaction = apps.get_model('transactions', 'ArchivedTransaction')
+
+    def count():
+        loads = {}
+        for model in (Transaction, ArchivedTransaction):
+            for user_id, rows in model.objects.values_list('user_id').annotate(rows=Count('pk')).order_by():
+                loads[user_id] = loads.get(user_id, 0) + rows
+        return loads
+
+    loads = for_each_shard(count)
+    # Rows left behind on a shard the user does not live on are not load
+    return {alias: {user_id: rows for user_id, rows in users.items() if shard_for(user_id) == alias}
+            for alias, users in loads.items()}
+
+
+def users_on(alias):
+    """Ids of the users whose data lives on ``alias``"""
+    users = User.objects.filter(shard__shard=alias)
+    if alias == DIRECTORY:
+        users = User.objects.filter(Q(shard__isnull=True) | Q(shard__shard=alias))
+    return list(users.order_by('pk').values_list('pk', flat=True))
+
+
+def plan_rebalance(loads, tolerance=0.1, max_moves=None):
+    """[(user id, source, target)] evening out the transactions per shard
+
+    Repeatedly moves, from the fullest to the emptiest shard, the user that
+    best halves the gap between them, until the gap is within ``tolerance``
+    of the average load.
+    """
+    loads = {alias: dict(users) for alias, users in loads.items()}
+    totals = {alias: sum(users.values()) for alias, users in loads.items()}
+    average = sum(totals.values()) / len(totals) if totals else 0
+    moves = []
+    while totals and (max_moves is None or len(moves) < max_moves):
+        source = max(totals, key=totals.get)
+        target = min(totals, key=totals.get)
+        gap = totals[source] - totals[target]
+        if gap <= tolerance * average:
+            break
+        candidates = [(abs(gap / 2 - rows), user_id, rows) for user_id, rows in loads[source].items() if 0 < rows < gap]
+        if not candidates:
+            break
+        _, user_id, rows = min(candidates)
+        moves.append((user_id, source, target))
+        loads[target][user_id] = loads[source].pop(user_id)
+        totals[source] -= rows
+        totals[target] += rows
+    return moves
+
+
+def _copy_rows(model, user_id, source, target):
+    """Insert a user's rows into another database unchanged, ids and timestamps included
+
+    SQLite moves its AUTOINCREMENT counter past copied ids, so there ids of
+    different shards may meet; PostgreSQL sequences are not affected.
+    """
+    connection = connections[target]
+    quote = connection.ops.quote_name
+    fields = model._meta.concrete_fields
+    sql = (
+        f'INSERT INTO {quote(model._meta.db_table)} ({", ".join(quote(field.column) for field in fields)}) '
+        f'VALUES ({", ".join(["%s"] * len(fields))})'
+    )
+    rows = model._base_manager.using(source).filter(user_id=user_id).order_by('pk').values_list(
+        *[field.attname for field in fields]
+    )
+    batch, copied = [], 0
+    with connection.cursor() as cursor:
+        for row in rows.iterator(chunk_size=MOVE_BATCH_SIZE):
+            batch.append([field.get_db_prep_save(value, connection) for field, value in zip(fields, row)])
+            if len(batch) >= MOVE_BATCH_SIZE:
+                cursor.executemany(sql, batch)
+                copied += len(batch)
+                batch = []
+        if batch:
+            cursor.executemany(sql, batch)
+            copied += len(batch)
+    return copied
+
+
+def _delete_rows(user_id, alias, mirror=True):
+    """Remove a user's rows from a shard, children first, without signals"""
+    with db_transaction.atomic(using=alias):
+        for label in reversed(MOVED_MODELS):
+            rows = apps.get_model(label)._base_manager.using(alias).filter(user_id=user_id)
+            rows._raw_delete(alias)
+        if mirror and alias != DIRECTORY:
+            User.objects.using(alias).filter(pk=user_id)._raw_delete(alias)
+
+
+def _mark_months_stale(user_id, alias):
+    # The target's precomputed monthly totals do not include the user yet
+    StaleMonth = apps.get_model('analytics', 'StaleMonth')
+    now = timezone.now()
+    months = set()
+    for label in ('transactions.Transaction', 'transactions.ArchivedTransaction'):
+        model = apps.get_model(label)
+        months.update(model._base_manager.using(alias).filter(user_id=user_id).dates('transaction_date', 'month'))
+    StaleMonth._base_manager.using(alias).bulk_create(
+        [StaleMonth(user_id=user_id, month=month, marked_at=now) for month in months],
+        update_conflicts=True,
+        unique_fields=['user', 'month'],
+        update_fields=['marked_at'],
+    )
+
+
+def _copy_user(user_id, source, target):
+    mirror_user(User.objects.get(pk=user_id), target)
+    with db_transaction.atomic(using=target):
+        # Left behind by an earlier move away from this shard that did not finish
+        _delete_rows(user_id, target, mirror=False)
+        for label in MOVED_MODELS:
+            model = apps.get_model(label)
+            copied = _copy_rows(model, user_id, source, target)
+            expected = model._base_manager.using(source).filter(user_id=user_id).count()
+            if copied != expected:
+                raise ShardingError(f"{label} of user {user_id}: copied {copied} of {expected} rows")
+        _mark_months_stale(user_id, target)
+
+
+def move_users(moves, settle=SHARD_CACHE_TIMEOUT, progress=None):
+    """Move users' data between shards; ``moves`` is [(user id, source, target)]
+
+    The users' writes are refused first, and after ``settle`` seconds every
+    process has seen that. Their rows are then copied with their ids and
+    the shard map is switched; after another ``settle`` no process reads
+    the old copies any more and they are removed. A user whose copy fails
+    stays where they were. ``progress`` is called with each finished move.
+    Returns the moves done and the (move, error) pairs of those that failed.
+    """
+    for user_id, source, target in moves:
+        _set_entry(user_id, source, moving=True)
+    time.sleep(settle)
+
+    moved, failed = [], []
+    for user_id, source, target in moves:
+        try:
+            _copy_user(user_id, source, target)
+        except Exception as error:
+            logger.exception("Moving user %s from %s to %s failed", user_id, source, target)
+            _set_entry(user_id, source)
+            failed.append(((user_id, source, target), error))
+            continue
+        _set_entry(user_id, target)
+        moved.append((user_id, source, target))
+
+    if moved:
+        time.sleep(settle)
+    for move in moved:
+        _delete_rows(move[0], move[1])
+        if progress:
+            progress(move)
+    return moved, failed
@@ -0,0 +1,126 @@
+import logging
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.template.base import Template
+from django.template.loader_tags import BLOCK_CONTEXT_KEY, BlockNode
+
+logger = logging.getLogger(__name__)
+
+# Templates reported in the Server-Timing header, slowest first
+SERVER_TIMING_LIMIT = 10
+
+_active_profile = ContextVar('template_profile', default=None)
+_original_render = None
+_original_block_render = None
+
+
+class TemplateProfile:
+    """Render time per template for one request
+
+    Every template, whether rendered directly, extended or included, and
+    every block is timed. ``total`` includes nested templates and blocks,
+    ``own`` excludes them.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self._stack = []
+
+    def enter(self, name):
+        self._stack.append([name, time.perf_counter(), 0.0])
+
+    def exit(self):
+        name, started, nested = self._stack.pop()
+        elapsed = time.perf_counter() - started
+        stats = self.stats.setdefault(name, {'name': name, 'count': 0, 'total': 0.0, 'own': 0.0})
+        stats['count'] += 1
+        stats['total'] += elapsed
+        stats['own'] += elapsed - nested
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    def summary(self):
+        return sorted(self.stats.values(), key=lambda stats: stats['own'], reverse=True)
+
+
+def _template_name(template):
+    return template.origin.template_name or template.origin.name or '<string>'
+
+
+def _profiled_render(self, context):
+    profile = _active_profile.get()
+    if profile is None:
+        return _original_render(self, context)
+    profile.enter(_template_name(self))
+    try:
+        return _original_render(self, context)
+    finally:
+        profile.exit()
+
+
+def _profiled_block_render(self, context):
+    profile = _active_profile.get()
+    if profile is None:
+        return _original_block_render(self, context)
+    # Attribute the block to the template whose version of it is rendered,
+    # rather than to the parent template that declares it
+    block_context = context.render_context.get(BLOCK_CONTEXT_KEY)
+    block = (block_context.get_block(self.name) if block_context else None) or self
+    profile.enter(f'{_template_name(block)}#{self.name}')
+    try:
+        return _original_block_render(self, context)
+    finally:
+        profile.exit()
+
+
+def install():
+    """Time every template render and {% block %}
+
+    Direct renders, {% extends %} and {% include %} all go through
+    Template._render; blocks are timed separately so a child template's
+    content is not counted against the base template it extends.
+    """
+    global _original_render, _original_block_render
+    if _original_render is None:
+        _original_render = Template._render
+        _original_block_render = BlockNode.render
+        Template._render = _profiled_render
+        BlockNode.render = _profiled_block_render
+
+
+class TemplateProfilerMiddleware:
+    """Attribute template render time to individual templates and includes
+
+    Enabled by the TEMPLATE_PROFILING setting. Results are logged and sent in
+    a Server-Timing header, so they show up in the browser's network panel.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'TEMPLATE_PROFILING', False):
+            raise MiddlewareNotUsed
+        install()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        profile = TemplateProfile()
+        token = _active_profile.set(profile)
+        try:
+            response = self.get_response(request)
+        finally:
+            _active_profile.reset(token)
+
+        summary = profile.summary()
+        if summary:
+            for stats in summary:
+                logger.debug(
+                    "%s %s: %d renders, %.2f ms own, %.2f ms total",
+                    request.path, stats['name'], stats['count'], stats['own'] * 1000, stats['total'] * 1000
+                )
+            response['Server-Timing'] = ', '.join(
+                f'tpl{position};desc="{stats["name"]} x{stats["count"]}";dur={stats["own"] * 1000:.2f}'
+                for position, stats in enumerate(summary[:SERVER_TIMING_LIMIT])
+            )
+        return response
@@ -0,0 +1,118 @@
+import shutil
+import tempfile
+from datetime import date
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test import TransactionTestCase, override_settings
+
+from accounts.models import UserShard
+from transactions.models import Category, Transaction
+from .sharding import ID_RANGE, UserMovingError, _set_entry, move_users, shard_for, user_shard
+
+SHARD_ALIASES = ('test_shard_1', 'test_shard_2')
+
+
+class TwoShardTests(TransactionTestCase):
+    """Routing, user copies and moves over two SQLite shards, with the directory on default"""
+
+    # The shards are added in setUpClass, so they are not named here; the
+    # test runner checks the databases it is given exist before that
+    databases = '__all__'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.shard_dir = tempfile.mkdtemp()
+        for alias in SHARD_ALIASES:
+            connections.settings[alias] = connections.configure_settings({
+                DEFAULT_DB_ALIAS: connections.settings[DEFAULT_DB_ALIAS],
+                alias: {'ENGINE': 'django.db.backends.sqlite3', 'NAME': f'{cls.shard_dir}/{alias}.sqlite3'},
+            })[alias]
+        cls.shard_settings = override_settings(
+            SHARDS={alias: number for number, alias in enumerate(SHARD_ALIASES, start=1)},
+            CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+            CELERY_TASK_ALWAYS_EAGER=True,
+        )
+        cls.shard_settings.enable()
+        for alias in SHARD_ALIASES:
+            call_command('migrate', database=alias, verbosity=0)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.shard_settings.disable()
+        for alias in SHARD_ALIASES:
+            connections[alias].close()
+            del connections[alias]
+            del connections.settings[alias]
+        shutil.rmtree(cls.shard_dir)
+
+    def create_user(self, username):
+        user = User.objects.create_user(username, f'{username}@example.com', 'secret')
+        with user_shard(user.pk):
+            category = Category.objects.create(user=user, name='Food', category_type='expense')
+            Transaction.objects.create(
+                user=user, category=category, transaction_type='expense', amount=Decimal('12.50'),
+                description='Groceries', transaction_date=date(2024, 5, 1),
+            )
+        return user
+
+    def test_new_users_are_spread_over_the_shards(self):
+        first, second = self.create_user('first'), self.create_user('second')
+        self.assertEqual({shard_for(first.pk), shard_for(second.pk)}, set(SHARD_ALIASES))
+        for user in (first, second):
+            alias = shard_for(user.pk)
+            other = next(shard for shard in SHARD_ALIASES if shard != alias)
+            self.assertTrue(Transaction.objects.using(alias).filter(user_id=user.pk).exists())
+            self.assertFalse(Transaction.objects.using(other).filter(user_id=user.pk).exists())
+            # Ids come from the shard's own range
+            number = SHARD_ALIASES.index(alias) + 1
+            self.assertGreater(Transaction.objects.using(alias).get(user_id=user.pk).pk, number * ID_RANGE)
+            with user_shard(user.pk):
+                self.assertEqual(Transaction.objects.filter(user=user).count(), 1)
+
+    def test_users_are_copied_to_their_shard_without_password(self):
+        user = self.create_user('copied')
+        copy = User.objects.using(shard_for(user.pk)).get(pk=user.pk)
+        self.assertEqual(copy.username, 'copied')
+        self.assertFalse(copy.has_usable_password())
+        self.assertTrue(User.objects.get(pk=user.pk).check_password('secret'))
+
+        user.email = 'changed@example.com'
+        user.save()
+        self.assertEqual(User.objects.using(shard_for(user.pk)).get(pk=user.pk).email, 'changed@example.com')
+
+    def test_move_users_keeps_ids_and_clears_the_source(self):
+        user = self.create_user('mover')
+        source = shard_for(user.pk)
+        target = next(shard for shard in SHARD_ALIASES if shard != source)
+        ids = list(Transaction.objects.using(source).filter(user_id=user.pk).values_list('pk', flat=True))
+
+        moved, failed = move_users([(user.pk, source, target)], settle=0)
+
+        self.assertEqual((moved, failed), ([(user.pk, source, target)], []))
+        self.assertEqual(shard_for(user.pk), target)
+        self.assertEqual(UserShard.objects.get(user_id=user.pk).shard, target)
+        self.assertEqual(list(Transaction.objects.using(target).filter(user_id=user.pk).values_list('pk', flat=True)), ids)
+        self.assertFalse(Transaction.objects.using(source).filter(user_id=user.pk).exists())
+        self.assertFalse(User.objects.using(source).filter(pk=user.pk).exists())
+        with user_shard(user.pk):
+            self.assertEqual(Transaction.objects.get(user=user).category.name, 'Food')
+
+    def test_writes_of_a_moving_user_are_refused_outside_requests(self):
+        user = self.create_user('blocked')
+        alias = shard_for(user.pk)
+        _set_entry(user.pk, alias, moving=True)
+        with user_shard(user.pk):
+            with self.assertRaises(UserMovingError):
+                Category.objects.create(user=user, name='Rent', category_type='expense')
+            with self.assertRaises(UserMovingError):
+                Transaction.objects.filter(user=user).update(description='Changed')
+            # Reads carry on from the old copy
+            self.assertEqual(Transaction.objects.filter(user=user).count(), 1)
+        _set_entry(user.pk, alias)
+        with user_shard(user.pk):
+            Category.objects.create(user=user, name='Rent', category_type='expense')
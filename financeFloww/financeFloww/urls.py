@@ -19,6 +19,9 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 
+from .metrics import metrics_view
+from .request_profiling import profile_report
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api-auth/', include('rest_framework.urls')),
@@ -26,6 +29,8 @@ urlpatterns = [
     path('transactions/', include('transactions.urls')),
     path('budgets/', include('budgets.urls')),
     path('analytics/', include('analytics.urls')),
+    path('metrics/', metrics_view, name='metrics'),
+    path('profiles/<str:profile_id>/', profile_report, name='profile_report'),
 ]
 
 if settings.DEBUG:
@@ -0,0 +1,357 @@
+from collections import Counter, defaultdict
+
+import numpy as np
+from django.db import connections, router
+from django.db.models import Q
+
+from .models import CategoryStats, Transaction
+
+# Scores follow the modified z-score: 0.6745 * (x - median) / MAD
+MAD_SCALE = 0.6745
+# Fallback scale when MAD is 0, from the mean absolute deviation
+MEAN_AD_SCALE = 0.7979
+ANOMALY_THRESHOLD = 3.5
+MIN_GROUP_SIZE = 8
+# Share of a group's members that may change before its median and deviations are sampled again
+RESAMPLE_SHARE = 0.1
+# Fields that move a transaction between scoring groups or change its score
+SCORED_FIELDS = ('category_id', 'transaction_type', 'amount', 'status')
+# CategoryStats fields written by the helpers below
+STATS_FIELDS = ['count', 'median', 'mad', 'mean_deviation', 'sample_count', 'changes_since_sample']
+
+
+def _group_medians(groups, values, group_count):
+    """Median of values per group id, for all groups at once"""
+    order = np.lexsort((values, groups))
+    sorted_values = values[order]
+    counts = np.bincount(groups, minlength=group_count)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    lower = sorted_values[starts + (counts - 1) // 2]
+    upper = sorted_values[starts + counts // 2]
+    return (lower + upper) / 2, counts
+
+
+def _group_stats(groups, amounts, group_count):
+    """(medians, MADs, mean absolute deviations, counts) per group id"""
+    medians, counts = _group_medians(groups, amounts, group_count)
+    deviations = np.abs(amounts - medians[groups])
+    mads, _ = _group_medians(groups, deviations, group_count)
+    mean_deviations = np.bincount(groups, weights=deviations, minlength=group_count) / counts
+    return medians, mads, mean_deviations, counts
+
+
+def _modified_z(amounts, medians, mads, mean_deviations):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = np.where(
+            mads > 0,
+            MAD_SCALE * (amounts - medians) / mads,
+            MEAN_AD_SCALE * (amounts - medians) / mean_deviations,
+        )
+    return np.where(np.isfinite(scores), scores, 0.0)
+
+
+def robust_scores(group_keys, amounts):
+    """Modified z-score of every amount against its group's median and MAD
+
+    Groups with fewer than MIN_GROUP_SIZE members get a NaN score.
+    """
+    amounts = np.asarray(amounts, dtype=float)
+    if amounts.size == 0:
+        return amounts
+
+    _, groups = np.unique(np.asarray(group_keys), axis=0, return_inverse=True)
+    groups = groups.ravel()
+    medians, mads, mean_deviations, counts = _group_stats(groups, amounts, groups.max() + 1)
+    scores = _modified_z(amounts, medians[groups], mads[groups], mean_deviations[groups])
+    return np.where(counts[groups] >= MIN_GROUP_SIZE, scores, np.nan)
+
+
+def _flags(scores):
+    return np.nan_to_num(scores, nan=0.0) > ANOMALY_THRESHOLD
+
+
+def _write_scores(changed, batch_size):
+    """Store (pk, score, flag) triples with one CASE UPDATE per batch
+
+    bulk_update builds a When() expression per row and field, which costs far
+    more than the statement itself once whole categories are re-scored.
+    """
+    connection = connections[router.db_for_write(Transaction)]
+    table = connection.ops.quote_name(Transaction._meta.db_table)
+    # Each row takes five parameters: two per CASE and one in the IN list
+    batch_size = min(batch_size, connection.ops.bulk_batch_size(['id'] * 5, changed) or batch_size)
+    with connection.cursor() as cursor:
+        for start in range(0, len(changed), batch_size):
+            batch = changed[start:start + batch_size]
+            whens = ' '.join(['WHEN %s THEN %s'] * len(batch))
+            placeholders = ', '.join(['%s'] * len(batch))
+            params = [value for pk, score, flag in batch for value in (pk, score)]
+            params += [value for pk, score, flag in batch for value in (pk, flag)]
+            params += [pk for pk, score, flag in batch]
+            cursor.execute(
+                f'UPDATE {table} SET '
+                f'"anomaly_score" = CAST(CASE "id" {whens} END AS DOUBLE PRECISION), '
+                f'"is_anomaly" = CASE "id" {whens} END '
+                f'WHERE "id" IN ({placeholders})',
+                params,
+            )
+
+
+def detect_anomalies(user_ids, batch_size=1000, categories=None):
+    """Score every completed transaction of the given users and store changed flags
+
+    Loads all rows in one pass and scores them vectorized per (user, category, type),
+    and rebuilds the users' category stats from the same rows. ``categories``
+    limits both to those category ids. Returns the number of updated
+    transactions.
+    """
+    transactions = Transaction.objects.filter(user_id__in=user_ids)
+    if categories is not None:
+        transactions = transactions.filter(category_id__in=categories)
+    rows = list(transactions.filter(
+        status='completed'
+    ).order_by().values_list(
+        'id', 'user_id', 'category_id', 'transaction_type', 'amount', 'anomaly_score', 'is_anomaly'
+    ))
+
+    changed = []
+    keys, amounts = np.empty((0, 3)), np.empty(0)
+    if rows:
+        ids, user_column, category_column, type_column, amounts, stored_scores, stored_flags = zip(*rows)
+        keys = np.column_stack((
+            user_column,
+            [category_id or 0 for category_id in category_column],
+            [transaction_type == 'income' for transaction_type in type_column],
+        ))
+        amounts = np.array([float(amount) for amount in amounts])
+        scores = robust_scores(keys, amounts)
+        flags = _flags(scores)
+
+        for position, pk in enumerate(ids):
+            score = None if np.isnan(scores[position]) else round(float(scores[position]), 3)
+            flag = bool(flags[position])
+            if score != stored_scores[position] or flag != stored_flags[position]:
+                changed.append((pk, score, flag))
+
+        _write_scores(changed, batch_size)
+    _rebuild_stats(user_ids, keys, amounts, categories)
+
+    # Pending and cancelled transactions are not charges yet
+    cleared = transactions.filter(
+        is_anomaly=True
+    ).exclude(status='completed').update(is_anomaly=False, anomaly_score=None)
+
+    return len(changed) + cleared
+
+
+def _stats_group(state):
+    """(category key, transaction type) of a tracked state, or None if it is not scored"""
+    if state is None or state['status'] != 'completed':
+        return None
+    return state['category_id'] or 0, state['transaction_type']
+
+
+def _groups_filter(groups, prefix=''):
+    matching = Q()
+    for category_key, transaction_type in groups:
+        matching |= Q(**{f'{prefix}category_key': category_key, f'{prefix}transaction_type': transaction_type})
+    return matching
+
+
+def _sample_groups(user_id, groups):
+    """{group: (count, median, MAD, mean absolute deviation)} from the groups' completed transactions"""
+    keys = {category_key for category_key, _ in groups}
+    categories = Q(category_id__in=keys - {0})
+    if 0 in keys:
+        categories |= Q(category_id__isnull=True)
+    amounts = defaultdict(list)
+    for category_id, transaction_type, amount in Transaction.objects.filter(
+        categories,
+        user_id=user_id,
+        transaction_type__in={transaction_type for _, transaction_type in groups},
+        status='completed'
+    ).order_by().values_list('category_id', 'transaction_type', 'amount'):
+        amounts[category_id or 0, transaction_type].append(float(amount))
+
+    samples = {}
+    for group in groups:
+        values = np.array(amounts.get(group, []))
+        if values.size:
+            medians, mads, mean_deviations, _ = _group_stats(np.zeros(values.size, dtype=int), values, 1)
+            samples[group] = (int(values.size), float(medians[0]), float(mads[0]), float(mean_deviations[0]))
+        else:
+            samples[group] = (0, 0.0, 0.0, 0.0)
+    return samples
+
+
+def _set_sample(row, sample):
+    row.count, row.median, row.mad, row.mean_deviation = sample
+    row.sample_count, row.changes_since_sample = row.count, 0
+
+
+def _needs_sample(row):
+    """Whether a group is scored but its sample is missing or too many writes old"""
+    return row.count >= MIN_GROUP_SIZE and (
+        row.sample_count < MIN_GROUP_SIZE or row.changes_since_sample > row.sample_count * RESAMPLE_SHARE
+    )
+
+
+def _seed_stats(user_id, groups):
+    """Create the stats rows of groups that have none, from their completed transactions"""
+    rows = []
+    for group, sample in _sample_groups(user_id, groups).items():
+        row = CategoryStats(user_id=user_id, category_key=group[0], transaction_type=group[1])
+        _set_sample(row, sample)
+        rows.append(row)
+    # A concurrent first write to the same group keeps its row; the next detect_anomalies pass evens them out
+    CategoryStats.objects.bulk_create(rows, ignore_conflicts=True)
+    return {(row.category_key, row.transaction_type): row for row in rows}
+
+
+def apply_stats_changes(user_id, changes):
+    """Fold the (previous, current) tracked states of a write into the user's stats
+
+    Counts follow every write. The median and deviations are sampled again
+    from the group's transactions once more than RESAMPLE_SHARE of its
+    members changed since they were taken, so each write reads a bounded
+    number of rows on average. Runs in the write's database transaction and
+    locks the affected rows. A group without a row yet is seeded from its
+    transactions, which already include the write. Returns
+    {(category key, type): CategoryStats} of the affected groups.
+    """
+    counts, changed = Counter(), Counter()
+    for previous, current in changes:
+        old_group, new_group = _stats_group(previous), _stats_group(current)
+        if old_group == new_group:
+            if old_group is not None and previous['amount'] != current['amount']:
+                changed[old_group] += 1
+            continue
+        if old_group is not None:
+            counts[old_group] -= 1
+            changed[old_group] += 1
+        if new_group is not None:
+            counts[new_group] += 1
+            changed[new_group] += 1
+    groups = set(changed)
+    if not groups:
+        return {}
+
+    stats = {
+        (row.category_key, row.transaction_type): row
+        for row in CategoryStats.objects.select_for_update().filter(
+            _groups_filter(groups), user_id=user_id
+        ).order_by('category_key', 'transaction_type')
+    }
+    for group, row in stats.items():
+        row.count += counts[group]
+        row.changes_since_sample += changed[group]
+    resampled = [group for group, row in stats.items() if _needs_sample(row)]
+    if resampled:
+        for group, sample in _sample_groups(user_id, resampled).items():
+            _set_sample(stats[group], sample)
+    CategoryStats.objects.bulk_update(stats.values(), STATS_FIELDS)
+
+    missing = groups - stats.keys()
+    if missing:
+        stats.update(_seed_stats(user_id, missing))
+    return stats
+
+
+def forget_stats(user_id, categories=None):
+    """Drop the user's stats, or those of some category ids, after writes they cannot follow
+
+    Groups are re-seeded on their next use.
+    """
+    stats = CategoryStats.objects.filter(user_id=user_id)
+    if categories is not None:
+        stats = stats.filter(category_key__in=categories)
+    stats.delete()
+
+
+def _rebuild_stats(user_ids, keys, amounts, categories=None):
+    """Replace the users' stats (of ``categories`` only, if given) with exact ones from the loaded rows"""
+    rows = []
+    if amounts.size:
+        unique, groups = np.unique(keys, axis=0, return_inverse=True)
+        groups = groups.ravel()
+        for (user_id, category_key, is_income), *sample in zip(unique, *_group_stats(groups, amounts, len(unique))):
+            median, mad, mean_deviation, count = (float(value) for value in sample)
+            row = CategoryStats(
+                user_id=int(user_id),
+                category_key=int(category_key),
+                transaction_type='income' if is_income else 'expense',
+            )
+            _set_sample(row, (int(count), median, mad, mean_deviation))
+            rows.append(row)
+
+    CategoryStats.objects.bulk_create(
+        rows,
+        batch_size=1000,
+        update_conflicts=True,
+        unique_fields=['user', 'category_key', 'transaction_type'],
+        update_fields=STATS_FIELDS,
+    )
+    wanted = {(row.user_id, row.category_key, row.transaction_type) for row in rows}
+    stored = CategoryStats.objects.filter(user_id__in=user_ids)
+    if categories is not None:
+        stored = stored.filter(category_key__in=categories)
+    stale = [
+        pk for pk, *group in stored.values_list(
+            'id', 'user_id', 'category_key', 'transaction_type'
+        )
+        if tuple(group) not in wanted
+    ]
+    CategoryStats.objects.filter(pk__in=stale).delete()
+
+
+def score_against_stats(amount, stats):
+    """Modified z-score of one amount against its group's sampled median and deviations
+
+    The same score detect_anomalies gives, against a sample at most
+    RESAMPLE_SHARE of the group's members old, so both are compared with
+    ANOMALY_THRESHOLD.
+    """
+    if stats is None or stats.count < MIN_GROUP_SIZE or stats.sample_count < MIN_GROUP_SIZE:
+        return None
+    score = _modified_z(*np.array([amount, stats.median, stats.mad, stats.mean_deviation], dtype=float))
+    return round(float(score), 3)
+
+
+def score_changes(user_id, changes, batch_size=1000):
+    """Fold a bulk write into the user's stats and score only its new and re-valued rows
+
+    ``changes`` are (previous, current) tracked states with 'id'. Other rows
+    of the affected groups keep their scores until the next detect_anomalies
+    pass. Returns the number of scored rows.
+    """
+    changes = list(changes)
+    stats = apply_stats_changes(user_id, changes)
+    scored = []
+    for previous, current in changes:
+        if current is None or (previous and all(previous[field] == current[field] for field in SCORED_FIELDS)):
+            continue
+        group = _stats_group(current)
+        score = None if group is None else score_against_stats(current['amount'], stats.get(group))
+        scored.append((current['id'], score, score is not None and score > ANOMALY_THRESHOLD))
+    _write_scores(scored, batch_size)
+    return len(scored)
+
+
+def score_transaction(transaction, stats):
+    """Score a single new or edited transaction against its group's maintained statistics
+
+    ``stats`` is what apply_stats_changes returned for the write, so no
+    history is read beyond the occasional resample. The next detect_anomalies
+    pass replaces the score with one against the group's current members.
+    """
+    score = None
+    if transaction.status == 'completed':
+        score = score_against_stats(
+            transaction.amount, stats.get((transaction.category_id or 0, transaction.transaction_type))
+        )
+
+    is_anomaly = score is not None and score > ANOMALY_THRESHOLD
+    Transaction.objects.filter(pk=transaction.pk).update(anomaly_score=score, is_anomaly=is_anomaly)
+    transaction.anomaly_score = score
+    transaction.is_anomaly = is_anomaly
+    return score
@@ -0,0 +1,83 @@
+from rest_framework import serializers
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from .choices import category_choices
+from .filters import filter_transactions
+from .forms import FILTER_REQUIRED_ACTIONS, TransactionFilterForm, narrowing_filters
+from .ingest import INGEST_MAX_ITEMS, ingest_transactions
+from .models import Transaction
+from .operations import BULK_ACTIONS, apply_bulk_action
+
+
+class BulkActionSerializer(serializers.Serializer):
+    """Action to apply to a list of transaction ids or to every transaction matching filters"""
+
+    action = serializers.ChoiceField(choices=BULK_ACTIONS)
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False)
+    filters = serializers.DictField(child=serializers.CharField(allow_blank=True), required=False)
+    category = serializers.IntegerField(required=False, allow_null=True)
+
+    def validate_filters(self, filters):
+        """The transaction list's filters, checked with its form; returns only those that narrow the list"""
+        form = TransactionFilterForm(filters, user=self.context['request'].user)
+        unknown = sorted(set(filters) - set(form.fields))
+        if unknown:
+            raise serializers.ValidationError(f"Unknown filters: {', '.join(unknown)}")
+        if not form.is_valid():
+            raise serializers.ValidationError(form.errors)
+        return narrowing_filters(form)
+
+    def validate(self, data):
+        if not data.get('ids') and 'filters' not in data:
+            raise serializers.ValidationError("Provide either ids or filters")
+        if not data.get('ids') and not data['filters'] and data['action'] in FILTER_REQUIRED_ACTIONS:
+            raise serializers.ValidationError({'filters': "Provide at least one filter"})
+        if data['action'] == 'categorize':
+            user = self.context['request'].user
+            if data.get('category') not in dict(category_choices(user.pk)):
+                raise serializers.ValidationError({'category': "Choose one of your active categories"})
+        return data
+
+
+class TransactionBulkActionView(APIView):
+    """POST {"action": ..., "ids": [...]} or {"action": ..., "filters": {...}}"""
+
+    def post(self, request):
+        serializer = BulkActionSerializer(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        transactions = Transaction.objects.filter(user=request.user)
+        if data.get('ids'):
+            transactions = transactions.filter(pk__in=data['ids'])
+        else:
+            transactions = filter_transactions(transactions, data['filters'])
+
+        count = apply_bulk_action(request.user, transactions, data['action'], category_id=data.get('category'))
+        return Response({'action': data['action'], 'count': count})
+
+
+class IngestSerializer(serializers.Serializer):
+    """A batch of transactions; the items themselves are validated by transactions.ingest"""
+
+    transactions = serializers.ListField(allow_empty=False, max_length=INGEST_MAX_ITEMS)
+
+
+class TransactionIngestView(APIView):
+    """POST {"transactions": [{"idempotency_key": ..., "amount": ..., ...}, ...]}
+
+    Answers with one result per item, in order: its status ('created',
+    'exists', 'duplicate' or 'invalid') and the transaction id or the errors.
+    Sending the same batch again is safe.
+    """
+
+    def post(self, request):
+        serializer = IngestSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        results = ingest_transactions(request.user, serializer.validated_data['transactions'])
+        counts = {}
+        for result in results:
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+        return Response({'counts': counts, 'results': results})
@@ -0,0 +1,137 @@
+from datetime import date
+
+from django.db import connections, transaction as db_transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from financeFloww.metrics import timed
+from financeFloww.sharding import shard_for
+from .anomalies import detect_anomalies
+from .cache import bump_data_version
+from .models import ArchivedTransaction, ArchivedYear, Transaction
+from .outbox import append, change_event
+
+# Rows moved per database transaction
+ARCHIVE_BATCH_SIZE = 5000
+# The current and previous year always stay in the hot table
+KEEP_YEARS = 2
+
+
+def archive_horizon(user_id):
+    """First day after the user's latest archived year, or None if nothing is archived
+
+    Only date ranges starting before the horizon need to read the archive.
+    Read from ArchivedYear on every call, an index-only lookup on its
+    (user, year) key, so every process sees a year as soon as it is
+    registered or restored.
+    """
+    year = ArchivedYear.objects.filter(user_id=user_id).aggregate(year=Max('year'))['year']
+    return date(year + 1, 1, 1) if year else None
+
+
+def transaction_sources(user_id, start=None):
+    """Models holding the user's transactions from ``start`` on (None: all time)
+
+    Reads over the returned models combine into the user's full history;
+    the archive is only included when the range reaches back into it.
+    """
+    horizon = archive_horizon(user_id)
+    if horizon is None or (start is not None and start >= horizon):
+        return [Transaction]
+    return [Transaction, ArchivedTransaction]
+
+
+def archivable_years(user_id, keep_years=KEEP_YEARS, today=None):
+    """Closed years that still have rows in the hot table"""
+    today = today or date.today()
+    return [
+        value.year
+        for value in Transaction.objects.filter(
+            user_id=user_id,
+            transaction_date__lt=date(today.year - keep_years + 1, 1, 1),
+        ).dates('transaction_date', 'year')
+    ]
+
+
+def _move_rows(source, target, user_id, year, batch_size, extra):
+    """Move a user's rows of one year between the hot and archive tables, in batches
+
+    Each batch is one INSERT ... SELECT and one DELETE, so rows keep their id
+    and timestamps exactly. ``extra`` gives values for target columns the
+    source does not have. Rows leave or enter the transactions of the
+    outbox feed, so each batch appends a delete (archiving) or create
+    (restoring) event per row in its database transaction.
+    """
+    alias = shard_for(user_id)
+    connection = connections[alias]
+    quote = connection.ops.quote_name
+    columns = [source._meta.get_field(name).column for name in ArchivedTransaction.COPIED_FIELDS]
+    target_columns = ', '.join(quote(column) for column in [*columns, *extra])
+    source_columns = ', '.join([quote(column) for column in columns] + ['%s'] * len(extra))
+    rows = source.objects.using(alias).filter(
+        user_id=user_id,
+        transaction_date__gte=date(year, 1, 1),
+        transaction_date__lt=date(year + 1, 1, 1),
+    ).order_by('pk').values('id', *Transaction.TRACKED_FIELDS)
+    archiving = target is ArchivedTransaction
+
+    moved = 0
+    while True:
+        with db_transaction.atomic(using=alias):
+            states = list(rows[:batch_size])
+            if not states:
+                return moved
+            ids = [state.pop('id') for state in states]
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'INSERT INTO {quote(target._meta.db_table)} ({target_columns}) '
+                    f'SELECT {source_columns} FROM {quote(source._meta.db_table)} '
+                    f'WHERE {quote("id")} IN ({", ".join(["%s"] * len(ids))})',
+                    [*extra.values(), *ids],
+                )
+            chunk = source.objects.using(alias).filter(pk__in=ids)
+            chunk._raw_delete(chunk.db)
+            append([
+                change_event(user_id, Transaction, pk, *((state, None) if archiving else (None, state)))
+                for pk, state in zip(ids, states)
+            ], using=alias)
+        moved += len(ids)
+
+
+@timed('archive_year')
+def archive_year(user_id, year, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move one closed year of a user's transactions into the archive table
+
+    Monthly rollups for the year should exist first; the archive command
+    builds any that are missing. Rows are moved in batches, each in its own
+    transaction, so the move can be interrupted and simply run again.
+    """
+    # Register the year first, so reads include the archive while rows move
+    archived, _ = ArchivedYear.objects.get_or_create(user_id=user_id, year=year)
+
+    connection = connections[shard_for(user_id)]
+    archived_at = connection.ops.adapt_datetimefield_value(timezone.now())
+    moved = _move_rows(Transaction, ArchivedTransaction, user_id, year, batch_size, {'archived_at': archived_at})
+    with db_transaction.atomic(using=connection.alias):
+        archived.transaction_count = ArchivedTransaction.objects.filter(
+            user_id=user_id,
+            transaction_date__gte=date(year, 1, 1),
+            transaction_date__lt=date(year + 1, 1, 1),
+        ).count()
+        archived.save()
+        bump_data_version(user_id)
+    return moved
+
+
+@timed('restore_year')
+def restore_year(user_id, year, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move one archived year back into the hot table and re-score the user"""
+    moved = _move_rows(
+        ArchivedTransaction, Transaction, user_id, year, batch_size, {'anomaly_score': None, 'is_anomaly': False}
+    )
+    with db_transaction.atomic(using=shard_for(user_id)):
+        ArchivedYear.objects.filter(user_id=user_id, year=year).delete()
+        bump_data_version(user_id)
+    if moved:
+        detect_anomalies([user_id])
+    return moved
@@ -0,0 +1,109 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.cache import cache
+from django.db import transaction as db_transaction
+from django.utils import timezone
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+
+from financeFloww.sharding import shard_for
+
+DATA_VERSION_KEY = 'user-data-version:{user_id}'
+CATALOG_VERSION_KEY = 'user-catalog-version:{user_id}'
+CLOSED_MONTHS_VERSION_KEY = 'user-closed-months-version:{user_id}'
+SUGGESTIONS_VERSION_KEY = 'user-suggestions-version:{user_id}'
+
+
+def _get_version(key):
+    version = cache.get(key)
+    if version is None:
+        # Nothing cached (first use or evicted), so start a fresh version
+        version = time.time_ns()
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+def _bump_version(key, user_id):
+    db_transaction.on_commit(lambda: cache.set(key, time.time_ns(), None), using=shard_for(user_id))
+
+
+def get_data_version(user_id):
+    """Return a marker that changes whenever the user's financial data changes"""
+    return _get_version(DATA_VERSION_KEY.format(user_id=user_id))
+
+
+def bump_data_version(user_id, dates=None):
+    """Invalidate everything cached under the user's current data version once the write commits
+
+    ``dates`` are the transaction dates the write touched, if known (empty
+    for writes to other data, e.g. budgets). Unless all of them are in the
+    current month or later, the closed-months version is bumped as well.
+    """
+    _bump_version(DATA_VERSION_KEY.format(user_id=user_id), user_id)
+    if dates is None or touches_closed_month(dates):
+        _bump_version(CLOSED_MONTHS_VERSION_KEY.format(user_id=user_id), user_id)
+
+
+def touches_closed_month(dates):
+    current_month = timezone.localdate().replace(day=1)
+    return any(day < current_month for day in dates)
+
+
+def get_closed_months_version(user_id):
+    """Return a marker that changes whenever transactions of the user's past months may have changed"""
+    return _get_version(CLOSED_MONTHS_VERSION_KEY.format(user_id=user_id))
+
+
+def get_catalog_version(user_id):
+    """Return a marker that changes whenever the user's categories or payment methods change"""
+    return _get_version(CATALOG_VERSION_KEY.format(user_id=user_id))
+
+
+def bump_catalog_version(user_id):
+    """Invalidate cached category and payment method lookups once the write commits"""
+    _bump_version(CATALOG_VERSION_KEY.format(user_id=user_id), user_id)
+
+
+def get_suggestions_version(user_id):
+    """Return a marker that changes whenever the user's description suggestions are rebuilt"""
+    return _get_version(SUGGESTIONS_VERSION_KEY.format(user_id=user_id))
+
+
+def bump_suggestions_version(user_id):
+    """Invalidate cached description suggestions once the rebuild commits"""
+    _bump_version(SUGGESTIONS_VERSION_KEY.format(user_id=user_id), user_id)
+
+
+def user_data_etag(request, *args, **kwargs):
+    """ETag for a page that only depends on the user's data, their profile, today's date and the URL
+
+    Computed from cached markers without touching the database. Returns None,
+    which disables conditional handling, for anonymous users and while a flash
+    message is waiting to be shown.
+    """
+    if not request.user.is_authenticated or CookieStorage.cookie_name in request.COOKIES:
+        return None
+    profile = request.profile
+    parts = [
+        request.user.pk,
+        get_data_version(request.user.pk),
+        profile.updated_at.isoformat() if profile else '',
+        timezone.localdate().isoformat(),
+        request.get_full_path(),
+        # Cached pages embed a CSRF token, which must match the current cookie
+        request.COOKIES.get(settings.CSRF_COOKIE_NAME, ''),
+    ]
+    return hashlib.md5('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def conditional_on_user_data(view):
+    """Answer repeat GETs with 304 Not Modified while the user's data is unchanged
+
+    The view itself, and all of its queries, only run when the ETag differs.
+    Browsers are told to revalidate on every use rather than serve a stale copy.
+    """
+    return cache_control(private=True, no_cache=True)(condition(etag_func=user_data_etag)(view))
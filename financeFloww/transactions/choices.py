@@ -0,0 +1,64 @@
+from django import forms
+from django.core.cache import cache
+
+from accounts.models import DeletionJob
+from .cache import get_catalog_version
+from .models import Category, PaymentMethod
+
+CHOICES_CACHE_KEY = 'user-choices:{user_id}:{version}'
+CHOICES_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def get_user_choices(user_id):
+    """Active categories and payment methods of a user, cached until either changes
+
+    Categories being deleted are left out. Returns
+    {'categories': [(id, name, category_type)], 'payment_methods': [(id, name)]}.
+    """
+    key = CHOICES_CACHE_KEY.format(user_id=user_id, version=get_catalog_version(user_id))
+    choices = cache.get(key)
+    if choices is None:
+        # Deletion jobs are on the directory database, the categories on the user's shard
+        deleting = list(DeletionJob.objects.filter(
+            user_id=user_id,
+            target_type='category'
+        ).exclude(status='completed').values_list('target_id', flat=True))
+        choices = {
+            'categories': list(Category.objects.filter(
+                user_id=user_id,
+                is_active=True
+            ).exclude(pk__in=deleting).order_by('category_type', 'name').values_list('id', 'name', 'category_type')),
+            'payment_methods': list(PaymentMethod.objects.filter(
+                user_id=user_id,
+                is_active=True
+            ).order_by('name').values_list('id', 'name')),
+        }
+        cache.set(key, choices, CHOICES_CACHE_TIMEOUT)
+    return choices
+
+
+def category_choices(user_id, category_type=None):
+    """(id, name) choices for the user's active categories, optionally of one type"""
+    return [
+        (pk, name)
+        for pk, name, type_ in get_user_choices(user_id)['categories']
+        if category_type is None or type_ == category_type
+    ]
+
+
+def payment_method_choices(user_id):
+    """(id, name) choices for the user's active payment methods"""
+    return list(get_user_choices(user_id)['payment_methods'])
+
+
+class UserChoiceField(forms.TypedChoiceField):
+    """Choice of one of the user's own objects, cleaned to its id without a database lookup
+
+    Used in place of ModelChoiceField; the form sets ``choices`` from the
+    per-user cache and assigns the cleaned id to the model's ``<field>_id``.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('coerce', int)
+        kwargs.setdefault('empty_value', None)
+        super().__init__(**kwargs)
@@ -0,0 +1,61 @@
+from django.db.models import Count
+
+from .models import Transaction
+
+LOOKUP_BATCH_SIZE = 500
+
+
+def find_duplicates(transaction):
+    """Existing rows with the same fingerprint as a new or edited transaction
+
+    A lookup on the (user, fingerprint) index, never a scan of the user's history.
+    """
+    fingerprint = transaction.compute_fingerprint()
+    return Transaction.objects.filter(
+        user_id=transaction.user_id,
+        fingerprint=fingerprint
+    ).exclude(pk=transaction.pk)
+
+
+def existing_fingerprints(user_id, fingerprints):
+    """The subset of fingerprints the user already has, in a handful of indexed lookups"""
+    fingerprints = list(fingerprints)
+    found = set()
+    for start in range(0, len(fingerprints), LOOKUP_BATCH_SIZE):
+        found.update(Transaction.objects.filter(
+            user_id=user_id,
+            fingerprint__in=fingerprints[start:start + LOOKUP_BATCH_SIZE]
+        ).values_list('fingerprint', flat=True))
+    return found
+
+
+def split_duplicates(user_id, transactions):
+    """Split unsaved transactions of one user into (new, duplicates) before a bulk insert
+
+    Rows repeated within the batch are caught by an in-memory set; the rest
+    are checked against the database with batched index lookups. Fingerprints
+    are set on every row so bulk_create stores them.
+    """
+    for transaction in transactions:
+        transaction.fingerprint = transaction.compute_fingerprint()
+
+    stored = existing_fingerprints(user_id, {transaction.fingerprint for transaction in transactions})
+    seen = set()
+    new, duplicates = [], []
+    for transaction in transactions:
+        if transaction.fingerprint in stored or transaction.fingerprint in seen:
+            duplicates.append(transaction)
+        else:
+            seen.add(transaction.fingerprint)
+            new.append(transaction)
+    return new, duplicates
+
+
+def duplicate_groups(users=None):
+    """Fingerprints that occur more than once per user, with their row counts"""
+    transactions = Transaction.objects.exclude(fingerprint='')
+    if users is not None:
+        transactions = transactions.filter(user__in=users)
+    return transactions.values('user_id', 'fingerprint').annotate(
+        count=Count('id')
+    ).filter(count__gt=1).order_by('user_id', '-count')
@@ -0,0 +1,58 @@
+from django.utils.dateparse import parse_date
+
+from .archive import transaction_sources
+from .models import ArchivedTransaction
+
+
+def filter_transactions(transactions, params):
+    """Apply the transaction list's filter parameters to a queryset
+
+    Shared by the list page and by bulk actions that target "everything
+    matching the current filter".
+    """
+    transaction_type = params.get('transaction_type', 'all')
+    if transaction_type in ('income', 'expense'):
+        transactions = transactions.filter(transaction_type=transaction_type)
+
+    category = params.get('category')
+    if category:
+        transactions = transactions.filter(category_id=category)
+
+    payment_method = params.get('payment_method')
+    if payment_method:
+        transactions = transactions.filter(payment_method_id=payment_method)
+
+    date_from = params.get('date_from')
+    if date_from:
+        transactions = transactions.filter(transaction_date__gte=date_from)
+
+    date_to = params.get('date_to')
+    if date_to:
+        transactions = transactions.filter(transaction_date__lte=date_to)
+
+    amount_min = params.get('amount_min')
+    if amount_min:
+        transactions = transactions.filter(amount__gte=amount_min)
+
+    amount_max = params.get('amount_max')
+    if amount_max:
+        transactions = transactions.filter(amount__lte=amount_max)
+
+    if params.get('anomalies'):
+        transactions = transactions.filter(is_anomaly=True)
+
+    return transactions
+
+
+def archived_transactions(user, params):
+    """Archived transactions matching the list filters, or None when the range does not reach the archive"""
+    # Archived rows are never scored, so they cannot match the anomaly filter
+    if params.get('anomalies'):
+        return None
+    try:
+        start = parse_date(params.get('date_from') or '')
+    except ValueError:
+        start = None
+    if ArchivedTransaction not in transaction_sources(user.pk, start):
+        return None
+    return filter_transactions(ArchivedTransaction.objects.filter(user=user), params)
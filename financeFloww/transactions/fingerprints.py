@@ -0,0 +1,38 @@
+import hashlib
+import re
+from datetime import datetime
+from decimal import Decimal
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+# Fields that make up a transaction's fingerprint
+FINGERPRINT_FIELDS = ['user_id', 'transaction_date', 'amount', 'description', 'payment_method_id']
+
+_NON_WORD = re.compile(r'[\W_]+')
+
+
+def normalize_description(description):
+    """Lowercase a description and collapse punctuation and whitespace
+
+    "AMAZON.COM  *Mktp" and "amazon com mktp" normalise to the same value.
+    """
+    return ' '.join(_NON_WORD.sub(' ', (description or '').lower()).split())
+
+
+def make_fingerprint(user_id, transaction_date, amount, description, payment_method_id):
+    """Stable hash of the values two copies of the same transaction would share"""
+    # Normalise the values a DateField accepts the same way it stores them
+    if isinstance(transaction_date, datetime):
+        transaction_date = timezone.localdate(transaction_date) if timezone.is_aware(transaction_date) else transaction_date.date()
+    elif isinstance(transaction_date, str):
+        transaction_date = parse_date(transaction_date)
+    amount = Decimal(str(amount)).quantize(Decimal('0.01'))
+    key = '|'.join([
+        str(user_id),
+        transaction_date.isoformat(),
+        str(amount),
+        normalize_description(description),
+        str(payment_method_id or ''),
+    ])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
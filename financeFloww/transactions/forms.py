@@ -1,5 +1,10 @@
 from django import forms
+from django.http import QueryDict
+from .choices import UserChoiceField, category_choices, payment_method_choices
 from .models import Transaction, Category, PaymentMethod
+from .duplicates import find_duplicates
+from .operations import BULK_ACTIONS
+from .reconciliation import DEFAULT_TOLERANCE_DAYS, parse_statement
 
 
 class CategoryForm(forms.ModelForm):
@@ -32,6 +37,29 @@ class CategoryForm(forms.ModelForm):
         self.fields['is_active'].widget.attrs.update({'class': 'form-check-input'})
 
 
+class CategoryMergeForm(forms.Form):
+    """Form for merging a category into another category of the same type"""
+
+    target = UserChoiceField(
+        label="Merge into",
+        widget=forms.Select(attrs={'class': 'form-select'})
+    )
+    delete_source = forms.BooleanField(
+        required=False,
+        initial=True,
+        label="Delete this category after moving its transactions",
+        widget=forms.CheckboxInput(attrs={'class': 'form-check-input'})
+    )
+
+    def __init__(self, *args, category=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['target'].choices = [
+            (pk, name)
+            for pk, name in category_choices(category.user_id, category.category_type)
+            if pk != category.pk
+        ]
+
+
 class PaymentMethodForm(forms.ModelForm):
     """Form for creating and editing payment methods"""
 
@@ -57,14 +85,21 @@ class PaymentMethodForm(forms.ModelForm):
 class TransactionForm(forms.ModelForm):
     """Form for creating and editing transactions"""
 
+    # Validated against the user's cached choices instead of ModelChoiceField queries
+    category = UserChoiceField(widget=forms.Select(attrs={'class': 'form-select'}))
+    payment_method = UserChoiceField(required=False, widget=forms.Select(attrs={'class': 'form-select'}))
+    allow_duplicate = forms.BooleanField(
+        required=False,
+        label="Save anyway, this is not a duplicate"
+    )
+    duplicate_found = False
+
     class Meta:
         model = Transaction
         fields = [
             'transaction_type',
-            'category',
             'amount',
             'description',
-            'payment_method',
             'transaction_date',
             'notes',
             'status',
@@ -75,6 +110,9 @@ class TransactionForm(forms.ModelForm):
     def __init__(self, *args, user=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.user = user
+        if self.instance.pk:
+            self.initial.setdefault('category', self.instance.category_id)
+            self.initial.setdefault('payment_method', self.instance.payment_method_id)
 
         self.fields['transaction_type'].widget.attrs.update({'class': 'form-select'})
         self.fields['amount'].widget.attrs.update({
@@ -102,19 +140,34 @@ class TransactionForm(forms.ModelForm):
             'placeholder': 'Separate tags with commas'
         })
 
-        # Filter categories and payment methods for the current user
+        # Only the current user's categories and payment methods are valid choices
         if user:
-            self.fields['category'].queryset = Category.objects.filter(user=user, is_active=True)
-            self.fields['payment_method'].queryset = PaymentMethod.objects.filter(user=user, is_active=True)
-            self.fields['category'].widget.attrs.update({'class': 'form-select'})
-            self.fields['payment_method'].widget.attrs.update({'class': 'form-select'})
+            self.fields['category'].choices = category_choices(user.pk)
+            self.fields['payment_method'].choices = payment_method_choices(user.pk)
 
     def clean(self):
         cleaned_data = super().clean()
         amount = cleaned_data.get('amount')
+        for field in ('category', 'payment_method'):
+            if field in cleaned_data:
+                setattr(self.instance, f'{field}_id', cleaned_data[field])
         
         if amount and amount <= 0:
             raise forms.ValidationError("Amount must be greater than 0")
+
+        if self.user and not self.instance.pk and not cleaned_data.get('allow_duplicate') and not self.errors:
+            candidate = Transaction(
+                user=self.user,
+                transaction_date=cleaned_data.get('transaction_date'),
+                amount=amount,
+                description=cleaned_data.get('description'),
+                payment_method_id=cleaned_data.get('payment_method'),
+            )
+            if find_duplicates(candidate).exists():
+                self.duplicate_found = True
+                raise forms.ValidationError(
+                    "A transaction with the same date, amount, description and payment method already exists."
+                )
         
         return cleaned_data
 
@@ -133,13 +186,11 @@ class TransactionFilterForm(forms.Form):
         required=False,
         widget=forms.Select(attrs={'class': 'form-select'})
     )
-    category = forms.ModelChoiceField(
-        queryset=Category.objects.none(),
+    category = UserChoiceField(
         required=False,
         widget=forms.Select(attrs={'class': 'form-select'})
     )
-    payment_method = forms.ModelChoiceField(
-        queryset=PaymentMethod.objects.none(),
+    payment_method = UserChoiceField(
         required=False,
         widget=forms.Select(attrs={'class': 'form-select'})
     )
@@ -167,9 +218,96 @@ class TransactionFilterForm(forms.Form):
             'step': '0.01'
         })
     )
+    anomalies = forms.BooleanField(required=False)
 
     def __init__(self, *args, user=None, **kwargs):
         super().__init__(*args, **kwargs)
         if user:
-            self.fields['category'].queryset = Category.objects.filter(user=user, is_active=True)
-            self.fields['payment_method'].queryset = PaymentMethod.objects.filter(user=user, is_active=True)
\ No newline at end of file
+            self.fields['category'].choices = category_choices(user.pk)
+            self.fields['payment_method'].choices = payment_method_choices(user.pk)
+
+
+# Actions that may not run over every transaction of the user by an empty or mistyped filter
+FILTER_REQUIRED_ACTIONS = ('delete', 'categorize')
+
+
+def narrowing_filters(form):
+    """Cleaned values of a valid TransactionFilterForm that actually narrow the list"""
+    return {
+        name: value
+        for name, value in form.cleaned_data.items()
+        if value not in (None, '', False, 'all')
+    }
+
+
+class BulkActionForm(forms.Form):
+    """Form for applying one action to many selected transactions"""
+
+    action = forms.ChoiceField(
+        choices=BULK_ACTIONS,
+        widget=forms.Select(attrs={'class': 'form-select form-select-sm'})
+    )
+    category = UserChoiceField(
+        required=False,
+        widget=forms.Select(attrs={'class': 'form-select form-select-sm'})
+    )
+    ids = forms.Field(required=False, widget=forms.MultipleHiddenInput)
+    select_all = forms.BooleanField(required=False)
+    query = forms.CharField(required=False, widget=forms.HiddenInput)
+
+    def __init__(self, *args, user=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user = user
+        if user:
+            self.fields['category'].choices = category_choices(user.pk)
+
+    def clean_ids(self):
+        try:
+            return [int(value) for value in self.cleaned_data['ids'] or []]
+        except (TypeError, ValueError):
+            raise forms.ValidationError("Invalid transaction selection")
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if not cleaned_data.get('select_all') and not cleaned_data.get('ids'):
+            raise forms.ValidationError("Select at least one transaction")
+        if cleaned_data.get('action') == 'categorize' and not cleaned_data.get('category'):
+            raise forms.ValidationError("Choose the category to move the transactions to")
+        if cleaned_data.get('select_all'):
+            # The list page's query string; parameters other than filters, e.g. page, are ignored
+            filter_form = TransactionFilterForm(QueryDict(cleaned_data.get('query') or ''), user=self.user)
+            if not filter_form.is_valid():
+                raise forms.ValidationError("The list filter is not valid; reload the list and try again")
+            cleaned_data['filters'] = narrowing_filters(filter_form)
+            if not cleaned_data['filters'] and cleaned_data.get('action') in FILTER_REQUIRED_ACTIONS:
+                raise forms.ValidationError("Filter the list before applying this action to every transaction")
+        return cleaned_data
+
+
+class StatementUploadForm(forms.Form):
+    """Form for uploading a bank statement to reconcile against"""
+
+    MAX_STATEMENT_SIZE = 5 * 1024 * 1024
+
+    statement = forms.FileField(
+        help_text="CSV with a date column and an amount column (or debit and credit columns)",
+        widget=forms.ClearableFileInput(attrs={'class': 'form-control', 'accept': '.csv,text/csv'})
+    )
+    tolerance_days = forms.IntegerField(
+        initial=DEFAULT_TOLERANCE_DAYS,
+        min_value=0,
+        max_value=31,
+        widget=forms.NumberInput(attrs={'class': 'form-control'})
+    )
+
+    def clean_statement(self):
+        statement = self.cleaned_data['statement']
+        if statement.size > self.MAX_STATEMENT_SIZE:
+            raise forms.ValidationError("Statement files must be smaller than 5 MB")
+        try:
+            lines = parse_statement(statement.read())
+        except (UnicodeDecodeError, ValueError) as error:
+            raise forms.ValidationError(str(error))
+        if not lines:
+            raise forms.ValidationError("The statement has no lines")
+        return lines
@@ -0,0 +1,200 @@
+from datetime import date
+from decimal import Decimal, InvalidOperation
+
+from django.db import IntegrityError, transaction as db_transaction
+
+from financeFloww.sharding import shard_for
+from .choices import get_user_choices
+from .duplicates import split_duplicates
+from .models import Transaction
+from .operations import bulk_transactions_changed
+
+# Most transactions accepted in one request
+INGEST_MAX_ITEMS = 5000
+# Rows per INSERT, well under PostgreSQL's 65535 parameter limit
+INGEST_INSERT_BATCH_SIZE = 1000
+# Lookups of stored idempotency keys per query
+KEY_LOOKUP_BATCH_SIZE = 1000
+# Inserts tried before giving up on a batch whose keys concurrent requests keep storing first
+INGEST_ATTEMPTS = 3
+
+TRANSACTION_TYPES = {value for value, _ in Transaction.TRANSACTION_TYPE_CHOICES}
+STATUSES = {value for value, _ in Transaction.STATUS_CHOICES}
+MAX_AMOUNT = Decimal('9999999999.99')
+
+
+def _text(item, field, errors, max_length=None, required=False):
+    value = item.get(field)
+    if value is None or value == '':
+        if required:
+            errors[field] = "This field is required."
+        return None
+    if not isinstance(value, str):
+        errors[field] = "Must be a string."
+    elif max_length is not None and len(value) > max_length:
+        errors[field] = f"At most {max_length} characters."
+    return value
+
+
+def _choice(item, field, errors, choices, default=None):
+    value = item.get(field, default)
+    if not isinstance(value, str) or value not in choices:
+        errors[field] = f"Must be one of {', '.join(sorted(choices))}."
+    return value
+
+
+def _flag(item, field, errors):
+    value = item.get(field, False)
+    if not isinstance(value, bool):
+        errors[field] = "Must be true or false."
+    return value
+
+
+def _amount(item, errors):
+    value = item.get('amount')
+    try:
+        # Floats go through str() so 12.1 stays 12.1 rather than its binary expansion
+        amount = Decimal(str(value)) if isinstance(value, (int, float, str)) and not isinstance(value, bool) else None
+    except InvalidOperation:
+        amount = None
+    if amount is None or not amount.is_finite():
+        errors['amount'] = "Must be a decimal number."
+    elif amount < Decimal('0.01') or amount > MAX_AMOUNT or amount.as_tuple().exponent < -2:
+        errors['amount'] = "Must be between 0.01 and 9999999999.99 with at most 2 decimal places."
+    return amount
+
+
+def _date(item, errors):
+    try:
+        return date.fromisoformat(item.get('transaction_date'))
+    except (TypeError, ValueError):
+        errors['transaction_date'] = "Must be a date in YYYY-MM-DD format."
+
+
+def _reference(item, field, errors, choices, required=False):
+    value = item.get(field)
+    if value is None or value == '':
+        if required:
+            errors[field] = "This field is required."
+        return None
+    if isinstance(value, bool) or not isinstance(value, int) or value not in choices:
+        errors[field] = "Choose one of your active ones."
+    return value
+
+
+def clean_item(user, item, categories, payment_methods):
+    """Validate one ingested transaction without queries; returns (transaction, errors)
+
+    ``categories`` and ``payment_methods`` are the ids of the user's active
+    ones, as in the cached choices the forms validate against.
+    """
+    if not isinstance(item, dict):
+        return None, {'non_field_errors': "Each transaction must be an object."}
+    errors = {}
+    transaction = Transaction(
+        user=user,
+        idempotency_key=_text(item, 'idempotency_key', errors, 64, required=True),
+        transaction_type=_choice(item, 'transaction_type', errors, TRANSACTION_TYPES),
+        amount=_amount(item, errors),
+        description=_text(item, 'description', errors, 255, required=True),
+        transaction_date=_date(item, errors),
+        category_id=_reference(item, 'category', errors, categories, required=True),
+        payment_method_id=_reference(item, 'payment_method', errors, payment_methods),
+        notes=_text(item, 'notes', errors),
+        status=_choice(item, 'status', errors, STATUSES, default='completed'),
+        is_recurring=_flag(item, 'is_recurring', errors),
+        tags=_text(item, 'tags', errors, 200),
+    )
+    _flag(item, 'allow_duplicate', errors)
+    return transaction, errors
+
+
+def stored_keys(user_id, keys):
+    """{idempotency key: transaction id} of the given keys the user already has"""
+    keys = list(keys)
+    found = {}
+    for start in range(0, len(keys), KEY_LOOKUP_BATCH_SIZE):
+        found.update(Transaction.objects.filter(
+            user_id=user_id,
+            idempotency_key__in=keys[start:start + KEY_LOOKUP_BATCH_SIZE]
+        ).values_list('idempotency_key', 'id'))
+    return found
+
+
+def _insert(user, candidates):
+    """Insert the candidates whose keys are not stored yet; returns ({key: result}, inserted rows)"""
+    results = {}
+    stored = stored_keys(user.pk, candidates)
+    for key, pk in stored.items():
+        results[key] = {'status': 'exists', 'id': pk}
+
+    pending = [candidates[key] for key in candidates if key not in stored]
+    new, duplicates = split_duplicates(user.pk, [transaction for transaction, _ in pending])
+    allowed = {id(transaction) for transaction, allow_duplicate in pending if allow_duplicate}
+    for transaction in duplicates:
+        if id(transaction) in allowed:
+            new.append(transaction)
+        else:
+            results[transaction.idempotency_key] = {'status': 'duplicate'}
+
+    Transaction.objects.bulk_create(new, batch_size=INGEST_INSERT_BATCH_SIZE)
+    for transaction in new:
+        results[transaction.idempotency_key] = {'status': 'created', 'id': transaction.pk}
+    return results, new
+
+
+def ingest_transactions(user, items):
+    """Validate and insert a batch of the user's transactions; returns one result per item
+
+    Items are validated in memory against the user's cached categories and
+    payment methods, so invalid ones cost no queries. Every item carries an
+    idempotency key: one already stored, even by a concurrent request, is
+    reported as 'exists' with its id instead of being inserted again, which
+    makes retrying a whole batch safe. Items matching an existing
+    transaction's fingerprint are reported as 'duplicate' unless they set
+    allow_duplicate. The rest go in with one bulk_create, and derived data is
+    adjusted once through bulk_transactions_changed.
+    """
+    choices = get_user_choices(user.pk)
+    categories = {pk for pk, _, _ in choices['categories']}
+    payment_methods = {pk for pk, _ in choices['payment_methods']}
+
+    results = [None] * len(items)
+    candidates, positions = {}, {}
+    for index, item in enumerate(items):
+        transaction, errors = clean_item(user, item, categories, payment_methods)
+        key = transaction.idempotency_key if transaction else None
+        if not errors and key in positions:
+            errors = {'idempotency_key': f"Repeats the key of item {positions[key]}."}
+        if errors:
+            results[index] = {'index': index, 'idempotency_key': key, 'status': 'invalid', 'errors': errors}
+            continue
+        candidates[key] = (transaction, item.get('allow_duplicate', False))
+        positions[key] = index
+
+    if candidates:
+        alias = shard_for(user.pk)
+        with db_transaction.atomic(using=alias):
+            for attempt in range(1, INGEST_ATTEMPTS + 1):
+                try:
+                    # Each attempt in its own savepoint, so a conflict only rolls back the attempt
+                    with db_transaction.atomic(using=alias):
+                        outcomes, inserted = _insert(user, candidates)
+                    break
+                except IntegrityError:
+                    if attempt == INGEST_ATTEMPTS:
+                        raise
+                    # A concurrent request stored some of the keys first; they are found next time
+                    for transaction, _ in candidates.values():
+                        transaction.pk = None
+                        transaction._state.adding = True
+            if inserted:
+                bulk_transactions_changed.send(
+                    sender=Transaction,
+                    user_id=user.pk,
+                    before=[None] * len(inserted),
+                    after=[{**transaction.get_tracked_state(), 'id': transaction.pk} for transaction in inserted],
+                )
+        for key, outcome in outcomes.items():
+            results[positions[key]] = {'index': positions[key], 'idempotency_key': key, **outcome}
+    return results
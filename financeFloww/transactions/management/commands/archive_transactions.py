@@ -0,0 +1,51 @@
+from datetime import date
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from analytics.breakdown import month_range
+from analytics.models import MonthlyReport
+from analytics.reports import build_reports
+from financeFloww.sharding import user_shard
+from transactions.archive import ARCHIVE_BATCH_SIZE, KEEP_YEARS, archivable_years, archive_year
+
+
+class Command(BaseCommand):
+    help = "Move closed years of transactions into the archive table once their monthly rollups exist"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', help='Only archive these user ids')
+        parser.add_argument('--keep-years', type=int, default=KEEP_YEARS,
+                            help='Most recent years, the current one included, to keep in the hot table')
+        parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE, help='Rows moved per transaction')
+        parser.add_argument('--dry-run', action='store_true', help='Only list the years that would be archived')
+
+    def ensure_rollups(self, user, year):
+        """Store a MonthlyReport for every month of the year that has none, before its rows move"""
+        months = month_range(date(year, 1, 1), date(year, 12, 1))
+        existing = set(MonthlyReport.objects.filter(user=user, month__in=months).values_list('month', flat=True))
+        missing = [month for month in months if month not in existing]
+        if missing:
+            MonthlyReport.objects.bulk_create(build_reports(user, missing), ignore_conflicts=True)
+        return len(missing)
+
+    def handle(self, *args, **options):
+        users = User.objects.order_by('pk')
+        if options['user']:
+            users = users.filter(pk__in=options['user'])
+
+        archived = 0
+        for user in users.iterator():
+            with user_shard(user.pk):
+                for year in archivable_years(user.pk, keep_years=max(options['keep_years'], 1)):
+                    if options['dry_run']:
+                        self.stdout.write(f"Would archive {year} of {user.username}")
+                        continue
+                    built = self.ensure_rollups(user, year)
+                    moved = archive_year(user.pk, year, batch_size=options['batch_size'])
+                    archived += moved
+                    self.stdout.write(
+                        f"Archived {moved} transactions of {user.username} for {year} ({built} rollups built)"
+                    )
+
+        self.stdout.write(self.style.SUCCESS(f"Archived {archived} transactions"))
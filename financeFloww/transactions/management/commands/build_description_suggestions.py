@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction as db_transaction
+
+from financeFloww.sharding import fan_out, shard_for, user_shard
+from transactions.models import Transaction
+from transactions.suggestions import rebuild_suggestions
+
+
+class Command(BaseCommand):
+    help = "Rebuild description suggestions from transactions, e.g. after deploying them or restoring a backup"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', help='Only rebuild these user ids')
+
+    def handle(self, *args, **options):
+        if options['user']:
+            user_ids = sorted(set(options['user']))
+        else:
+            user_ids = set()
+            for _ in fan_out():
+                user_ids.update(Transaction.objects.order_by().values_list('user_id', flat=True).distinct())
+            user_ids = sorted(user_ids)
+
+        written = deleted = 0
+        for user_id in user_ids:
+            with user_shard(user_id), db_transaction.atomic(using=shard_for(user_id)):
+                user_written, user_deleted = rebuild_suggestions(user_id)
+            written += user_written
+            deleted += user_deleted
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt suggestions of {len(user_ids)} users: {written} written, {deleted} deleted"
+        ))
@@ -0,0 +1,56 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from financeFloww.metrics import timed
+from financeFloww.sharding import fan_out
+from transactions.outbox import CONSUME_BATCH_SIZE, consume, consumers, prune_outbox
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Hand new outbox events to the consumers in OUTBOX_CONSUMERS, once or on a schedule"
+
+    def add_arguments(self, parser):
+        parser.add_argument('consumer', nargs='*', help='Only run these consumers')
+        parser.add_argument('--batch-size', type=int, default=CONSUME_BATCH_SIZE, help='Events per partition and batch')
+        parser.add_argument('--interval', type=int, help='Keep running and poll every this many seconds')
+        parser.add_argument('--prune', action='store_true', help='Also delete events every consumer has handled')
+
+    def handle(self, *args, **options):
+        registered = consumers()
+        unknown = set(options['consumer']) - registered.keys()
+        if unknown:
+            raise CommandError(f"Unknown consumers: {', '.join(sorted(unknown))}")
+        selected = {name: registered[name] for name in options['consumer'] or registered}
+        if not selected and not options['prune']:
+            self.stdout.write("No consumers are configured in OUTBOX_CONSUMERS")
+            return
+
+        while True:
+            with timed('consume_outbox'):
+                for shard, _ in fan_out():
+                    for name, handler in selected.items():
+                        handled = 0
+                        try:
+                            # Drain the shard, so a backlog does not wait for the next interval
+                            while True:
+                                batch = consume(name, handler, batch_size=options['batch_size'])
+                                if not batch:
+                                    break
+                                handled += batch
+                        except Exception:
+                            logger.exception("Outbox consumer %s failed on %s", name, shard)
+                            self.stdout.write(self.style.ERROR(f"{name} failed on {shard} after {handled} events"))
+                            continue
+                        if handled:
+                            self.stdout.write(f"{name} handled {handled} events on {shard}")
+                    if options['prune']:
+                        self.stdout.write(f"Pruned {prune_outbox()} events on {shard}")
+            if not options['interval']:
+                return
+            close_old_connections()
+            time.sleep(options['interval'])
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+
+from financeFloww.sharding import fan_out
+from transactions.duplicates import duplicate_groups
+from transactions.models import Transaction
+
+
+class Command(BaseCommand):
+    help = "Report transactions that share a fingerprint with another transaction of the same user"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', help='Only report these user ids')
+        parser.add_argument('--details', action='store_true', help='List the rows in each duplicate group')
+
+    def handle(self, *args, **options):
+        groups, rows = [], {}
+        for shard, user_ids in fan_out(options['user']):
+            shard_groups = list(duplicate_groups(user_ids))
+            groups += shard_groups
+            if options['details'] and shard_groups:
+                # One query per shard for every row of every reported group
+                for transaction in Transaction.objects.filter(
+                    fingerprint__in={group['fingerprint'] for group in shard_groups}
+                ).order_by('created_at'):
+                    rows.setdefault((transaction.user_id, transaction.fingerprint), []).append(transaction)
+
+        if not groups:
+            self.stdout.write(self.style.SUCCESS("No duplicate transactions found"))
+            return
+
+        extra = 0
+        for group in groups:
+            extra += group['count'] - 1
+            self.stdout.write(f"user {group['user_id']}: {group['count']} copies of {group['fingerprint']}")
+            for transaction in rows.get((group['user_id'], group['fingerprint']), []):
+                self.stdout.write(
+                    f"    #{transaction.pk} {transaction.transaction_date} {transaction.amount} "
+                    f"{transaction.description} (created {transaction.created_at:%Y-%m-%d %H:%M})"
+                )
+
+        self.stdout.write(self.style.WARNING(
+            f"{len(groups)} duplicate groups, {extra} transactions beyond the first copy"
+        ))
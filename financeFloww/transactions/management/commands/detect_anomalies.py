@@ -0,0 +1,52 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from accounts.models import CommandCursor
+
+from financeFloww.sharding import fan_out
+from transactions.anomalies import detect_anomalies
+
+CURSOR_NAME = 'detect-anomalies'
+
+
+class Command(BaseCommand):
+    help = "Re-score all transactions for anomalies, a chunk of users at a time"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', help='Only score these user ids')
+        parser.add_argument('--chunk-size', type=int, default=200, help='Users loaded per pass')
+        parser.add_argument('--max-seconds', type=int, default=None,
+                            help='Stop after this long and resume from the same user next run')
+        parser.add_argument('--restart', action='store_true', help='Ignore the saved cursor')
+
+    def handle(self, *args, **options):
+        if options['user']:
+            updated = sum(detect_anomalies(user_ids) for shard, user_ids in fan_out(options['user'], writing=True))
+            self.stdout.write(self.style.SUCCESS(f"Updated {updated} transactions"))
+            return
+
+        started = time.monotonic()
+        # Kept in the directory database, so a run on any host resumes where the last one stopped
+        saved, _ = CommandCursor.objects.get_or_create(name=CURSOR_NAME)
+        cursor = 0 if options['restart'] else saved.position
+        users = User.objects.order_by('id').values_list('id', flat=True)
+        updated = 0
+
+        while True:
+            user_ids = list(users.filter(id__gt=cursor)[:options['chunk_size']])
+            if not user_ids:
+                saved.delete()
+                break
+
+            updated += sum(detect_anomalies(ids) for shard, ids in fan_out(user_ids, writing=True))
+            cursor = user_ids[-1]
+            saved.position = cursor
+            saved.save(update_fields=['position', 'updated_at'])
+
+            if options['max_seconds'] and time.monotonic() - started > options['max_seconds']:
+                self.stdout.write(f"Time budget reached, will resume after user {cursor}")
+                break
+
+        self.stdout.write(self.style.SUCCESS(f"Updated {updated} transactions"))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from financeFloww.sharding import user_shard
+from transactions.archive import ARCHIVE_BATCH_SIZE, restore_year
+from transactions.models import ArchivedYear
+
+
+class Command(BaseCommand):
+    help = "Move archived years of transactions back into the hot table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, required=True, help='User whose years are restored')
+        parser.add_argument('--year', type=int, action='append', help='Only restore these years (default: all)')
+        parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE, help='Rows moved per transaction')
+
+    def handle(self, *args, **options):
+        with user_shard(options['user']):
+            years = ArchivedYear.objects.filter(user_id=options['user']).order_by('year')
+            if options['year']:
+                years = years.filter(year__in=options['year'])
+            years = list(years.values_list('year', flat=True))
+            if not years:
+                raise CommandError("No matching archived years")
+
+            restored = 0
+            for year in years:
+                moved = restore_year(options['user'], year, batch_size=options['batch_size'])
+                restored += moved
+                self.stdout.write(f"Restored {moved} transactions for {year}")
+
+            self.stdout.write(self.style.SUCCESS(f"Restored {restored} transactions"))
@@ -0,0 +1,178 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction as db_transaction
+from django.db.models import Case, Sum, Value, When
+from django.utils import timezone
+
+from analytics.columnar import bump_store_version
+from analytics.goals import reconcile_savings_goals
+from analytics.models import SavingsGoal, SpendingTrend
+from analytics.reports import invalidate_reports
+from budgets.models import Budget, BudgetAlert
+from financeFloww.sharding import shard_for, user_shard
+from .anomalies import detect_anomalies, forget_stats
+from .cache import bump_catalog_version, bump_data_version
+from .models import ArchivedTransaction, Category, Transaction
+from .outbox import append, change_event
+
+# Budget amounts are per period; folded budgets are converted to the survivor's period
+PERIOD_MONTHS = {'monthly': 1, 'quarterly': 3, 'yearly': 12}
+
+
+def _outbox_state(instance):
+    return {field: getattr(instance, field) for field in instance.OUTBOX_FIELDS}
+
+
+def _convert_amount(amount, frequency, to_frequency):
+    """A budget amount per ``frequency`` period as the amount per ``to_frequency`` period"""
+    return (amount * PERIOD_MONTHS[to_frequency] / PERIOD_MONTHS[frequency]).quantize(Decimal('0.01'))
+
+
+def _merge_budgets(user, source_ids, target):
+    """Move budgets to the target, folding budgets that share a start date into one
+
+    Budget is unique on (user, category, start_date). Of each colliding group
+    the target's own budget (or else the oldest one) survives, takes the sum
+    of the amounts and the alerts of the others; the others are deleted.
+    Amounts of other frequencies are converted to the survivor's first, so a
+    monthly and a yearly budget fold into 1/12 or 12 times the yearly amount.
+    """
+    budgets = Budget.objects.filter(user=user, category_id__in=[*source_ids, target.pk]).order_by('pk')
+    groups = defaultdict(list)
+    states = {}
+    for budget in budgets.only('id', *Budget.OUTBOX_FIELDS):
+        groups[budget.start_date].append(budget)
+        states[budget.pk] = _outbox_state(budget)
+
+    survivors, merged = [], {}
+    for group in groups.values():
+        survivor = next((budget for budget in group if budget.category_id == target.pk), group[0])
+        others = [budget for budget in group if budget is not survivor]
+        if survivor.category_id == target.pk and not others:
+            continue
+        if others:
+            survivor.amount = sum(
+                (_convert_amount(budget.amount, budget.frequency, survivor.frequency) for budget in group),
+                Decimal(0)
+            )
+            survivor.is_active = any(budget.is_active for budget in group)
+            end_dates = [budget.end_date for budget in group]
+            survivor.end_date = None if None in end_dates else max(end_dates)
+        survivor.category_id = target.pk
+        survivors.append(survivor)
+        merged.update({budget.pk: survivor.pk for budget in others})
+
+    # Re-point alerts and drop the folded budgets before the survivors move,
+    # so no intermediate row collides with the unique constraint
+    if merged:
+        BudgetAlert.objects.filter(budget_id__in=merged).update(budget_id=Case(
+            *[When(budget_id=budget_id, then=Value(survivor_id)) for budget_id, survivor_id in merged.items()]
+        ))
+        Budget.objects.filter(pk__in=merged)._raw_delete(Budget.objects.db)
+
+    for survivor in survivors:
+        survivor.updated_at = timezone.now()
+    Budget.objects.bulk_update(survivors, ['category', 'amount', 'is_active', 'end_date', 'updated_at'])
+    append(
+        [change_event(user.pk, Budget, budget.pk, states[budget.pk], _outbox_state(budget)) for budget in survivors]
+        + [change_event(user.pk, Budget, pk, states[pk], None) for pk in merged]
+    )
+    return len(survivors) + len(merged)
+
+
+def _merge_trends(user, source_ids, target):
+    """Fold the trends of all categories into one row per period for the target
+
+    SpendingTrend is unique on (user, category, period, period_start_date),
+    so the rows are regrouped and rewritten instead of updated in place.
+    """
+    trends = SpendingTrend.objects.filter(user=user, category_id__in=[*source_ids, target.pk])
+    if not trends.filter(category_id__in=source_ids).exists():
+        return 0
+
+    rows = list(trends.values('period', 'period_start_date').annotate(
+        total=Sum('amount'),
+        count=Sum('transaction_count'),
+    ).order_by())
+    trends._raw_delete(trends.db)
+    SpendingTrend.objects.bulk_create([
+        SpendingTrend(
+            user=user,
+            category=target,
+            period=row['period'],
+            period_start_date=row['period_start_date'],
+            amount=row['total'],
+            transaction_count=row['count'],
+        )
+        for row in rows
+    ], batch_size=1000)
+    return len(rows)
+
+
+def _rescore_category(user_id, category_id):
+    with user_shard(user_id):
+        detect_anomalies([user_id], categories=[category_id])
+
+
+def merge_categories(user, sources, target, delete_source=True):
+    """Move everything filed under ``sources`` to ``target`` in one database transaction
+
+    Transactions (archived ones included), budgets, spending trends and
+    savings goals are moved with a handful of set-based statements,
+    whatever the number of transactions.
+    With ``delete_source`` the emptied categories are removed as well,
+    otherwise they are kept for reuse. Returns a dict of moved row counts.
+    """
+    source_ids = sorted({category.pk for category in sources} - {target.pk})
+    if target.user_id != user.pk or any(category.user_id != user.pk for category in sources):
+        raise ValueError("Categories can only be merged within one user's categories")
+    if any(category.category_type != target.category_type for category in sources):
+        raise ValueError("Income and expense categories cannot be merged")
+    if not source_ids:
+        return {'transactions': 0, 'budgets': 0, 'trends': 0, 'goals': 0}
+
+    with db_transaction.atomic(using=shard_for(user.pk)):
+        # Lock the categories so no transaction is filed under a source mid-merge
+        list(Category.objects.filter(pk__in=[*source_ids, target.pk]).select_for_update().values_list('pk'))
+
+        months = []
+        moved_count = 0
+        events = []
+        for model in (Transaction, ArchivedTransaction):
+            moved = model.objects.filter(user=user, category_id__in=source_ids)
+            months += moved.dates('transaction_date', 'month')
+            # Archived rows left the outbox feed when they were archived (see transactions.archive)
+            if model is Transaction:
+                for row in moved.values('id', *Transaction.OUTBOX_CONTEXT_FIELDS):
+                    pk = row.pop('id')
+                    events.append(change_event(user.pk, Transaction, pk, row, {**row, 'category_id': target.pk}))
+            moved_count += moved.update(category_id=target.pk, updated_at=timezone.now())
+        goals = SavingsGoal.objects.filter(user=user, category_id__in=source_ids)
+        events += [
+            change_event(user.pk, SavingsGoal, pk, {'category_id': category_id}, {'category_id': target.pk})
+            for pk, category_id in goals.values_list('id', 'category_id')
+        ]
+        counts = {
+            'transactions': moved_count,
+            'budgets': _merge_budgets(user, source_ids, target),
+            'trends': _merge_trends(user, source_ids, target),
+            'goals': goals.update(category_id=target.pk),
+        }
+        append(events)
+
+        if counts['goals'] or counts['transactions']:
+            reconcile_savings_goals(SavingsGoal.objects.filter(user=user, category=target))
+        if counts['transactions']:
+            # Totals are unchanged, but the top expense category of those months may not be
+            invalidate_reports(user.pk, months)
+            bump_store_version(user.pk)
+            # Only the merged categories' groups changed; score them once the merge is visible
+            forget_stats(user.pk, [*source_ids, target.pk])
+            db_transaction.on_commit(lambda: _rescore_category(user.pk, target.pk), using=shard_for(user.pk))
+
+        if delete_source:
+            Category.objects.filter(user=user, pk__in=source_ids).delete()
+        bump_data_version(user.pk)
+        bump_catalog_version(user.pk)
+    return counts
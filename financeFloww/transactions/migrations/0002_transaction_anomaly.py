@@ -0,0 +1,27 @@
+# Generated by Django 4.2.13 on 2026-10-19 07:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='anomaly_score',
+            field=models.FloatField(blank=True, help_text="Robust z-score within the user's category", null=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='is_anomaly',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(('is_anomaly', True)), fields=['user', '-transaction_date'], name='transaction_anomaly_idx'),
+        ),
+    ]
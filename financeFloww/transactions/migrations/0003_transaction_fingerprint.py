@@ -0,0 +1,44 @@
+# Generated by Django 4.2.13 on 2026-10-19 07:56
+
+from django.db import migrations, models
+
+from transactions.fingerprints import make_fingerprint
+
+
+def fill_fingerprints(apps, schema_editor):
+    Transaction = apps.get_model('transactions', 'Transaction')
+    alias = schema_editor.connection.alias
+    batch = []
+    rows = Transaction.objects.using(alias).order_by('pk').only(
+        'user_id', 'transaction_date', 'amount', 'description', 'payment_method_id'
+    )
+    for transaction in rows.iterator(chunk_size=2000):
+        transaction.fingerprint = make_fingerprint(
+            transaction.user_id, transaction.transaction_date, transaction.amount,
+            transaction.description, transaction.payment_method_id
+        )
+        batch.append(transaction)
+        if len(batch) >= 2000:
+            Transaction.objects.using(alias).bulk_update(batch, ['fingerprint'])
+            batch = []
+    Transaction.objects.using(alias).bulk_update(batch, ['fingerprint'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0002_transaction_anomaly'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='fingerprint',
+            field=models.CharField(blank=True, default='', editable=False, max_length=40),
+        ),
+        migrations.RunPython(fill_fingerprints, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['user', 'fingerprint'], name='transaction_fingerprint_idx'),
+        ),
+    ]
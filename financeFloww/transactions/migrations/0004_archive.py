@@ -0,0 +1,60 @@
+# Generated by Django 4.2.13 on 2026-10-19 08:15
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('transactions', '0003_transaction_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedYear',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveIntegerField()),
+                ('transaction_count', models.IntegerField(default=0)),
+                ('archived_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_years', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Archived Year',
+                'verbose_name_plural': 'Archived Years',
+                'ordering': ['user', 'year'],
+                'unique_together': {('user', 'year')},
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedTransaction',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('transaction_type', models.CharField(choices=[('income', 'Income'), ('expense', 'Expense')], max_length=10)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('description', models.CharField(max_length=255)),
+                ('notes', models.TextField(blank=True, null=True)),
+                ('transaction_date', models.DateField()),
+                ('created_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('completed', 'Completed'), ('cancelled', 'Cancelled')], max_length=20)),
+                ('is_recurring', models.BooleanField(default=False)),
+                ('is_reconciled', models.BooleanField(default=False)),
+                ('tags', models.CharField(blank=True, max_length=200, null=True)),
+                ('fingerprint', models.CharField(blank=True, default='', max_length=40)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('category', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='archived_transactions', to='transactions.category')),
+                ('payment_method', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='archived_transactions', to='transactions.paymentmethod')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_transactions', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Archived Transaction',
+                'verbose_name_plural': 'Archived Transactions',
+                'ordering': ['-transaction_date', '-created_at'],
+                'indexes': [models.Index(fields=['user', '-transaction_date'], name='transaction_user_id_806d87_idx')],
+            },
+        ),
+    ]
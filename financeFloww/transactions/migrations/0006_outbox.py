@@ -0,0 +1,50 @@
+# Generated by Django 4.2.13 on 2026-10-19 09:09
+
+from django.conf import settings
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('transactions', '0005_transaction_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxOffset',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('consumer', models.CharField(max_length=100)),
+                ('partition', models.PositiveSmallIntegerField()),
+                ('position', models.BigIntegerField(default=0, help_text='Id of the last handled event')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Outbox Offset',
+                'verbose_name_plural': 'Outbox Offsets',
+                'unique_together': {('consumer', 'partition')},
+            },
+        ),
+        migrations.CreateModel(
+            name='OutboxEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('partition', models.PositiveSmallIntegerField()),
+                ('model', models.CharField(help_text='Label of the written model, e.g. transactions.transaction', max_length=40)),
+                ('object_id', models.BigIntegerField()),
+                ('action', models.CharField(choices=[('create', 'Create'), ('update', 'Update'), ('delete', 'Delete')], max_length=10)),
+                ('changes', models.JSONField(default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Outbox Event',
+                'verbose_name_plural': 'Outbox Events',
+                'indexes': [models.Index(fields=['partition', 'id'], name='outbox_partition_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 4.2.13 on 2026-10-19 09:13
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+# icontains compiles to UPPER("column"::text) LIKE UPPER(%s) on PostgreSQL, so the
+# trigram indexes are over that expression; btree_gin lets user_id lead them
+TRIGRAM_INDEXES = {
+    'transactions_suggestion_trgm': ('transactions_descriptionsuggestion', 'description'),
+    'transactions_category_name_trgm': ('transactions_category', 'name'),
+}
+
+
+def create_trigram_indexes(apps, schema_editor):
+    """GIN trigram indexes for substring searches; other backends scan the user's rows"""
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS btree_gin')
+    for name, (table, column) in TRIGRAM_INDEXES.items():
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS {name} ON {table} USING gin (user_id, UPPER({column}::text) gin_trgm_ops)'
+        )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name in TRIGRAM_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('transactions', '0006_outbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DescriptionSuggestion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('description', models.CharField(max_length=255)),
+                ('use_count', models.IntegerField(default=0)),
+                ('last_used', models.DateField()),
+                ('category', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='transactions.category')),
+                ('payment_method', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='transactions.paymentmethod')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='description_suggestions', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Description Suggestion',
+                'verbose_name_plural': 'Description Suggestions',
+                'unique_together': {('user', 'description')},
+            },
+        ),
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.13 on 2026-10-19 09:35
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('transactions', '0007_description_suggestions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category_key', models.BigIntegerField(help_text='Category id, or 0 for uncategorized transactions')),
+                ('transaction_type', models.CharField(max_length=10)),
+                ('count', models.IntegerField(default=0)),
+                ('mean', models.FloatField(default=0)),
+                ('m2', models.FloatField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Category Stats',
+                'verbose_name_plural': 'Category Stats',
+                'unique_together': {('user', 'category_key', 'transaction_type')},
+            },
+        ),
+    ]
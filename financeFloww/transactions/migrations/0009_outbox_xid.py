@@ -0,0 +1,31 @@
+# Generated by Django 4.2.13 on 2026-10-19 09:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0008_category_stats'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='outboxevent',
+            name='outbox_partition_idx',
+        ),
+        migrations.AddField(
+            model_name='outboxevent',
+            name='xid',
+            field=models.BigIntegerField(default=0, help_text='Id of the appending database transaction on PostgreSQL, else 0'),
+        ),
+        migrations.AddField(
+            model_name='outboxoffset',
+            name='xid',
+            field=models.BigIntegerField(default=0, help_text='Transaction id of the last handled event'),
+        ),
+        migrations.AddIndex(
+            model_name='outboxevent',
+            index=models.Index(fields=['partition', 'xid', 'id'], name='outbox_partition_xid_idx'),
+        ),
+    ]
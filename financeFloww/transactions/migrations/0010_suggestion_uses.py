@@ -0,0 +1,23 @@
+# Generated by Django 4.2.13 on 2026-10-19 10:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0009_outbox_xid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='descriptionsuggestion',
+            name='category_uses',
+            field=models.JSONField(default=list),
+        ),
+        migrations.AddField(
+            model_name='descriptionsuggestion',
+            name='payment_method_uses',
+            field=models.JSONField(default=list),
+        ),
+    ]
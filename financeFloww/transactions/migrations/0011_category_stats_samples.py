@@ -0,0 +1,46 @@
+# Generated by Django 4.2.13 on 2026-10-19 10:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0010_suggestion_uses'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='categorystats',
+            name='m2',
+        ),
+        migrations.RemoveField(
+            model_name='categorystats',
+            name='mean',
+        ),
+        migrations.AddField(
+            model_name='categorystats',
+            name='changes_since_sample',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='categorystats',
+            name='mad',
+            field=models.FloatField(default=0, help_text='Median absolute deviation from the median'),
+        ),
+        migrations.AddField(
+            model_name='categorystats',
+            name='mean_deviation',
+            field=models.FloatField(default=0, help_text='Mean absolute deviation from the median'),
+        ),
+        migrations.AddField(
+            model_name='categorystats',
+            name='median',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='categorystats',
+            name='sample_count',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -1,7 +1,28 @@
-from django.db import models
+from django.db import models, router, transaction as db_transaction
 from django.contrib.auth.models import User
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import MinValueValidator
 from django.utils import timezone
+from decimal import Decimal
+
+from .fingerprints import FINGERPRINT_FIELDS, make_fingerprint
+
+class RecordedModel(models.Model):
+    """Base of the models whose writes are appended to the outbox (see transactions.outbox)
+
+    The post_save receivers append the change record, so save() runs in a
+    database transaction and the record commits or rolls back with the row.
+    Deletes already send post_delete inside the collector's transaction.
+    """
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+        with db_transaction.atomic(using=using):
+            super().save(*args, **kwargs)
+
 
 class Category(models.Model):
     """Transaction categories"""
@@ -59,7 +80,7 @@ class PaymentMethod(models.Model):
         return f"{self.name} ({self.get_payment_type_display()})"
 
 
-class Transaction(models.Model):
+class Transaction(RecordedModel):
     """Income and expense transactions"""
     
     TRANSACTION_TYPE_CHOICES = [
@@ -96,6 +117,24 @@ class Transaction(models.Model):
     
     tags = models.CharField(max_length=200, blank=True, null=True, help_text="Comma-separated tags")
 
+    anomaly_score = models.FloatField(blank=True, null=True, help_text="Robust z-score within the user's category")
+    is_anomaly = models.BooleanField(default=False)
+
+    # Hash of user, date, amount, normalised description and payment method, for duplicate checks
+    fingerprint = models.CharField(max_length=40, blank=True, default='', editable=False)
+
+    # Client-supplied key of an ingested transaction (see transactions.ingest), so retries insert it once
+    idempotency_key = models.CharField(max_length=64, blank=True, null=True, editable=False)
+
+    # Fields whose last saved values are remembered so derived data can be adjusted by delta
+    TRACKED_FIELDS = [
+        'user_id', 'category_id', 'payment_method_id', 'transaction_type',
+        'amount', 'transaction_date', 'status', 'description',
+    ]
+    # Sent with every outbox event of a transaction, changed or not, so consumers
+    # know which description a change applies to (see transactions.suggestions)
+    OUTBOX_CONTEXT_FIELDS = ['description', 'category_id', 'payment_method_id', 'transaction_date']
+
     class Meta:
         verbose_name = 'Transaction'
         verbose_name_plural = 'Transactions'
@@ -104,13 +143,256 @@ class Transaction(models.Model):
             models.Index(fields=['user', '-transaction_date']),
             models.Index(fields=['user', 'transaction_type']),
             models.Index(fields=['user', 'category']),
+            models.Index(
+                fields=['user', '-transaction_date'],
+                condition=models.Q(is_anomaly=True),
+                name='transaction_anomaly_idx',
+            ),
+            models.Index(fields=['user', 'fingerprint'], name='transaction_fingerprint_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'idempotency_key'],
+                condition=models.Q(idempotency_key__isnull=False),
+                name='transaction_idempotency_key_uniq',
+            ),
         ]
 
     def __str__(self):
         return f"{self.get_transaction_type_display()} - {self.amount} on {self.transaction_date}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = instance.get_tracked_state()
+        return instance
+
+    def save(self, *args, **kwargs):
+        self.fingerprint = self.compute_fingerprint()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'fingerprint' not in update_fields:
+            # Accept both 'payment_method' and 'payment_method_id' style names
+            if {name.removesuffix('_id') for name in update_fields} & {name.removesuffix('_id') for name in FINGERPRINT_FIELDS}:
+                kwargs['update_fields'] = [*update_fields, 'fingerprint']
+        super().save(*args, **kwargs)
+        self._loaded_values = self.get_tracked_state()
+
+    def compute_fingerprint(self):
+        return make_fingerprint(
+            self.user_id, self.transaction_date, self.amount, self.description, self.payment_method_id
+        )
+
+    def get_tracked_state(self):
+        """Return the tracked field values, or None if some of them are deferred"""
+        if any(field not in self.__dict__ for field in self.TRACKED_FIELDS):
+            return None
+        state = {field: self.__dict__[field] for field in self.TRACKED_FIELDS}
+        # Until the row is reloaded the date and amount are whatever was
+        # assigned: the timezone.now default is a datetime, form-less callers
+        # may pass strings or floats. Convert them to what the fields store.
+        state['transaction_date'] = self._meta.get_field('transaction_date').to_python(state['transaction_date'])
+        if state['amount'] is not None:
+            state['amount'] = Decimal(str(state['amount']))
+        return state
+
+    def get_previous_state(self):
+        """Return the tracked field values as last loaded from or saved to the database"""
+        return getattr(self, '_loaded_values', None)
+
+    def get_display_amount(self):
+        """Return amount with sign based on transaction type"""
+        if self.transaction_type == 'expense':
+            return f"-{self.amount}"
+        return f"+{self.amount}"
+
+    is_archived = False
+
+
+class ArchivedTransaction(models.Model):
+    """Transaction of a closed year, moved out of the hot table (see transactions.archive)
+
+    Keeps the id and the fields of the original row, so it can be listed,
+    reported on and restored, but only the index the archive reads use.
+    """
+
+    id = models.BigIntegerField(primary_key=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_transactions')
+    category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, related_name='archived_transactions')
+    payment_method = models.ForeignKey(
+        PaymentMethod, on_delete=models.SET_NULL, null=True, blank=True, related_name='archived_transactions'
+    )
+
+    transaction_type = models.CharField(max_length=10, choices=Transaction.TRANSACTION_TYPE_CHOICES)
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    description = models.CharField(max_length=255)
+    notes = models.TextField(blank=True, null=True)
+
+    transaction_date = models.DateField()
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+
+    status = models.CharField(max_length=20, choices=Transaction.STATUS_CHOICES)
+    is_recurring = models.BooleanField(default=False)
+    is_reconciled = models.BooleanField(default=False)
+
+    tags = models.CharField(max_length=200, blank=True, null=True)
+    fingerprint = models.CharField(max_length=40, blank=True, default='')
+
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    # Fields copied between the hot and archive tables
+    COPIED_FIELDS = [
+        'id', 'user_id', 'category_id', 'payment_method_id', 'transaction_type', 'amount',
+        'description', 'notes', 'transaction_date', 'created_at', 'updated_at', 'status',
+        'is_recurring', 'is_reconciled', 'tags', 'fingerprint',
+    ]
+
+    is_archived = True
+    is_anomaly = False
+    anomaly_score = None
+
+    class Meta:
+        verbose_name = 'Archived Transaction'
+        verbose_name_plural = 'Archived Transactions'
+        ordering = ['-transaction_date', '-created_at']
+        indexes = [
+            models.Index(fields=['user', '-transaction_date']),
+        ]
+
+    def __str__(self):
+        return f"{self.get_transaction_type_display()} - {self.amount} on {self.transaction_date} (archived)"
+
     def get_display_amount(self):
         """Return amount with sign based on transaction type"""
         if self.transaction_type == 'expense':
             return f"-{self.amount}"
-        return f"+{self.amount}"
\ No newline at end of file
+        return f"+{self.amount}"
+
+
+class ArchivedYear(models.Model):
+    """A closed year of one user's transactions that lives in the archive table"""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_years')
+    year = models.PositiveIntegerField()
+    transaction_count = models.IntegerField(default=0)
+    archived_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Archived Year'
+        verbose_name_plural = 'Archived Years'
+        unique_together = ['user', 'year']
+        ordering = ['user', 'year']
+
+    def __str__(self):
+        return f"{self.user.username} - {self.year} ({self.transaction_count} transactions)"
+
+
+class DescriptionSuggestion(models.Model):
+    """A distinct description from a user's transactions, offered as they type a new one
+
+    Derived data, updated from the outbox by transactions.suggestions. On
+    PostgreSQL a pg_trgm GIN index over (user, UPPER(description)) serves
+    the substring matches (see migration 0007).
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='description_suggestions')
+    description = models.CharField(max_length=255)
+    use_count = models.IntegerField(default=0)
+    last_used = models.DateField()
+    # The most frequent category and payment method of the transactions with this description
+    category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, related_name='+')
+    payment_method = models.ForeignKey(PaymentMethod, on_delete=models.SET_NULL, null=True, related_name='+')
+    # [[id, transactions], ...] per category and payment method, so the most frequent can be kept by delta
+    category_uses = models.JSONField(default=list)
+    payment_method_uses = models.JSONField(default=list)
+
+    class Meta:
+        verbose_name = 'Description Suggestion'
+        verbose_name_plural = 'Description Suggestions'
+        unique_together = ['user', 'description']
+
+    def __str__(self):
+        return f"{self.user.username} - {self.description} ({self.use_count})"
+
+
+class CategoryStats(models.Model):
+    """Robust amount statistics of a user's completed transactions per category and type
+
+    Derived data kept up to date on writes by transactions.anomalies, so a
+    single transaction is scored without reading its category's history.
+    ``count`` follows every write; the median and deviations are those of
+    a sample of ``sample_count`` members, taken again once enough of them
+    changed.
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    # A plain id, so uncategorized transactions (0) get a row of their own
+    category_key = models.BigIntegerField(help_text="Category id, or 0 for uncategorized transactions")
+    transaction_type = models.CharField(max_length=10)
+    count = models.IntegerField(default=0)
+    median = models.FloatField(default=0)
+    mad = models.FloatField(default=0, help_text="Median absolute deviation from the median")
+    mean_deviation = models.FloatField(default=0, help_text="Mean absolute deviation from the median")
+    sample_count = models.IntegerField(default=0)
+    changes_since_sample = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name = 'Category Stats'
+        verbose_name_plural = 'Category Stats'
+        unique_together = ['user', 'category_key', 'transaction_type']
+
+    def __str__(self):
+        return f"{self.user_id} - {self.category_key} {self.transaction_type} ({self.count})"
+
+
+class OutboxEvent(models.Model):
+    """Compact record of a write to a transaction, budget or savings goal
+
+    Appended on the user's shard in the database transaction of the write,
+    and read by consumers in (xid, id) order per partition (see transactions.outbox).
+    """
+
+    ACTION_CHOICES = [
+        ('create', 'Create'),
+        ('update', 'Update'),
+        ('delete', 'Delete'),
+    ]
+
+    partition = models.PositiveSmallIntegerField()
+    # Events outlive the rows and users they describe
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    model = models.CharField(max_length=40, help_text="Label of the written model, e.g. transactions.transaction")
+    object_id = models.BigIntegerField()
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    # {'before': {...}, 'after': {...}} with the fields the writer knows changed; a side is None if unknown
+    changes = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    xid = models.BigIntegerField(default=0, help_text="Id of the appending database transaction on PostgreSQL, else 0")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Outbox Event'
+        verbose_name_plural = 'Outbox Events'
+        indexes = [
+            models.Index(fields=['partition', 'xid', 'id'], name='outbox_partition_xid_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.action} {self.model} {self.object_id}"
+
+
+class OutboxOffset(models.Model):
+    """How far a consumer has read one partition of the outbox on this database"""
+
+    consumer = models.CharField(max_length=100)
+    partition = models.PositiveSmallIntegerField()
+    xid = models.BigIntegerField(default=0, help_text="Transaction id of the last handled event")
+    position = models.BigIntegerField(default=0, help_text="Id of the last handled event")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Outbox Offset'
+        verbose_name_plural = 'Outbox Offsets'
+        unique_together = ['consumer', 'partition']
+
+    def __str__(self):
+        return f"{self.consumer} [{self.partition}] at {self.xid}:{self.position}"
@@ -0,0 +1,100 @@
+from django.db import transaction as db_transaction
+from django.dispatch import Signal
+from django.utils import timezone
+
+from financeFloww.sharding import shard_for
+from .models import Transaction
+
+# Sent once per bulk operation, inside its database transaction, so derived
+# data can be adjusted in one pass instead of through per-row post_save and
+# post_delete signals. ``before`` and ``after`` are lists of tracked states
+# (see Transaction.TRACKED_FIELDS, plus 'id'); ``before`` entries are None for
+# inserted rows and ``after`` entries are None for deleted rows.
+bulk_transactions_changed = Signal()
+
+# Keeps each IN (...) list well under database parameter limits
+BULK_CHUNK_SIZE = 5000
+
+BULK_STATUS_ACTIONS = {
+    'mark_completed': 'completed',
+    'mark_pending': 'pending',
+    'mark_cancelled': 'cancelled',
+}
+BULK_ACTIONS = [
+    ('categorize', 'Change category'),
+    ('mark_completed', 'Mark completed'),
+    ('mark_pending', 'Mark pending'),
+    ('mark_cancelled', 'Mark cancelled'),
+    ('reconcile', 'Mark reconciled'),
+    ('unreconcile', 'Mark unreconciled'),
+    ('delete', 'Delete'),
+]
+
+
+def _chunks(ids):
+    for start in range(0, len(ids), BULK_CHUNK_SIZE):
+        yield ids[start:start + BULK_CHUNK_SIZE]
+
+
+def _lock_tracked_rows(user, transactions):
+    """Lock the selected rows of the user and return their tracked state"""
+    fields = Transaction.TRACKED_FIELDS + ['id']
+    rows = transactions.filter(user=user).order_by('pk').select_for_update().values_list(*fields)
+    return [dict(zip(fields, row)) for row in rows]
+
+
+def bulk_update_transactions(user, transactions, **changes):
+    """Set fields on many of the user's transactions with set-based UPDATEs
+
+    ``transactions`` is any queryset (ids or a filter); only the user's rows
+    are touched. ``changes`` use attribute names, e.g. category_id=3.
+    Returns the number of updated transactions.
+    """
+    with db_transaction.atomic(using=shard_for(user.pk)):
+        before = _lock_tracked_rows(user, transactions)
+        if not before:
+            return 0
+
+        ids = [row['id'] for row in before]
+        now = timezone.now()
+        for chunk in _chunks(ids):
+            Transaction.objects.filter(user=user, pk__in=chunk).update(updated_at=now, **changes)
+
+        tracked_changes = {field: value for field, value in changes.items() if field in Transaction.TRACKED_FIELDS}
+        after = [{**row, **tracked_changes} for row in before]
+        bulk_transactions_changed.send(sender=Transaction, user_id=user.pk, before=before, after=after)
+    return len(ids)
+
+
+def bulk_delete_transactions(user, transactions):
+    """Delete many of the user's transactions with set-based DELETEs
+
+    Bypasses the ORM collector, which would load every row and send a
+    post_delete signal for each; receivers of bulk_transactions_changed
+    adjust derived data once instead. Returns the number of deleted rows.
+    """
+    with db_transaction.atomic(using=shard_for(user.pk)):
+        before = _lock_tracked_rows(user, transactions)
+        if not before:
+            return 0
+
+        ids = [row['id'] for row in before]
+        for chunk in _chunks(ids):
+            queryset = Transaction.objects.filter(user=user, pk__in=chunk)
+            queryset._raw_delete(queryset.db)
+
+        bulk_transactions_changed.send(sender=Transaction, user_id=user.pk, before=before, after=[None] * len(before))
+    return len(ids)
+
+
+def apply_bulk_action(user, transactions, action, category_id=None):
+    """Run one of BULK_ACTIONS over a queryset of the user's transactions"""
+    if action == 'delete':
+        return bulk_delete_transactions(user, transactions)
+    if action == 'categorize':
+        return bulk_update_transactions(user, transactions, category_id=category_id)
+    if action in BULK_STATUS_ACTIONS:
+        return bulk_update_transactions(user, transactions, status=BULK_STATUS_ACTIONS[action])
+    if action in ('reconcile', 'unreconcile'):
+        return bulk_update_transactions(user, transactions, is_reconciled=action == 'reconcile')
+    raise ValueError(f"Unknown bulk action '{action}'")
@@ -0,0 +1,172 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, router, transaction as db_transaction
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from financeFloww.sharding import shard_for
+from .models import OutboxEvent, OutboxOffset
+
+# Partitions of the feed, by user. Each is read in order on its own, so up
+# to this many workers of one consumer can run at once; changing it
+# reorders unread events, so let the consumers catch up first.
+OUTBOX_PARTITIONS = 16
+CONSUME_BATCH_SIZE = 500
+APPEND_BATCH_SIZE = 1000
+# Events every consumer has handled are kept this long, for inspection and replays
+OUTBOX_RETENTION = timedelta(days=7)
+# Transactions older than this are all finished on PostgreSQL; events of
+# later ones may still commit, so consumers stop at it
+FINISHED_XID_SQL = 'pg_snapshot_xmin(pg_current_snapshot())::text::bigint'
+
+
+def partition_for(user_id):
+    return user_id % OUTBOX_PARTITIONS
+
+
+def _transaction_id(connection):
+    """Id of the database transaction in progress on PostgreSQL, 0 elsewhere
+
+    Ids of events are taken from a sequence at insert time, so they do not
+    follow commit order, and a consumer reading by id could pass an event
+    whose transaction commits later. Consumers read in (xid, id) order and
+    only up to the oldest running transaction instead. SQLite lets one
+    writer in at a time, so there ids do follow commit order.
+    """
+    if connection.vendor != 'postgresql':
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_current_xact_id()::text::bigint')
+        return cursor.fetchone()[0]
+
+
+def append(events, using=None):
+    """Insert OutboxEvents in the current database transaction of their user's shard"""
+    by_shard = defaultdict(list)
+    for event in events:
+        event.partition = partition_for(event.user_id)
+        by_shard[using or shard_for(event.user_id)].append(event)
+    for alias, shard_events in by_shard.items():
+        with db_transaction.atomic(using=alias, savepoint=False):
+            xid = _transaction_id(connections[alias])
+            for event in shard_events:
+                event.xid = xid
+            OutboxEvent.objects.using(alias).bulk_create(shard_events, batch_size=APPEND_BATCH_SIZE)
+
+
+def diff(before, after, context=()):
+    """The changes of a row between two states; a missing state is None
+
+    ``context`` fields are kept on both sides even when unchanged.
+    """
+    if before is None or after is None:
+        return {'before': before, 'after': after}
+    changed = [field for field in after if before.get(field) != after[field] or field in context]
+    return {'before': {field: before.get(field) for field in changed}, 'after': {field: after[field] for field in changed}}
+
+
+def change_event(user_id, model, object_id, before=None, after=None, action=None):
+    """An unsaved OutboxEvent; the action follows from which states are given unless passed"""
+    if action is None:
+        action = 'create' if before is None else 'delete' if after is None else 'update'
+    return OutboxEvent(
+        user_id=user_id,
+        model=model._meta.label_lower,
+        object_id=object_id,
+        action=action,
+        changes=diff(before, after, getattr(model, 'OUTBOX_CONTEXT_FIELDS', ())),
+    )
+
+
+def record(user_id, model, object_ids, before=None, after=None, action=None, using=None):
+    """Append the same change for several rows of one user, e.g. after a queryset update"""
+    append([change_event(user_id, model, pk, before, after, action) for pk in object_ids], using=using)
+
+
+def record_instance(instance, created=False, deleted=False):
+    """Append a save or delete of a budget or savings goal, with its OUTBOX_FIELDS"""
+    state = {field: getattr(instance, field) for field in instance.OUTBOX_FIELDS}
+    if deleted:
+        before, after, action = state, None, 'delete'
+    else:
+        before, after, action = None, state, 'create' if created else 'update'
+    record(instance.user_id, type(instance), [instance.pk], before, after, action, using=instance._state.db)
+
+
+# Consumers ---------------------------------------------------------------------
+
+def consumers():
+    """{name: handler} from settings.OUTBOX_CONSUMERS, which maps names to dotted paths"""
+    return {name: import_string(path) for name, path in getattr(settings, 'OUTBOX_CONSUMERS', {}).items()}
+
+
+def _after(offset):
+    """Condition matching the events that come after an offset"""
+    return Q(xid__gt=offset.xid) | Q(xid=offset.xid, id__gt=offset.position)
+
+
+def consume(name, handler, batch_size=CONSUME_BATCH_SIZE, partitions=None):
+    """Give ``handler`` the next batch of each partition no other worker holds; returns the events handled
+
+    Reads the current shard. A partition is claimed by locking the
+    consumer's offset row with SKIP LOCKED, so workers of one consumer
+    split the partitions between them. The handler gets a list of
+    OutboxEvents in (xid, id) order, all from finished database
+    transactions, so no event can still appear before them. It runs in
+    the database transaction that advances the offset: derived data it
+    writes to this database is applied exactly once, and if it raises the
+    batch is handed out again. Effects outside the database happen at
+    least once.
+    """
+    partitions = range(OUTBOX_PARTITIONS) if partitions is None else partitions
+    OutboxOffset.objects.bulk_create(
+        [OutboxOffset(consumer=name, partition=partition) for partition in partitions],
+        ignore_conflicts=True
+    )
+    alias = router.db_for_write(OutboxOffset)
+    handled = 0
+    for partition in partitions:
+        with db_transaction.atomic(using=alias):
+            offset = OutboxOffset.objects.select_for_update(skip_locked=True).filter(
+                consumer=name,
+                partition=partition
+            ).first()
+            if offset is None:
+                continue
+            events = OutboxEvent.objects.filter(_after(offset), partition=partition)
+            if connections[alias].vendor == 'postgresql':
+                events = events.filter(xid__lt=RawSQL(FINISHED_XID_SQL, []))
+            events = list(events.order_by('xid', 'id')[:batch_size])
+            if not events:
+                continue
+            handler(events)
+            offset.xid, offset.position = events[-1].xid, events[-1].pk
+            offset.save(update_fields=['xid', 'position', 'updated_at'])
+            handled += len(events)
+    return handled
+
+
+def prune_outbox(retention=OUTBOX_RETENTION):
+    """Delete events of the current shard that every consumer has handled and that are older than ``retention``"""
+    names = list(consumers())
+    cutoff = timezone.now() - retention
+    deleted = 0
+    for partition in range(OUTBOX_PARTITIONS):
+        events = OutboxEvent.objects.filter(partition=partition, created_at__lt=cutoff)
+        if names:
+            offsets = {offset.consumer: offset for offset in OutboxOffset.objects.filter(
+                consumer__in=names,
+                partition=partition
+            )}
+            # A consumer that never ran starts from the oldest event
+            slowest = min(
+                (offsets.get(name) or OutboxOffset(partition=partition) for name in names),
+                key=lambda offset: (offset.xid, offset.position),
+            )
+            events = events.exclude(_after(slowest))
+        deleted += events.delete()[0]
+    return deleted
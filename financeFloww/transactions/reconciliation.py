@@ -0,0 +1,162 @@
+import csv
+import io
+from bisect import bisect_left
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction as db_transaction
+from django.utils import timezone
+
+from financeFloww.sharding import shard_for
+from .cache import bump_data_version
+from .models import Transaction
+from .outbox import record
+
+DEFAULT_TOLERANCE_DAYS = 3
+DATE_FORMATS = ['%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%d.%m.%Y']
+
+StatementLine = namedtuple('StatementLine', ['line_number', 'date', 'amount', 'description'])
+
+
+def _parse_date(value):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), date_format).date()
+        except ValueError:
+            continue
+    raise ValueError(f"unrecognised date '{value}'")
+
+
+def _parse_amount(value):
+    cleaned = value.strip().replace(',', '')
+    if not cleaned:
+        return Decimal('0')
+    # Accounting notation: (12.50) is a debit
+    if cleaned.startswith('(') and cleaned.endswith(')'):
+        cleaned = '-' + cleaned[1:-1]
+    try:
+        return Decimal(cleaned)
+    except InvalidOperation:
+        raise ValueError(f"unrecognised amount '{value}'")
+
+
+def parse_statement(data):
+    """Parse a CSV bank statement into StatementLines with signed amounts
+
+    The header must contain a date column and either a signed amount column
+    or separate debit and credit columns. Debits become negative amounts.
+    """
+    if isinstance(data, bytes):
+        data = data.decode('utf-8-sig')
+    reader = csv.DictReader(io.StringIO(data))
+    columns = {name.strip().lower(): name for name in reader.fieldnames or []}
+
+    if 'date' not in columns or not ('amount' in columns or {'debit', 'credit'} <= columns.keys()):
+        raise ValueError("Statement needs a 'date' column and an 'amount' column or 'debit' and 'credit' columns")
+
+    lines = []
+    for line_number, row in enumerate(reader, start=2):
+        try:
+            if 'amount' in columns:
+                amount = _parse_amount(row[columns['amount']] or '')
+            else:
+                amount = _parse_amount(row[columns['credit']] or '') - abs(_parse_amount(row[columns['debit']] or ''))
+            lines.append(StatementLine(
+                line_number=line_number,
+                date=_parse_date(row[columns['date']] or ''),
+                amount=amount,
+                description=(row.get(columns.get('description', ''), '') or '').strip(),
+            ))
+        except ValueError as error:
+            raise ValueError(f"Line {line_number}: {error}")
+    return lines
+
+
+def _signed_cents(transaction_type, amount):
+    cents = int(round(amount * 100))
+    return -cents if transaction_type == 'expense' else cents
+
+
+def build_index(candidates):
+    """Index candidate rows by signed amount in cents, each bucket sorted by date"""
+    index = defaultdict(list)
+    for pk, transaction_type, amount, transaction_date, _ in candidates:
+        index[_signed_cents(transaction_type, amount)].append((transaction_date.toordinal(), pk))
+    for bucket in index.values():
+        bucket.sort()
+    return index
+
+
+def match_lines(lines, index, tolerance_days=DEFAULT_TOLERANCE_DAYS):
+    """Pair each statement line with the closest-dated unclaimed transaction of the same amount
+
+    Returns (matches, unmatched_lines) where matches maps transaction id to
+    its statement line. Each lookup is a hash probe plus a binary search.
+    """
+    matches = {}
+    unmatched = []
+    for line in sorted(lines, key=lambda line: line.date):
+        bucket = index.get(int(round(line.amount * 100)))
+        if not bucket:
+            unmatched.append(line)
+            continue
+
+        ordinal = line.date.toordinal()
+        position = bisect_left(bucket, (ordinal - tolerance_days,))
+        best = None
+        while position < len(bucket) and bucket[position][0] <= ordinal + tolerance_days:
+            if best is None or abs(bucket[position][0] - ordinal) < abs(bucket[best][0] - ordinal):
+                best = position
+            position += 1
+
+        if best is None:
+            unmatched.append(line)
+        else:
+            matches[bucket.pop(best)[1]] = line
+    return matches, unmatched
+
+
+def reconcile_statement(user, lines, tolerance_days=DEFAULT_TOLERANCE_DAYS, commit=True):
+    """Match statement lines to the user's unreconciled transactions and mark the matches reconciled
+
+    Loads every candidate in the statement period in one query and updates
+    all matched rows in one query.
+    """
+    if not lines:
+        return {'matched': [], 'unmatched_lines': [], 'unmatched_transactions': []}
+
+    first_date = min(line.date for line in lines)
+    last_date = max(line.date for line in lines)
+    candidates = list(Transaction.objects.filter(
+        user=user,
+        is_reconciled=False,
+        transaction_date__gte=first_date - timedelta(days=tolerance_days),
+        transaction_date__lte=last_date + timedelta(days=tolerance_days),
+    ).exclude(status='cancelled').order_by().values_list(
+        'id', 'transaction_type', 'amount', 'transaction_date', 'description'
+    ))
+
+    matches, unmatched_lines = match_lines(lines, build_index(candidates), tolerance_days)
+
+    if matches and commit:
+        with db_transaction.atomic(using=shard_for(user.pk)):
+            Transaction.objects.filter(pk__in=list(matches)).update(is_reconciled=True, updated_at=timezone.now())
+            record(user.pk, Transaction, list(matches), {'is_reconciled': False}, {'is_reconciled': True})
+        bump_data_version(user.pk)
+
+    candidates_by_id = {row[0]: row for row in candidates}
+    return {
+        'matched': [
+            {'transaction_id': pk, 'description': candidates_by_id[pk][4], 'line': line}
+            for pk, line in sorted(matches.items(), key=lambda item: item[1].line_number)
+        ],
+        'unmatched_lines': sorted(unmatched_lines, key=lambda line: line.line_number),
+        # Rows picked up only through the tolerance margin are not part of this statement
+        'unmatched_transactions': [
+            {'id': pk, 'transaction_type': transaction_type, 'amount': amount,
+             'transaction_date': transaction_date, 'description': description}
+            for pk, transaction_type, amount, transaction_date, description in sorted(candidates, key=lambda row: row[3])
+            if pk not in matches and first_date <= transaction_date <= last_date
+        ],
+    }
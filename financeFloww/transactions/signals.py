@@ -0,0 +1,111 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .anomalies import SCORED_FIELDS, apply_stats_changes, forget_stats, score_changes, score_transaction
+from .cache import bump_catalog_version, bump_data_version
+from .models import Category, PaymentMethod, Transaction
+from .operations import bulk_transactions_changed
+from .outbox import append, change_event, record
+
+
+@receiver(post_save, sender=Transaction)
+@receiver(post_delete, sender=Transaction)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=PaymentMethod)
+@receiver(post_delete, sender=PaymentMethod)
+def bump_user_data_version(sender, instance, created=False, **kwargs):
+    """Invalidate the owner's cached analytics after any change to their data"""
+    dates = None
+    if sender is Transaction:
+        states = [instance.get_tracked_state()]
+        if not created:
+            states.append(instance.get_previous_state())
+        if all(states):
+            dates = [state['transaction_date'] for state in states]
+    elif sender is PaymentMethod:
+        # Payment methods are not part of any month's category totals
+        dates = ()
+    bump_data_version(instance.user_id, dates)
+
+
+@receiver(bulk_transactions_changed)
+def bump_user_data_version_on_bulk_change(sender, user_id, before, after, **kwargs):
+    """Invalidate the owner's cached analytics once per bulk operation"""
+    dates = [
+        state['transaction_date']
+        for previous, current in zip(before, after) if previous != current
+        for state in (previous, current) if state
+    ]
+    bump_data_version(user_id, dates)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=PaymentMethod)
+@receiver(post_delete, sender=PaymentMethod)
+def bump_user_catalog_version(sender, instance, **kwargs):
+    """Invalidate cached category and payment method names, e.g. in rendered transaction rows"""
+    bump_catalog_version(instance.user_id)
+
+
+@receiver(post_save, sender=Transaction)
+def score_new_transaction(sender, instance, created, raw=False, **kwargs):
+    """Update the category stats and score new or re-valued transactions against them"""
+    if raw:
+        return
+    previous = None if created else instance.get_previous_state()
+    current = {field: getattr(instance, field) for field in SCORED_FIELDS}
+    if not created and previous is None:
+        # The amount to take out of the stats is unknown
+        forget_stats(instance.user_id)
+    elif previous and all(previous[field] == current[field] for field in SCORED_FIELDS):
+        return
+    score_transaction(instance, apply_stats_changes(instance.user_id, [(previous, current)]))
+
+
+@receiver(post_delete, sender=Transaction)
+def unscore_deleted_transaction(sender, instance, **kwargs):
+    """Take a deleted transaction out of its category stats"""
+    previous = instance.get_previous_state()
+    if previous is None:
+        forget_stats(instance.user_id)
+    else:
+        apply_stats_changes(instance.user_id, [(previous, None)])
+
+
+@receiver(bulk_transactions_changed)
+def rescore_on_bulk_change(sender, user_id, before, after, **kwargs):
+    """Update the category stats with a bulk change and score the rows it added or re-valued"""
+    score_changes(user_id, zip(before, after))
+
+
+@receiver(post_save, sender=Transaction)
+def record_transaction_save(sender, instance, created, raw=False, **kwargs):
+    """Append the change to the outbox, in the database transaction of the save"""
+    if raw:
+        return
+    before = None if created else instance.get_previous_state()
+    record(
+        instance.user_id, Transaction, [instance.pk], before, instance.get_tracked_state(),
+        action='create' if created else 'update', using=instance._state.db
+    )
+
+
+@receiver(post_delete, sender=Transaction)
+def record_transaction_delete(sender, instance, **kwargs):
+    """Append the delete to the outbox, in the collector's database transaction"""
+    state = instance.get_previous_state() or instance.get_tracked_state()
+    record(instance.user_id, Transaction, [instance.pk], state, None, action='delete', using=instance._state.db)
+
+
+@receiver(bulk_transactions_changed)
+def record_bulk_change(sender, user_id, before, after, **kwargs):
+    """Append one event per row of a bulk operation, in a single insert"""
+    events = []
+    for previous, current in zip(before, after):
+        object_id = (current or previous)['id']
+        previous = {field: value for field, value in previous.items() if field != 'id'} if previous else None
+        current = {field: value for field, value in current.items() if field != 'id'} if current else None
+        events.append(change_event(user_id, Transaction, object_id, previous, current))
+    append(events)
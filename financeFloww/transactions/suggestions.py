@@ -0,0 +1,319 @@
+import hashlib
+from collections import Counter, defaultdict
+from datetime import date
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction as db_transaction
+from django.db.models import Case, Count, IntegerField, Max, Value, When
+
+from financeFloww.sharding import current_shard, shard_for, user_shard
+from .cache import bump_suggestions_version, get_suggestions_version
+from .models import Category, DescriptionSuggestion, PaymentMethod, Transaction
+
+# Suggestions returned per query
+SUGGESTION_LIMIT = 8
+# Shorter queries match the start of descriptions only; pg_trgm needs three characters to use its index
+MIN_SUBSTRING_LENGTH = 3
+# Queries up to this length, the first keystrokes of every entry, are answered from the cache
+CACHED_PREFIX_LENGTH = 4
+SUGGESTIONS_CACHE_KEY = 'description-suggestions:{user_id}:{version}:{prefix}'
+SUGGESTIONS_CACHE_TIMEOUT = 60 * 60 * 24
+SUGGESTION_WRITE_BATCH_SIZE = 1000
+# Transaction fields a suggestion is computed from; outbox events carry them (see Transaction.OUTBOX_CONTEXT_FIELDS)
+SUGGESTION_FIELDS = ['description', 'category_id', 'payment_method_id', 'transaction_date']
+# Usage of an event state that lacks some SUGGESTION_FIELDS
+UNKNOWN = object()
+
+
+def _most_common(counter, known=None):
+    """Key with the highest positive count, skipping ids not in ``known``; None stays allowed"""
+    for key, count in counter.most_common():
+        if count > 0 and (known is None or key is None or key in known):
+            return key
+    return None
+
+
+def _uses(counter):
+    """JSON form of a Counter of ids, [[id, count], ...] in id order with None first"""
+    return [[key, count] for key, count in sorted(counter.items(), key=lambda item: (item[0] is not None, item[0] or 0))
+            if count > 0]
+
+
+def aggregate_descriptions(user_id, descriptions=None):
+    """{description: (use_count, last_used, category_id, payment_method_id, category_uses, payment_method_uses)}
+
+    Over the user's transactions, or only those with ``descriptions``.
+    Archived transactions do not count: archiving appends a delete event
+    per row (see transactions.archive), so the deltas leave them out too.
+    """
+    transactions = Transaction.objects.filter(user_id=user_id)
+    if descriptions is not None:
+        transactions = transactions.filter(description__in=descriptions)
+    groups = transactions.order_by().values(
+        'description', 'category_id', 'payment_method_id'
+    ).annotate(uses=Count('id'), last_used=Max('transaction_date')).values_list(
+        'description', 'category_id', 'payment_method_id', 'uses', 'last_used'
+    )
+    uses, last_used = Counter(), {}
+    categories, payment_methods = defaultdict(Counter), defaultdict(Counter)
+    for description, category_id, payment_method_id, count, last in groups:
+        if not description:
+            continue
+        uses[description] += count
+        last_used[description] = max(last, last_used.get(description, last))
+        categories[description][category_id] += count
+        if payment_method_id is not None:
+            payment_methods[description][payment_method_id] += count
+    return {
+        description: (
+            count,
+            last_used[description],
+            _most_common(categories[description]),
+            _most_common(payment_methods[description]),
+            _uses(categories[description]),
+            _uses(payment_methods[description]),
+        )
+        for description, count in uses.items()
+    }
+
+
+def _write_suggestions(user_id, changed, stale):
+    DescriptionSuggestion.objects.bulk_create(
+        changed,
+        batch_size=SUGGESTION_WRITE_BATCH_SIZE,
+        update_conflicts=True,
+        unique_fields=['user', 'description'],
+        update_fields=[
+            'use_count', 'last_used', 'category', 'payment_method', 'category_uses', 'payment_method_uses',
+        ],
+    )
+    for start in range(0, len(stale), SUGGESTION_WRITE_BATCH_SIZE):
+        DescriptionSuggestion.objects.filter(pk__in=stale[start:start + SUGGESTION_WRITE_BATCH_SIZE]).delete()
+    if changed or stale:
+        bump_suggestions_version(user_id)
+
+
+def rebuild_suggestions(user_id):
+    """Bring the user's suggestions in line with their transactions; returns (rows written, rows deleted)
+
+    Recomputed with one grouped query over the user's transactions, but
+    only new and changed descriptions are written, so a rebuild after a
+    handful of new transactions touches a handful of rows and index entries.
+    Outbox events not consumed yet are counted again once they are, so
+    rebuilds of every user are best run while the consumer is caught up.
+    """
+    wanted = aggregate_descriptions(user_id)
+    stored = {
+        description: (pk, values)
+        for pk, description, *values in DescriptionSuggestion.objects.filter(user_id=user_id).values_list(
+            'id', 'description', 'use_count', 'last_used', 'category_id', 'payment_method_id',
+            'category_uses', 'payment_method_uses',
+        )
+    }
+    changed = [
+        DescriptionSuggestion(
+            user_id=user_id,
+            description=description,
+            use_count=use_count,
+            last_used=last_used,
+            category_id=category_id,
+            payment_method_id=payment_method_id,
+            category_uses=category_uses,
+            payment_method_uses=payment_method_uses,
+        )
+        for description, (use_count, last_used, category_id, payment_method_id, category_uses, payment_method_uses)
+        in wanted.items()
+        if description not in stored or tuple(stored[description][1]) != wanted[description]
+    ]
+    stale = [pk for description, (pk, _) in stored.items() if description not in wanted]
+    _write_suggestions(user_id, changed, stale)
+    return len(changed), len(stale)
+
+
+def _usage(state):
+    """(description, category_id, payment_method_id, date) a transaction state counts towards
+
+    None when it counts towards no suggestion, UNKNOWN when the state
+    lacks the fields.
+    """
+    if state is None or any(field not in state for field in SUGGESTION_FIELDS):
+        return UNKNOWN
+    if not state['description']:
+        return None
+    return (
+        state['description'],
+        state['category_id'],
+        state['payment_method_id'],
+        date.fromisoformat(str(state['transaction_date'])),
+    )
+
+
+def _event_usages(event):
+    """(old usage, new usage) of a transaction event, or None when they cannot be told"""
+    before, after = event.changes.get('before'), event.changes.get('after')
+    if event.action == 'update' and not (set(before or ()) | set(after or ())) & set(SUGGESTION_FIELDS):
+        # e.g. a reconciliation
+        return None, None
+    old = None if event.action == 'create' else _usage(before)
+    new = None if event.action == 'delete' else _usage(after)
+    if old is UNKNOWN or new is UNKNOWN:
+        return None
+    return old, new
+
+
+def apply_usage_changes(user_id, pairs):
+    """Adjust the user's suggestions by (old usage, new usage) pairs of changed transactions
+
+    Counts move by delta. Only when a removed use was on its description's
+    last_used day is that day looked up again, in one grouped query over
+    those descriptions of the hot table, like aggregate_descriptions.
+    """
+    deltas = defaultdict(lambda: {'uses': 0, 'categories': Counter(), 'payment_methods': Counter(), 'latest': None})
+    removed_days = defaultdict(set)
+    for old, new in pairs:
+        for usage, sign in ((old, -1), (new, 1)):
+            if usage is None:
+                continue
+            description, category_id, payment_method_id, day = usage
+            delta = deltas[description]
+            delta['uses'] += sign
+            delta['categories'][category_id] += sign
+            if payment_method_id is not None:
+                delta['payment_methods'][payment_method_id] += sign
+            if sign > 0:
+                delta['latest'] = max(day, delta['latest'] or day)
+            else:
+                removed_days[description].add(day)
+    if not deltas:
+        return
+
+    stored = {
+        suggestion.description: suggestion
+        for suggestion in DescriptionSuggestion.objects.filter(user_id=user_id, description__in=list(deltas))
+    }
+    if any(not suggestion.category_uses for suggestion in stored.values()):
+        # Written before the per-category counts were kept
+        rebuild_suggestions(user_id)
+        return
+
+    refreshed = [
+        description for description, suggestion in stored.items()
+        if suggestion.last_used in removed_days[description]
+    ]
+    last_used = dict(
+        Transaction.objects.filter(user_id=user_id, description__in=refreshed).order_by().values(
+            'description'
+        ).annotate(last=Max('transaction_date')).values_list('description', 'last')
+    ) if refreshed else {}
+
+    changed, stale, totals = [], [], []
+    for description, delta in deltas.items():
+        suggestion = stored.get(description)
+        if suggestion is None:
+            if delta['uses'] <= 0 or delta['latest'] is None:
+                continue
+            suggestion = DescriptionSuggestion(user_id=user_id, description=description, use_count=0)
+        use_count = suggestion.use_count + delta['uses']
+        if use_count <= 0:
+            if suggestion.pk:
+                stale.append(suggestion.pk)
+            continue
+        categories = Counter(dict(map(tuple, suggestion.category_uses)))
+        categories.update(delta['categories'])
+        payment_methods = Counter(dict(map(tuple, suggestion.payment_method_uses)))
+        payment_methods.update(delta['payment_methods'])
+        days = [day for day in (last_used.get(description, suggestion.last_used), delta['latest']) if day]
+        suggestion.use_count = use_count
+        suggestion.last_used = max(days)
+        suggestion.category_uses = _uses(categories)
+        suggestion.payment_method_uses = _uses(payment_methods)
+        changed.append(suggestion)
+        totals.append((suggestion, categories, payment_methods))
+
+    # Categories and payment methods deleted since are not suggested
+    known_categories = set(Category.objects.filter(
+        user_id=user_id, pk__in={key for _, categories, _ in totals for key in categories if key is not None}
+    ).values_list('pk', flat=True))
+    known_payment_methods = set(PaymentMethod.objects.filter(
+        user_id=user_id, pk__in={key for _, _, payment_methods in totals for key in payment_methods}
+    ).values_list('pk', flat=True))
+    for suggestion, categories, payment_methods in totals:
+        suggestion.category_id = _most_common(categories, known_categories)
+        suggestion.payment_method_id = _most_common(payment_methods, known_payment_methods)
+
+    _write_suggestions(user_id, changed, stale)
+
+
+def apply_events(events):
+    """Outbox consumer: adjust the suggestions of the users whose transactions changed
+
+    Events carry the description, category, payment method and date of
+    their row (Transaction.OUTBOX_CONTEXT_FIELDS), so counts are updated by
+    delta in the consumer's database transaction and applied exactly once.
+    Users with events that lack them, e.g. ones appended before they were
+    carried, and users moved to another shard since are rebuilt instead.
+    """
+    label = Transaction._meta.label_lower
+    changes, rebuilt = defaultdict(list), set()
+    for event in events:
+        if event.model != label:
+            continue
+        usages = _event_usages(event)
+        if usages is None:
+            rebuilt.add(event.user_id)
+        elif usages[0] != usages[1]:
+            changes[event.user_id].append(usages)
+
+    # Suggestions of deleted users went with them
+    users = set(User.objects.filter(pk__in=rebuilt | changes.keys()).values_list('pk', flat=True))
+    shard = current_shard()
+    for user_id in sorted(users):
+        if user_id in rebuilt or shard_for(user_id) != shard:
+            with user_shard(user_id) as alias, db_transaction.atomic(using=alias):
+                rebuild_suggestions(user_id)
+        else:
+            with user_shard(user_id):
+                apply_usage_changes(user_id, changes[user_id])
+
+
+def _query_suggestions(user_id, query):
+    suggestions = DescriptionSuggestion.objects.filter(user_id=user_id)
+    if len(query) < MIN_SUBSTRING_LENGTH:
+        suggestions = suggestions.filter(description__istartswith=query).order_by('-use_count', '-last_used')
+    else:
+        # Served by the trigram index on PostgreSQL; descriptions starting with the query come first
+        suggestions = suggestions.filter(description__icontains=query).annotate(
+            prefix_rank=Case(
+                When(description__istartswith=query, then=Value(0)),
+                default=Value(1),
+                output_field=IntegerField(),
+            )
+        ).order_by('prefix_rank', '-use_count', '-last_used')
+    return [
+        {'description': description, 'category': category_id, 'payment_method': payment_method_id, 'uses': uses}
+        for description, category_id, payment_method_id, uses in suggestions.values_list(
+            'description', 'category_id', 'payment_method_id', 'use_count'
+        )[:SUGGESTION_LIMIT]
+    ]
+
+
+def suggest_descriptions(user_id, query):
+    """The user's previous descriptions matching what they typed, most used first
+
+    Each comes with the category and payment method most often used with
+    it. Short queries are cached per user until the suggestions are rebuilt.
+    """
+    query = query.strip()
+    if not query:
+        return []
+    if len(query) > CACHED_PREFIX_LENGTH:
+        return _query_suggestions(user_id, query)
+
+    prefix = hashlib.md5(query.upper().encode('utf-8')).hexdigest()
+    key = SUGGESTIONS_CACHE_KEY.format(user_id=user_id, version=get_suggestions_version(user_id), prefix=prefix)
+    suggestions = cache.get(key)
+    if suggestions is None:
+        suggestions = _query_suggestions(user_id, query)
+        cache.set(key, suggestions, SUGGESTIONS_CACHE_TIMEOUT)
+    return suggestions
@@ -1,3 +1,429 @@
-from django.test import TestCase
+import threading
+from datetime import date
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import IntegrityError, connection, connections, transaction as db_transaction
+from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from budgets.models import Budget, BudgetAlert
+from .anomalies import ANOMALY_THRESHOLD, detect_anomalies
+from .archive import archive_year, restore_year
+from .ingest import INGEST_ATTEMPTS, ingest_transactions, stored_keys
+from .merge import merge_categories
+from .models import Category, CategoryStats, DescriptionSuggestion, OutboxEvent, OutboxOffset, Transaction
+from .outbox import consume, partition_for, record
+from .suggestions import aggregate_descriptions, apply_events
+
+LOCAL_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+# Longest a test waits on another thread before failing instead of hanging
+THREAD_TIMEOUT = 10
+
+
+def append(user, *object_ids):
+    record(user.pk, Transaction, object_ids, after={'amount': '1.00'})
+
+
+def in_thread(target):
+    def run():
+        try:
+            target()
+        finally:
+            connections.close_all()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class OutboxConsumeTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('reader', 'reader@example.com', 'secret')
+
+    def test_each_event_is_handled_once(self):
+        seen = []
+        append(self.user, 1, 2, 3)
+        self.assertEqual(consume('index', seen.extend), 3)
+        append(self.user, 4)
+        self.assertEqual(consume('index', seen.extend), 1)
+        self.assertEqual(consume('index', seen.extend), 0)
+        self.assertEqual([event.object_id for event in seen], [1, 2, 3, 4])
+
+    def test_consumers_keep_their_own_offsets(self):
+        first, second = [], []
+        append(self.user, 1, 2)
+        consume('index', first.extend)
+        consume('audit', second.extend)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 2)
+
+    def test_failed_batch_is_rolled_back_and_handed_out_again(self):
+        append(self.user, 1, 2)
+
+        def fail(events):
+            OutboxOffset.objects.create(consumer='written-by-handler', partition=0)
+            raise RuntimeError("handler failed")
+
+        with self.assertRaises(RuntimeError):
+            consume('index', fail)
+        self.assertFalse(OutboxOffset.objects.filter(consumer='written-by-handler').exists())
+
+        seen = []
+        self.assertEqual(consume('index', seen.extend), 2)
+        self.assertEqual([event.object_id for event in seen], [1, 2])
+
+    def test_archiving_appends_events_for_the_moved_rows(self):
+        kept = Transaction.objects.create(
+            user=self.user, transaction_type='expense', amount=Decimal('2.00'), description='Tea',
+            transaction_date=date(2024, 5, 1),
+        )
+        moved = [
+            Transaction.objects.create(
+                user=self.user, transaction_type='expense', amount=Decimal('3.00'), description='Bus',
+                transaction_date=day,
+            ).pk
+            for day in (date(2020, 3, 1), date(2020, 7, 1))
+        ]
+        consume('index', list)
+
+        seen = []
+        archive_year(self.user.pk, 2020, batch_size=1)
+        consume('index', seen.extend)
+        restore_year(self.user.pk, 2020)
+        consume('index', seen.extend)
+
+        self.assertEqual(
+            [(event.object_id, event.action) for event in seen],
+            [(pk, 'delete') for pk in moved] + [(pk, 'create') for pk in moved],
+        )
+        self.assertEqual(seen[0].changes['before']['description'], 'Bus')
+        self.assertEqual(seen[-1].changes['after']['transaction_date'], '2020-07-01')
+        self.assertNotIn(kept.pk, [event.object_id for event in seen])
+
+
+@skipUnlessDBFeature('has_select_for_update_skip_locked')
+@override_settings(CACHES=LOCAL_CACHE)
+class OutboxConcurrencyTests(TransactionTestCase):
+    def setUp(self):
+        self.first = User.objects.create_user('first', 'first@example.com', 'secret')
+        self.second = User.objects.create_user('second', 'second@example.com', 'secret')
+
+    def test_workers_skip_partitions_held_by_another(self):
+        append(self.first, 1, 2)
+        append(self.second, 3)
+        held, release = threading.Event(), threading.Event()
+        seen_by_worker, seen = [], []
+
+        def hold(events):
+            seen_by_worker.extend(events)
+            held.set()
+            release.wait(THREAD_TIMEOUT)
+
+        worker = in_thread(lambda: consume('index', hold, partitions=[partition_for(self.first.pk)]))
+        self.assertTrue(held.wait(THREAD_TIMEOUT))
+        # The worker's partition is locked, so only the other one is handed out
+        self.assertEqual(consume('index', seen.extend), 1)
+        release.set()
+        worker.join(THREAD_TIMEOUT)
+
+        self.assertEqual(consume('index', seen.extend), 0)
+        self.assertEqual([event.object_id for event in seen_by_worker], [1, 2])
+        self.assertEqual([event.object_id for event in seen], [3])
+
+    def test_events_wait_for_older_transactions_to_finish(self):
+        appended, release = threading.Event(), threading.Event()
+
+        def slow_writer():
+            with db_transaction.atomic():
+                append(self.first, 1)
+                appended.set()
+                release.wait(THREAD_TIMEOUT)
+
+        writer = in_thread(slow_writer)
+        self.assertTrue(appended.wait(THREAD_TIMEOUT))
+        # Committed first, but its transaction started after the writer's
+        append(self.first, 2)
+
+        seen = []
+        self.assertEqual(consume('index', seen.extend), 0)
+        release.set()
+        writer.join(THREAD_TIMEOUT)
+        self.assertEqual(consume('index', seen.extend), 2)
+        self.assertEqual([event.object_id for event in seen], [1, 2])
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class DescriptionSuggestionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('typist', 'typist@example.com', 'secret')
+        self.coffee = Category.objects.create(user=self.user, name='Coffee', category_type='expense')
+        self.food = Category.objects.create(user=self.user, name='Food', category_type='expense')
+
+    def create(self, description, category, day=date(2024, 5, 1)):
+        return Transaction.objects.create(
+            user=self.user, category=category, transaction_type='expense', amount=Decimal('4.20'),
+            description=description, transaction_date=day,
+        )
+
+    def consume(self):
+        consume('description-suggestions', apply_events)
+
+    def stored(self):
+        return {
+            description: (use_count, last_used, category_id)
+            for description, use_count, last_used, category_id in DescriptionSuggestion.objects.filter(
+                user=self.user
+            ).values_list('description', 'use_count', 'last_used', 'category_id')
+        }
+
+    def category_uses(self, description):
+        return DescriptionSuggestion.objects.get(user=self.user, description=description).category_uses
+
+    def rebuilt(self):
+        return {
+            description: (use_count, last_used, category_id)
+            for description, (use_count, last_used, category_id, *_) in aggregate_descriptions(self.user.pk).items()
+        }
+
+    def test_events_carry_the_description_of_unchanged_rows(self):
+        transaction = self.create('Flat white', self.coffee)
+        transaction.status = 'pending'
+        transaction.save()
+        changes = OutboxEvent.objects.latest('id').changes
+        self.assertEqual(changes['before']['description'], 'Flat white')
+        self.assertEqual(changes['after']['description'], 'Flat white')
+
+    def test_suggestions_follow_changes_by_delta(self):
+        first = self.create('Flat white', self.coffee, date(2024, 5, 1))
+        self.create('Flat white', self.coffee, date(2024, 5, 3))
+        latest = self.create('Flat white', self.food, date(2024, 5, 9))
+        self.consume()
+        self.assertEqual(self.stored(), {'Flat white': (3, date(2024, 5, 9), self.coffee.pk)})
+
+        first.category = self.food
+        first.save()
+        latest.description = 'Bagel'
+        latest.save()
+        self.consume()
+        self.assertEqual(self.stored(), self.rebuilt())
+
+        latest.delete()
+        first.delete()
+        self.consume()
+        self.assertEqual(self.stored(), {'Flat white': (1, date(2024, 5, 3), self.coffee.pk)})
+        self.assertEqual(self.stored(), self.rebuilt())
+
+    def test_archived_transactions_are_left_out_on_both_paths(self):
+        self.create('Flat white', self.coffee, date(2020, 6, 1))
+        self.create('Flat white', self.coffee, date(2020, 9, 1))
+        self.create('Flat white', self.food, date(2024, 5, 1))
+        self.create('Bagel', self.food, date(2020, 2, 1))
+        self.consume()
+        archive_year(self.user.pk, 2020)
+        merge_categories(self.user, [self.coffee], self.food)
+        self.consume()
+        self.assertEqual(self.stored(), {'Flat white': (1, date(2024, 5, 1), self.food.pk)})
+        self.assertEqual(self.stored(), self.rebuilt())
+        self.assertEqual(self.category_uses('Flat white'), [[self.food.pk, 1]])
+
+        restore_year(self.user.pk, 2020)
+        self.consume()
+        self.assertEqual(self.stored()['Flat white'], (3, date(2024, 5, 1), self.food.pk))
+        self.assertEqual(self.stored(), self.rebuilt())
+        self.assertEqual(self.category_uses('Flat white'), [[self.food.pk, 3]])
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class AnomalyScoreTests(TestCase):
+    # Grocery runs with two earlier large shops, which inflate a standard deviation but not the MAD
+    HISTORY = ['42.50', '48.00', '51.20', '39.90', '55.00', '47.30', '60.10', '44.00',
+               '52.80', '49.50', '58.00', '45.60', '120.00', '150.00', '41.20', '53.30']
+
+    def setUp(self):
+        self.user = User.objects.create_user('scored', 'scored@example.com', 'secret')
+        self.food = Category.objects.create(user=self.user, name='Food', category_type='expense')
+
+    def create(self, amount):
+        return Transaction.objects.create(
+            user=self.user, category=self.food, transaction_type='expense', amount=amount,
+            description='Groceries', transaction_date=date(2024, 5, 1),
+        )
+
+    def stats(self):
+        return {
+            (row.category_key, row.transaction_type): row.count
+            for row in CategoryStats.objects.filter(user=self.user)
+        }
+
+    def test_save_time_scores_agree_with_the_nightly_pass(self):
+        for amount in self.HISTORY:
+            self.create(amount)
+        detect_anomalies([self.user.pk])
+
+        for amount in ('55.00', '80.00', '95.00', '160.00'):
+            saved = self.create(amount)
+            detect_anomalies([self.user.pk])
+            nightly = Transaction.objects.get(pk=saved.pk)
+            self.assertEqual(saved.is_anomaly, nightly.is_anomaly, amount)
+            self.assertAlmostEqual(saved.anomaly_score, nightly.anomaly_score, delta=0.5)
+            nightly.delete()
+
+    def test_groups_without_spread_score_zero(self):
+        scores = [self.create('7.00').anomaly_score for _ in range(10)]
+        self.assertEqual(scores[-2:], [0.0, 0.0])
+
+    def test_stats_follow_writes_without_the_nightly_pass(self):
+        first, *rest = [self.create(amount) for amount in self.HISTORY]
+        self.assertEqual(self.stats(), {(self.food.pk, 'expense'): len(self.HISTORY)})
+        self.assertGreater(self.create('400.00').anomaly_score, ANOMALY_THRESHOLD)
+
+        first.category = None
+        first.save()
+        rest[0].status = 'pending'
+        rest[0].save()
+        rest[1].delete()
+        self.create('10.00').delete()
+        incremental = self.stats()
+
+        detect_anomalies([self.user.pk])
+        self.assertEqual(incremental, self.stats())
+        self.assertEqual(incremental, {(self.food.pk, 'expense'): len(self.HISTORY) - 2, (0, 'expense'): 1})
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class CategoryMergeTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('merger', 'merger@example.com', 'secret')
+        self.target = Category.objects.create(user=self.user, name='Food', category_type='expense')
+        self.sources = [
+            Category.objects.create(user=self.user, name=name, category_type='expense') for name in ('Lunch', 'Snacks')
+        ]
+
+    def budget(self, category, day):
+        budget = Budget.objects.create(user=self.user, category=category, amount=Decimal('50.00'), start_date=day)
+        BudgetAlert.objects.create(budget=budget, user=self.user, message='80% spent', percentage_at_trigger=80)
+        return budget
+
+    def test_alerts_of_folded_budgets_move_in_one_update(self):
+        kept = self.budget(self.target, date(2024, 5, 1))
+        folded = [self.budget(category, date(2024, 5, 1)) for category in self.sources]
+        survivor = self.budget(self.sources[0], date(2024, 6, 1))
+        oldest = self.budget(self.sources[1], date(2024, 6, 1))
+        table = BudgetAlert._meta.db_table
+
+        with CaptureQueriesContext(connection) as queries:
+            merge_categories(self.user, self.sources, self.target)
+
+        self.assertEqual(len([query for query in queries if query['sql'].startswith(f'UPDATE "{table}"')]), 1)
+        self.assertEqual(
+            sorted(BudgetAlert.objects.values_list('budget_id', flat=True)),
+            [kept.pk] * 3 + [survivor.pk] * 2,
+        )
+        self.assertEqual(set(Budget.objects.values_list('pk', flat=True)), {kept.pk, survivor.pk})
+        self.assertFalse(Budget.objects.filter(pk__in=[budget.pk for budget in folded] + [oldest.pk]).exists())
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class BulkActionViewTests(TestCase):
+    def setUp(self):
+        # Users are cached by id, and ids are reused once a test rolls back
+        cache.clear()
+        self.user = User.objects.create_user('bulk', 'bulk@example.com', 'secret')
+        self.client.force_login(self.user)
+        for day in (date(2024, 5, 1), date(2024, 6, 1)):
+            Transaction.objects.create(
+                user=self.user, transaction_type='expense', amount=Decimal('3.00'),
+                description='Bus', transaction_date=day,
+            )
+
+    def post(self, action, query):
+        return self.client.post(
+            reverse('transaction_bulk_action'), {'action': action, 'select_all': 'on', 'query': query}, follow=True
+        )
+
+    def test_invalid_filters_are_reported_not_applied(self):
+        for query in ('category=abc', 'date_from=zzz'):
+            response = self.post('mark_pending', query)
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, 'The list filter is not valid')
+        self.assertFalse(Transaction.objects.filter(status='pending').exists())
+
+    def test_delete_needs_a_narrowing_filter(self):
+        response = self.post('delete', 'page=2')
+        self.assertContains(response, 'Filter the list before applying this action')
+        self.assertEqual(Transaction.objects.count(), 2)
+
+        self.post('delete', 'date_from=2024-06-01&page=2')
+        self.assertEqual(list(Transaction.objects.values_list('transaction_date', flat=True)), [date(2024, 5, 1)])
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class IngestTests(TestCase):
+    def setUp(self):
+        # The choices the items are validated against are cached by user id
+        cache.clear()
+        self.user = User.objects.create_user('importer', 'importer@example.com', 'secret')
+        self.food = Category.objects.create(user=self.user, name='Food', category_type='expense')
+
+    def item(self, key, amount='5.00', day='2024-05-01', description='Lunch'):
+        return {
+            'idempotency_key': key, 'transaction_type': 'expense', 'amount': amount,
+            'description': description, 'transaction_date': day, 'category': self.food.pk,
+        }
+
+    def test_keys_stored_by_a_concurrent_request_are_reported(self):
+        stored = ingest_transactions(self.user, [self.item('first')])[0]['id']
+        lookups = []
+
+        def racing_lookup(user_id, keys):
+            # The concurrent request commits after the first lookup
+            lookups.append(keys)
+            return {} if len(lookups) == 1 else stored_keys(user_id, keys)
+
+        # Fingerprint matches would be reported before the key conflict
+        items = [{**self.item('first'), 'allow_duplicate': True}, self.item('second', day='2024-05-02')]
+        with mock.patch('transactions.ingest.stored_keys', racing_lookup):
+            results = ingest_transactions(self.user, items)
+
+        self.assertEqual([result['status'] for result in results], ['exists', 'created'])
+        self.assertEqual(results[0]['id'], stored)
+        self.assertEqual(Transaction.objects.filter(user=self.user).count(), 2)
+
+    def test_conflicts_are_retried_a_bounded_number_of_times(self):
+        ingest_transactions(self.user, [self.item('first')])
+        lookup = mock.Mock(return_value={})
+        items = [{**self.item('first'), 'allow_duplicate': True}, self.item('second', day='2024-05-02')]
+        with mock.patch('transactions.ingest.stored_keys', lookup), self.assertRaises(IntegrityError):
+            ingest_transactions(self.user, items)
+        self.assertEqual(lookup.call_count, INGEST_ATTEMPTS)
+        self.assertEqual(Transaction.objects.filter(user=self.user).count(), 1)
+
+    def test_derived_data_of_an_ingest_equals_a_rebuild(self):
+        items = [
+            self.item(f'key-{number}', amount=f'{4 + number % 5}.50', day=f'2024-0{3 + number % 3}-1{number % 9}',
+                      description=('Lunch', 'Coffee')[number % 2])
+            for number in range(12)
+        ]
+        ingest_transactions(self.user, items[:6])
+        ingest_transactions(self.user, items)
+        consume('description-suggestions', apply_events)
+        stats = list(CategoryStats.objects.filter(user=self.user).values_list('category_key', 'transaction_type', 'count'))
+        suggestions = list(DescriptionSuggestion.objects.filter(user=self.user).order_by('description').values_list(
+            'description', 'use_count', 'last_used', 'category_id', 'category_uses'
+        ))
+
+        detect_anomalies([self.user.pk])
+        self.assertEqual(stats, [(self.food.pk, 'expense', 12)])
+        self.assertEqual(
+            stats, list(CategoryStats.objects.filter(user=self.user).values_list('category_key', 'transaction_type', 'count'))
+        )
+        self.assertEqual(suggestions, [
+            (description, use_count, last_used, category_id, category_uses)
+            for description, (use_count, last_used, category_id, _, category_uses, _)
+            in sorted(aggregate_descriptions(self.user.pk).items())
+        ])
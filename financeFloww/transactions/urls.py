@@ -1,19 +1,26 @@
 from django.urls import path
-from . import views
+from . import api, views
 
 urlpatterns = [
     # Transaction URLs
     path('', views.transaction_list, name='transaction_list'),
     path('create/', views.transaction_create, name='transaction_create'),
+    path('export/', views.transaction_export, name='transaction_export'),
+    path('suggestions/', views.transaction_suggestions, name='transaction_suggestions'),
     path('<int:pk>/', views.transaction_detail, name='transaction_detail'),
     path('<int:pk>/edit/', views.transaction_edit, name='transaction_edit'),
     path('<int:pk>/delete/', views.transaction_delete, name='transaction_delete'),
+    path('reconcile/', views.transaction_reconcile, name='transaction_reconcile'),
+    path('bulk/', views.transaction_bulk_action, name='transaction_bulk_action'),
+    path('api/bulk/', api.TransactionBulkActionView.as_view(), name='api_transaction_bulk_action'),
+    path('api/ingest/', api.TransactionIngestView.as_view(), name='api_transaction_ingest'),
     
     # Category URLs
     path('categories/', views.category_list, name='category_list'),
     path('categories/create/', views.category_create, name='category_create'),
     path('categories/<int:pk>/edit/', views.category_edit, name='category_edit'),
     path('categories/<int:pk>/delete/', views.category_delete, name='category_delete'),
+    path('categories/<int:pk>/merge/', views.category_merge, name='category_merge'),
     
     # Payment Method URLs
     path('payment-methods/', views.payment_method_list, name='payment_method_list'),
@@ -1,12 +1,40 @@
+import csv
+import heapq
+
 from django.shortcuts import render, redirect, get_object_or_404
+from django.http import JsonResponse, QueryDict, StreamingHttpResponse
+from django.urls import reverse
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.views.decorators.http import require_http_methods
 from django.db.models import Q, Sum
 from django.utils import timezone
 from datetime import timedelta
+from accounts.deletion import pending_deletion, start_deletion
 from .models import Transaction, Category, PaymentMethod
-from .forms import TransactionForm, CategoryForm, PaymentMethodForm, TransactionFilterForm
+from .forms import (
+    TransactionForm, CategoryForm, CategoryMergeForm, PaymentMethodForm, TransactionFilterForm, StatementUploadForm, BulkActionForm
+)
+from .merge import merge_categories
+from .operations import apply_bulk_action
+from .reconciliation import reconcile_statement
+from .suggestions import suggest_descriptions
+from .cache import get_catalog_version
+from .filters import archived_transactions, filter_transactions
+
+# Rendered rows are keyed on their own updated_at, so they can live long
+ROW_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+EXPORT_COLUMNS = [
+    'Date', 'Type', 'Amount', 'Description', 'Category', 'Payment Method', 'Status', 'Reconciled', 'Tags', 'Notes',
+]
+
+
+class Echo:
+    """File-like object that returns what is written, for streaming csv.writer output"""
+
+    def write(self, value):
+        return value
 
 
 @login_required
@@ -15,56 +43,71 @@ def transaction_list(request):
     transactions = Transaction.objects.filter(user=request.user).select_related('category', 'payment_method')
     
     # Apply filters
-
-    filter_form = TransactionFilterForm(request.GET)
-    filter_form.fields['category'].queryset = request.user.categories.filter(is_active=True)
-    filter_form.fields['payment_method'].queryset = request.user.payment_methods.filter(is_active=True)    
-    transaction_type = request.GET.get('transaction_type', 'all')
-
-    if transaction_type == 'income':
-        transactions = transactions.filter(transaction_type='income')
-    elif transaction_type == 'expense':
-        transactions = transactions.filter(transaction_type='expense')
-    
-    category = request.GET.get('category')
-    if category:
-        transactions = transactions.filter(category_id=category)
-    
-    payment_method = request.GET.get('payment_method')
-    if payment_method:
-        transactions = transactions.filter(payment_method_id=payment_method)
-    
-    date_from = request.GET.get('date_from')
-    if date_from:
-        transactions = transactions.filter(transaction_date__gte=date_from)
-    
-    date_to = request.GET.get('date_to')
-    if date_to:
-        transactions = transactions.filter(transaction_date__lte=date_to)
-    
-    amount_min = request.GET.get('amount_min')
-    if amount_min:
-        transactions = transactions.filter(amount__gte=amount_min)
-    
-    amount_max = request.GET.get('amount_max')
-    if amount_max:
-        transactions = transactions.filter(amount__lte=amount_max)
+    filter_form = TransactionFilterForm(request.GET, user=request.user)
+    # Invalid filters are shown with their errors instead of applied
+    params = request.GET if filter_form.is_valid() else QueryDict()
+    transactions = filter_transactions(transactions, params)
+    archived = archived_transactions(request.user, params)
     
     # Calculate summary
-    income = transactions.filter(transaction_type='income').aggregate(Sum('amount'))['amount__sum'] or 0
-    expenses = transactions.filter(transaction_type='expense').aggregate(Sum('amount'))['amount__sum'] or 0
+    income = expenses = 0
+    for queryset in (transactions, archived):
+        if queryset is not None:
+            totals = queryset.aggregate(
+                income=Sum('amount', filter=Q(transaction_type='income')),
+                expenses=Sum('amount', filter=Q(transaction_type='expense')),
+            )
+            income += totals['income'] or 0
+            expenses += totals['expenses'] or 0
     net = income - expenses
+
+    if archived is not None:
+        # Both are ordered newest first; archived years are listed after the hot ones
+        transactions = heapq.merge(
+            transactions,
+            archived.select_related('category', 'payment_method'),
+            key=lambda transaction: (transaction.transaction_date, transaction.created_at),
+            reverse=True,
+        )
     
     context = {
         'transactions': transactions,
         'filter_form': filter_form,
+        'bulk_form': BulkActionForm(user=request.user, initial={'query': request.GET.urlencode()}),
         'income': income,
         'expenses': expenses,
         'net': net,
+        'catalog_version': get_catalog_version(request.user.pk),
+        'row_cache_timeout': ROW_CACHE_TIMEOUT,
     }
     return render(request, 'transactions/transaction_list.html', context)
 
 
+@login_required
+@require_http_methods(["GET"])
+def transaction_export(request):
+    """Stream the transactions matching the list filters as CSV, archived years included"""
+    transactions = filter_transactions(Transaction.objects.filter(user=request.user), request.GET)
+    sources = [transactions]
+    archived = archived_transactions(request.user, request.GET)
+    if archived is not None:
+        sources.append(archived)
+
+    def rows():
+        writer = csv.writer(Echo())
+        yield writer.writerow(EXPORT_COLUMNS)
+        for queryset in sources:
+            for row in queryset.values_list(
+                'transaction_date', 'transaction_type', 'amount', 'description', 'category__name',
+                'payment_method__name', 'status', 'is_reconciled', 'tags', 'notes'
+            ).iterator(chunk_size=2000):
+                yield writer.writerow(row)
+
+    response = StreamingHttpResponse(rows(), content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="transactions.csv"'
+    return response
+
+
 @login_required
 @require_http_methods(["GET", "POST"])
 def transaction_create(request):
@@ -78,7 +121,7 @@ def transaction_create(request):
             messages.success(request, 'Transaction created successfully!')
             return redirect('transaction_list')
     else:
-        form = TransactionForm()
+        form = TransactionForm(user=request.user)
     
     context = {'form': form, 'action': 'Create'}
     return render(request, 'transactions/transaction_form.html', context)
@@ -121,12 +164,73 @@ def transaction_delete(request, pk):
     return redirect('transaction_list')
 
 
+@login_required
+@require_http_methods(["GET"])
+def transaction_suggestions(request):
+    """Previous descriptions matching ``q``, with their usual category and payment method, as JSON"""
+    return JsonResponse({'suggestions': suggest_descriptions(request.user.pk, request.GET.get('q', ''))})
+
+
+@login_required
+@require_http_methods(["GET", "POST"])
+def transaction_reconcile(request):
+    """Reconcile transactions against an uploaded bank statement"""
+    result = None
+    if request.method == 'POST':
+        form = StatementUploadForm(request.POST, request.FILES)
+        if form.is_valid():
+            result = reconcile_statement(
+                request.user,
+                form.cleaned_data['statement'],
+                tolerance_days=form.cleaned_data['tolerance_days']
+            )
+            messages.success(request, f"Reconciled {len(result['matched'])} transactions.")
+    else:
+        form = StatementUploadForm()
+
+    context = {'form': form, 'result': result}
+    return render(request, 'transactions/reconcile.html', context)
+
+
+@login_required
+@require_http_methods(["POST"])
+def transaction_bulk_action(request):
+    """Apply one action to the selected transactions, or to everything matching the list filter"""
+    form = BulkActionForm(request.POST, user=request.user)
+    query = request.POST.get('query', '')
+
+    if form.is_valid():
+        transactions = Transaction.objects.filter(user=request.user)
+        if form.cleaned_data['select_all']:
+            transactions = filter_transactions(transactions, form.cleaned_data['filters'])
+        else:
+            transactions = transactions.filter(pk__in=form.cleaned_data['ids'])
+
+        count = apply_bulk_action(
+            request.user,
+            transactions,
+            form.cleaned_data['action'],
+            category_id=form.cleaned_data['category']
+        )
+        verb = 'Deleted' if form.cleaned_data['action'] == 'delete' else 'Updated'
+        messages.success(request, f'{verb} {count} transactions.')
+    else:
+        for error in form.non_field_errors() or [e for errors in form.errors.values() for e in errors]:
+            messages.error(request, error)
+
+    url = reverse('transaction_list')
+    return redirect(f'{url}?{query}' if query else url)
+
+
 # Category Views
 
 @login_required
 def category_list(request):
     """List all categories"""
-    categories = Category.objects.filter(user=request.user).order_by('category_type', 'name')
+    categories = list(Category.objects.filter(user=request.user).order_by('category_type', 'name'))
+    deleting = pending_deletion('category', [category.pk for category in categories])
+    for category in categories:
+        category.is_deleting = category.pk in deleting
     context = {'categories': categories}
     return render(request, 'transactions/category_list.html', context)
 
@@ -155,6 +259,9 @@ def category_create(request):
 def category_edit(request, pk):
     """Edit a category"""
     category = get_object_or_404(Category, pk=pk, user=request.user)
+    if pending_deletion('category', [category.pk]):
+        messages.error(request, 'This category is being deleted and cannot be edited.')
+        return redirect('category_list')
     
     if request.method == 'POST':
         form = CategoryForm(request.POST, instance=category)
@@ -172,13 +279,52 @@ def category_edit(request, pk):
 @login_required
 @require_http_methods(["POST"])
 def category_delete(request, pk):
-    """Delete a category"""
+    """Queue a category's removal; its budgets and trends are removed in the background"""
     category = get_object_or_404(Category, pk=pk, user=request.user)
-    category.delete()
-    messages.success(request, 'Category deleted successfully!')
+    if pending_deletion('category', [category.pk]):
+        messages.info(request, 'This category is already being deleted.')
+        return redirect('category_list')
+    start_deletion(category)
+    messages.success(request, 'Category is being deleted. Its transactions will be kept without a category.')
     return redirect('category_list')
 
 
+@login_required
+@require_http_methods(["GET", "POST"])
+def category_merge(request, pk):
+    """Move a category's transactions, budgets and goals into another category"""
+    category = get_object_or_404(Category, pk=pk, user=request.user)
+    if pending_deletion('category', [category.pk]):
+        messages.error(request, 'This category is being deleted and cannot be merged.')
+        return redirect('category_list')
+
+    if request.method == 'POST':
+        form = CategoryMergeForm(request.POST, category=category)
+        if form.is_valid():
+            target = get_object_or_404(Category, pk=form.cleaned_data['target'], user=request.user)
+            counts = merge_categories(
+                request.user,
+                [category],
+                target,
+                delete_source=form.cleaned_data['delete_source']
+            )
+            messages.success(
+                request,
+                f"Moved {counts['transactions']} transactions and {counts['budgets']} budgets "
+                f"from {category.name} to {target.name}."
+            )
+            return redirect('category_list')
+    else:
+        form = CategoryMergeForm(category=category)
+
+    context = {
+        'form': form,
+        'category': category,
+        'transaction_count': Transaction.objects.filter(category=category).count(),
+    }
+    return render(request, 'transactions/category_merge.html', context)
+
+
 # Payment Method Views
 
 @login_required